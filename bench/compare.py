@@ -0,0 +1,54 @@
+"""
+Compare two reports of bench/run.py, scenario by scenario.
+
+    python bench/compare.py before.json after.json --metric p95_ms --threshold 0.10
+
+Exits with status 1 when a scenario got slower than the threshold (10% by default), so it can gate a CI job.
+"""
+import sys
+import json
+import argparse
+
+# metrics where a bigger number is better
+HIGHER_IS_BETTER = ("rps",)
+
+
+def load(path):
+    with open(path) as report_file:
+        return json.load(report_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metric", default="p95_ms", help="p50_ms, p95_ms, p99_ms, mean_ms, rps, peak_rss_mb or mean_bytes")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+    for key in ("scale", "client", "database", "concurrency"):
+        if before["meta"].get(key) != after["meta"].get(key):
+            print("warning: %s differs (%s vs %s)" % (key, before["meta"].get(key), after["meta"].get(key)))
+
+    regressions = []
+    print("%-28s %12s %12s %9s" % ("scenario", "before", "after", "change"))
+    for name, old in sorted(before["scenarios"].items()):
+        new = after["scenarios"].get(name)
+        if new is None or old.get(args.metric) is None or new.get(args.metric) is None:
+            continue
+        old_value, new_value = old[args.metric], new[args.metric]
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        worse = -change if args.metric in HIGHER_IS_BETTER else change
+        flag = "  <- regression" if worse > args.threshold else ""
+        if flag:
+            regressions.append(name)
+        print("%-28s %12s %12s %+8.1f%%%s" % (name, old_value, new_value, change * 100, flag))
+
+    if regressions:
+        print("\n%d scenario(s) regressed more than %.0f%% on %s" % (len(regressions), args.threshold * 100, args.metric))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""
+Load benchmark of the API: seeds a synthetic Star Wars database and measures every route.
+
+    python bench/run.py --scale small --output results.json
+    python bench/run.py --scale medium --client http --workers 4 --concurrency 32 --output results.json
+    python bench/compare.py before.json after.json
+
+--client wsgi calls the Flask app in process (no network, one request at a time), --client http
+starts gunicorn with the Procfile command and drives it with concurrent keep-alive connections.
+The report has p50/p95/p99 latency, requests per second and peak RSS for every scenario.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+import http.client
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--scale", default="tiny", help="tiny, small, medium, large or a number of rows per catalog table")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database-url", help="defaults to a sqlite file per scale in /tmp")
+    parser.add_argument("--reseed", action="store_true", help="drop the tables and load the dataset again")
+    parser.add_argument("--client", choices=["wsgi", "http"], default="wsgi")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="http client threads")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers started by --client http")
+    parser.add_argument("--threads", type=int, default=16, help="threads of each gunicorn worker")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting gunicorn")
+    parser.add_argument("--only", help="comma separated scenario names")
+    parser.add_argument("--accept-encoding", help="Accept-Encoding header of every request, e.g. gzip or br")
+    parser.add_argument("--output", help="write the JSON report here (stdout otherwise)")
+    return parser.parse_args()
+
+
+def percentile(ordered, fraction):
+    # nearest rank, on an already sorted list
+    if not ordered:
+        return None
+    return ordered[max(int(math.ceil(fraction * len(ordered))) - 1, 0)]
+
+
+def summarize(latencies, statuses, elapsed, peak_rss, sizes=()):
+    ordered = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        # response body bytes as sent, compressed when --accept-encoding was given
+        "mean_bytes": round(sum(sizes) / len(sizes)) if sizes else None,
+        "errors": sum(count for status, count in statuses.items() if status == "error" or int(status) >= 500),
+        "statuses": statuses,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3) if ordered else None,
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3) if ordered else None,
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3) if ordered else None,
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+        "peak_rss_mb": round(peak_rss / 1024 / 1024, 1) if peak_rss else None,
+    }
+
+
+########## DATASET ##########
+
+def seed_database(app, db, dataset, reseed):
+    from models import Character
+    from seed import load_tables
+    with app.app_context():
+        if reseed:
+            db.drop_all()
+        db.create_all()
+        existing = db.session.query(Character.id).count()
+        db.session.commit()
+        if existing == dataset.size:
+            print("database already seeded with %d rows per catalog table" % existing, file=sys.stderr)
+            return
+        if existing:
+            sys.exit("the database has %d characters, not %d: use --reseed or another --database-url"
+                     % (existing, dataset.size))
+        # same bulk loader as `flask seed`
+        load_tables(db.engine, [(name, rows()) for name, rows in dataset.tables()],
+                    echo=lambda message: print("seeded " + message, file=sys.stderr))
+
+
+########## SCENARIOS ##########
+
+class Scenario:
+    def __init__(self, name, endpoint, method, make, max_requests=None):
+        self.name = name
+        # flask endpoint, to check that every route of src/app.py is covered
+        self.endpoint = endpoint
+        self.method = method
+        # make(i) -> (path, json body or None)
+        self.make = make
+        self.max_requests = max_requests
+
+
+def scenarios(dataset, run_id):
+    from synthetic import PowerLaw
+    from pagination import encode_cursor
+    size = dataset.size
+    # reads follow the same popularity as the favorites: hot rows get most of the traffic
+    rng = random.Random(dataset.seed)
+    hot = PowerLaw(size, dataset.alpha, rng)
+    hot_user = PowerLaw(dataset.user_count, dataset.alpha, rng)
+
+    def get(path):
+        return lambda i: (path, None)
+
+    def favorite_target(i):
+        # the same i gives the same pair, so the delete scenarios remove what the add scenarios wrote
+        pair = random.Random("favorite-%s-%d" % (run_id, i))
+        return pair.randint(1, dataset.user_count), pair.randint(1, size)
+
+    def deep_page(path):
+        return lambda i: ("%s?after=%s" % (path, encode_cursor({"id": hot.pick()})), None)
+
+    # ids above the dataset, written and removed by the catalog write scenarios
+    def new_id(i):
+        return size + 1 + i
+
+    result = [
+        Scenario("sitemap", "sitemap", "GET", get("/")),
+        Scenario("pool_stats", "get_pool_stats", "GET", get("/pool/stats")),
+        Scenario("cache_stats", "get_cache_stats", "GET", get("/cache/stats")),
+        Scenario("metrics", "metrics", "GET", get("/metrics")),
+        Scenario("create_user", "create_user", "POST",
+                 lambda i: ("/user", {"email": "bench-%s-%d@example.com" % (run_id, i), "password": "bench"})),
+        Scenario("users_list", "get_users", "GET", get("/users")),
+        Scenario("user_favorites", "get_users_favorites", "GET",
+                 lambda i: ("/users/%d/favorites" % hot_user.pick(), None)),
+        Scenario("user_favorites_expand", "get_users_favorites", "GET",
+                 lambda i: ("/users/%d/favorites?expand=1" % hot_user.pick(), None)),
+    ]
+    for kind, path, list_endpoint, single_endpoint in (
+            ("people", "/people", "get_all_people", "get_single_person"),
+            ("planets", "/planets", "get_all_the_planets", "get_single_planet"),
+            ("starships", "/starships", "get_all_the_starships", "get_a_starship")):
+        result += [
+            Scenario(kind + "_list", list_endpoint, "GET", get(path)),
+            Scenario(kind + "_list_deep_page", list_endpoint, "GET", deep_page(path)),
+            Scenario(kind + "_list_fields", list_endpoint, "GET", get(path + "?fields=id,name&limit=500")),
+            Scenario(kind + "_stream", list_endpoint, "GET", get(path + "?stream=1"), max_requests=3),
+            Scenario(kind + "_single", single_endpoint, "GET", lambda i, path=path: ("%s/%d" % (path, hot.pick()), None)),
+        ]
+    result += [
+        Scenario("people_filtered", "get_all_people", "GET", get("/people?age[gte]=30&eye_color=blue&sort=-age")),
+        Scenario("planets_filtered", "get_all_the_planets", "GET",
+                 get("/planets?population[gte]=1000000&climate=arid&sort=-diameter")),
+        Scenario("starships_filtered", "get_all_the_starships", "GET",
+                 get("/starships?starship_class[in]=Starfighter,Corvette&sort=crew")),
+        Scenario("top_planets", "get_top_items", "GET", get("/top/planets")),
+        Scenario("top_people_comments", "get_top_items", "GET", get("/top/people?by=comments&limit=50")),
+        Scenario("planet_comments", "get_item_comments", "GET",
+                 lambda i: ("/planets/%d/comments" % hot.pick(), None)),
+        Scenario("user_comments", "get_user_comments", "GET", lambda i: ("/users/%d/comments" % hot_user.pick(), None)),
+    ]
+    def add_favorite(kind):
+        def make(i):
+            user_id, target_id = favorite_target(i)
+            return "/favorites/user/%d/%s/%d" % (user_id, kind, target_id), None
+        return make
+
+    def delete_favorite(path):
+        def make(i):
+            user_id, target_id = favorite_target(i)
+            return "%s/%d?user_id=%d" % (path, target_id, user_id), None
+        return make
+
+    for kind, delete_path, add_endpoint, delete_endpoint in (
+            ("planet", "/favorite/planet", "add_favorite_planet_to_user", "delete_favorite_planet"),
+            ("people", "/favorites/people", "add_favorite_character_to_user", "delete_favorite_caracter"),
+            ("starship", "/favorites/starship", "add_favorite_starship_to_user", "delete_favorite_starship")):
+        result += [
+            Scenario("favorite_add_" + kind, add_endpoint, "POST", add_favorite(kind)),
+            Scenario("favorite_delete_" + kind, delete_endpoint, "DELETE", delete_favorite(delete_path)),
+        ]
+    result.append(Scenario("favorite_batch", "batch_favorites_of_user", "POST", lambda i: (
+        "/favorites/user/%d/batch" % hot_user.pick(),
+        {"add": [{"kind": "planet", "id": hot.pick()}, {"kind": "starship", "id": hot.pick()}],
+         "remove": [{"kind": "people", "id": hot.pick()}]},
+    )))
+    for kind, path, endpoint in (
+            ("planet", "/comment/planet", "add_comment_in_planet"),
+            ("people", "/comment/people", "add_comment_in_character"),
+            ("starship", "/comment/starship", "add_comment_in_starship")):
+        result.append(Scenario("comment_add_" + kind, endpoint, "POST", lambda i, path=path: (
+            "%s/%d" % (path, hot.pick()), {"user_id": hot_user.pick(), "comment_text": "benchmark comment %d" % i},
+        )))
+    words = ["sky", "an", "ka", "arid", "star", "force", "jedi dark", "corellian"]
+    result += [
+        Scenario("search", "search_everything", "GET", lambda i: ("/search?q=%s" % words[i % len(words)], None)),
+        Scenario("search_typed", "search_everything", "GET",
+                 lambda i: ("/search?q=%s&type=planets,starships" % words[i % len(words)], None)),
+    ]
+    result += [
+        Scenario("catalog_create", "create_catalog_items", "POST",
+                 lambda i: ("/planets", {"name": "Bench %d" % i, "climate": "arid", "population": i})),
+        Scenario("catalog_upsert", "upsert_catalog_items", "PUT",
+                 lambda i: ("/planets", [{"id": new_id(i), "name": "Bench %d" % i, "climate": "temperate"}])),
+        Scenario("catalog_update", "update_catalog_item", "PUT",
+                 lambda i: ("/planets/%d" % new_id(i), {"population": i})),
+        Scenario("catalog_delete", "delete_catalog_item", "DELETE", lambda i: ("/planets/%d" % new_id(i), None)),
+    ]
+    return result
+
+
+def check_coverage(app, selected):
+    covered = {scenario.endpoint for scenario in selected}
+    # the routes of src/app.py are the "api." blueprint, the other blueprints (flask-admin) and static files are not
+    endpoints = [rule.endpoint[len("api."):] if rule.endpoint.startswith("api.") else rule.endpoint
+                 for rule in app.url_map.iter_rules()]
+    missing = sorted(endpoint for endpoint in endpoints
+                     if "." not in endpoint and endpoint != "static" and endpoint not in covered)
+    if missing:
+        print("not benchmarked: %s" % ", ".join(missing), file=sys.stderr)
+    return missing
+
+
+########## CLIENTS ##########
+
+def peak_rss_self():
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def run_wsgi(app, scenario, count, accept_encoding=None):
+    client = app.test_client()
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    latencies = []
+    statuses = {}
+    sizes = []
+    start = time.perf_counter()
+    for i in range(count):
+        path, body = scenario.make(i)
+        began = time.perf_counter()
+        response = client.open(path, method=scenario.method, json=body, headers=headers)
+        sizes.append(len(response.get_data()))
+        latencies.append(time.perf_counter() - began)
+        status = str(response.status_code)
+        statuses[status] = statuses.get(status, 0) + 1
+    return summarize(latencies, statuses, time.perf_counter() - start, peak_rss_self(), sizes)
+
+
+def process_tree_rss(pid):
+    # resident memory of gunicorn: the master and its workers (linux /proc only)
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open("/proc/%d/status" % current) as status_file:
+                for line in status_file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            with open("/proc/%d/task/%d/children" % (current, current)) as children_file:
+                pending.extend(int(child) for child in children_file.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return self.peak
+
+
+class HttpClient:
+    """One keep-alive connection per thread, reopened when the server closes it"""
+
+    def __init__(self, host, port, accept_encoding=None):
+        self.host = host
+        self.port = port
+        self.accept_encoding = accept_encoding
+        self.local = threading.local()
+
+    def request(self, method, path, body):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = {"Accept-Encoding": self.accept_encoding} if self.accept_encoding else {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            size = len(response.read())
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            raise
+        if response.will_close:
+            connection.close()
+            self.local.connection = None
+        return response.status, size
+
+
+def run_http(client, scenario, count, concurrency, server_pid):
+    latencies = []
+    statuses = {}
+    sizes = []
+    lock = threading.Lock()
+
+    def one(i):
+        path, body = scenario.make(i)
+        began = time.perf_counter()
+        size = None
+        try:
+            status, size = client.request(scenario.method, path, body)
+            status = str(status)
+        except (OSError, http.client.HTTPException):
+            status = "error"
+        elapsed = time.perf_counter() - began
+        with lock:
+            latencies.append(elapsed)
+            if size is not None:
+                sizes.append(size)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    sampler = RssSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(count)))
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, statuses, elapsed, sampler.stop() if sampler else None, sizes)
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_gunicorn(workers, threads, env):
+    port = free_port()
+    # same command as the Procfile, bound to a local port
+    command = [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", SRC, "--preload",
+               "--worker-class", "gthread", "--threads", str(threads),
+               "--workers", str(workers), "--bind", "127.0.0.1:%d" % port, "--log-level", "warning"]
+    server = subprocess.Popen(command, env=env)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit("gunicorn exited with %s (is it installed? pip install gunicorn)" % server.returncode)
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return server, port
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("gunicorn did not start listening within 60 seconds")
+
+
+########## MAIN ##########
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                             cwd=ROOT, text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, SRC)
+    from synthetic import SyntheticDataset
+    dataset = SyntheticDataset(args.scale, seed=args.seed)
+    database_url = args.database_url or "sqlite:////tmp/starwars-bench-%d.db" % dataset.size
+    # the app reads its configuration when it is built, the same way as the gunicorn workers
+    os.environ["DATABASE_URL"] = database_url
+    # every request comes from one address, the per client buckets would measure themselves
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    from wsgi import application as app
+    from models import db
+    from sqlalchemy.engine import make_url
+
+    seed_database(app, db, dataset, args.reseed)
+    run_id = "%x" % int(time.time() * 1000)
+    selected = scenarios(dataset, run_id)
+    if args.only:
+        names = set(args.only.split(","))
+        selected = [scenario for scenario in selected if scenario.name in names]
+    missing = check_coverage(app, selected) if not args.only else []
+
+    server = None
+    server_pid = None
+    if args.client == "http":
+        if args.url:
+            host, _, port = args.url.split("://")[-1].rstrip("/").partition(":")
+            port = int(port or 80)
+        else:
+            server, port = start_gunicorn(args.workers, args.threads, dict(os.environ))
+            host, server_pid = "127.0.0.1", server.pid
+        client = HttpClient(host, port, args.accept_encoding)
+
+    results = {}
+    try:
+        for scenario in selected:
+            count = min(args.requests, scenario.max_requests or args.requests)
+            if args.client == "wsgi":
+                results[scenario.name] = run_wsgi(app, scenario, count, args.accept_encoding)
+            else:
+                results[scenario.name] = run_http(client, scenario, count, args.concurrency, server_pid)
+            results[scenario.name].update({"endpoint": scenario.endpoint, "method": scenario.method})
+            print("%-28s %8s rps  p50 %8s ms  p99 %8s ms  %d errors" % (
+                scenario.name, results[scenario.name]["rps"], results[scenario.name]["p50_ms"],
+                results[scenario.name]["p99_ms"], results[scenario.name]["errors"]), file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": make_url(database_url).get_backend_name(),
+            "scale": dataset.size,
+            "users": dataset.user_count,
+            "seed": args.seed,
+            "client": args.client,
+            "requests_per_scenario": args.requests,
+            "accept_encoding": args.accept_encoding,
+            "concurrency": args.concurrency if args.client == "http" else 1,
+            "workers": args.workers if args.client == "http" and not args.url else None,
+            "not_benchmarked": missing,
+        },
+        "scenarios": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""favorites and comment indexes
+
+Revision ID: 3c1f0a6d9b27
+Revises: 98be2e323b3f
+Create Date: 2026-10-18 10:12:41.518203
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f0a6d9b27'
+down_revision = '98be2e323b3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop duplicated favorites before the unique indexes are created (keeps the oldest row),
+    # pair by pair: rows that differ in another target column would still break the index
+    for column in ('planet_id', 'character_id', 'starship_id'):
+        op.execute(
+            "DELETE FROM favorites WHERE {0} IS NOT NULL AND id NOT IN ("
+            "SELECT id FROM (SELECT MIN(id) AS id FROM favorites WHERE {0} IS NOT NULL "
+            "GROUP BY user_id, {0}) AS keep)".format(column)
+        )
+    op.create_index('uq_favorites_user_planet', 'favorites', ['user_id', 'planet_id'], unique=True)
+    op.create_index('uq_favorites_user_character', 'favorites', ['user_id', 'character_id'], unique=True)
+    op.create_index('uq_favorites_user_starship', 'favorites', ['user_id', 'starship_id'], unique=True)
+    op.create_index('ix_favorites_planet_user', 'favorites', ['planet_id', 'user_id'], unique=False)
+    op.create_index('ix_favorites_character_user', 'favorites', ['character_id', 'user_id'], unique=False)
+    op.create_index('ix_favorites_starship_user', 'favorites', ['starship_id', 'user_id'], unique=False)
+    op.create_index('ix_comment_user_id', 'comment', ['user_id'], unique=False)
+    op.create_index('ix_comment_planet_user', 'comment', ['planet_id', 'user_id'], unique=False)
+    op.create_index('ix_comment_character_user', 'comment', ['character_id', 'user_id'], unique=False)
+    op.create_index('ix_comment_starship_user', 'comment', ['starship_id', 'user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comment_starship_user', table_name='comment')
+    op.drop_index('ix_comment_character_user', table_name='comment')
+    op.drop_index('ix_comment_planet_user', table_name='comment')
+    op.drop_index('ix_comment_user_id', table_name='comment')
+    op.drop_index('ix_favorites_starship_user', table_name='favorites')
+    op.drop_index('ix_favorites_character_user', table_name='favorites')
+    op.drop_index('ix_favorites_planet_user', table_name='favorites')
+    op.drop_index('uq_favorites_user_starship', table_name='favorites')
+    op.drop_index('uq_favorites_user_character', table_name='favorites')
+    op.drop_index('uq_favorites_user_planet', table_name='favorites')
@@ -0,0 +1,74 @@
+"""full-text search index
+
+Revision ID: 7d2b9e4c51a8
+Revises: 3c1f0a6d9b27
+Create Date: 2026-10-18 12:31:05.204917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2b9e4c51a8'
+down_revision = '3c1f0a6d9b27'
+branch_labels = None
+depends_on = None
+
+# doc_id = id * 4 + kind (0 people, 1 planets, 2 starships, 3 comments), same as src/search.py
+DOCUMENTS = [
+    "SELECT id * 4 + 0, 0, id, name, NULL FROM character",
+    "SELECT id * 4 + 1, 1, id, name, climate FROM planet",
+    "SELECT id * 4 + 2, 2, id, name, model FROM starship",
+    "SELECT id * 4 + 3, 3, id, NULL, comment_text FROM comment",
+]
+
+
+def fts5_available(bind):
+    try:
+        bind.exec_driver_sql("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(content)")
+        bind.exec_driver_sql("DROP TABLE temp.fts5_probe")
+    except sa.exc.OperationalError:
+        return False
+    return True
+
+
+def upgrade():
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+    if dialect == 'sqlite':
+        if not fts5_available(bind):
+            # sqlite built without FTS5: the API falls back to its in-memory index
+            return
+        op.execute(
+            "CREATE VIRTUAL TABLE search_index USING fts5("
+            "kind UNINDEXED, entity_id UNINDEXED, title, body, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+        columns = "rowid, kind, entity_id, title, body"
+    elif dialect == 'postgresql':
+        op.execute(
+            "CREATE TABLE search_index ("
+            "doc_id BIGINT PRIMARY KEY, kind SMALLINT NOT NULL, entity_id INTEGER NOT NULL, title TEXT, body TEXT, "
+            "document tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(body, '')), 'B')) STORED)"
+        )
+        op.execute("CREATE INDEX ix_search_index_document ON search_index USING GIN (document)")
+        columns = "doc_id, kind, entity_id, title, body"
+    elif dialect == 'mysql':
+        op.execute(
+            "CREATE TABLE search_index ("
+            "doc_id BIGINT PRIMARY KEY, kind SMALLINT NOT NULL, entity_id INTEGER NOT NULL, title TEXT, body TEXT, "
+            "FULLTEXT KEY ft_search_index (title, body)) ENGINE=InnoDB"
+        )
+        columns = "doc_id, kind, entity_id, title, body"
+    else:
+        return
+
+    for documents in DOCUMENTS:
+        op.execute("INSERT INTO search_index (%s) %s" % (columns, documents))
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS search_index")
@@ -0,0 +1,44 @@
+"""comment created_at and feed indexes
+
+Revision ID: a9f3d6b2c845
+Revises: e4a7c2d91f36
+Create Date: 2026-10-18 16:07:12.904381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9f3d6b2c845'
+down_revision = 'e4a7c2d91f36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('comment', sa.Column('created_at', sa.DateTime(), nullable=True))
+    # the existing comments have no date: they all get the upgrade time, the feeds order them by id
+    if op.get_bind().dialect.name == 'sqlite':
+        # same text format as SQLAlchemy writes, sqlite compares the dates as text
+        op.execute("UPDATE comment SET created_at = strftime('%Y-%m-%d %H:%M:%f', 'now') || '000'")
+    else:
+        op.execute("UPDATE comment SET created_at = CURRENT_TIMESTAMP")
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.alter_column('created_at', existing_type=sa.DateTime(), nullable=False)
+
+    op.drop_index('ix_comment_user_id', table_name='comment')
+    op.create_index('ix_comment_user_created', 'comment', ['user_id', 'created_at', 'id'], unique=False)
+    op.create_index('ix_comment_planet_created', 'comment', ['planet_id', 'created_at', 'id'], unique=False)
+    op.create_index('ix_comment_character_created', 'comment', ['character_id', 'created_at', 'id'], unique=False)
+    op.create_index('ix_comment_starship_created', 'comment', ['starship_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comment_starship_created', table_name='comment')
+    op.drop_index('ix_comment_character_created', table_name='comment')
+    op.drop_index('ix_comment_planet_created', table_name='comment')
+    op.drop_index('ix_comment_user_created', table_name='comment')
+    op.create_index('ix_comment_user_id', 'comment', ['user_id'], unique=False)
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.drop_column('created_at')
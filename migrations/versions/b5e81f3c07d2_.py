@@ -0,0 +1,41 @@
+"""list filter indexes
+
+Revision ID: b5e81f3c07d2
+Revises: 7d2b9e4c51a8
+Create Date: 2026-10-18 14:02:37.861140
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e81f3c07d2'
+down_revision = '7d2b9e4c51a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_character_name_id', 'character', ['name', 'id'], unique=False)
+    op.create_index('ix_character_age_id', 'character', ['age', 'id'], unique=False)
+    op.create_index('ix_character_eye_color_id', 'character', ['eye_color', 'id'], unique=False)
+    op.create_index('ix_planet_name_id', 'planet', ['name', 'id'], unique=False)
+    op.create_index('ix_planet_climate_id', 'planet', ['climate', 'id'], unique=False)
+    op.create_index('ix_planet_population_id', 'planet', ['population', 'id'], unique=False)
+    op.create_index('ix_planet_diameter_id', 'planet', ['diameter', 'id'], unique=False)
+    op.create_index('ix_starship_name_id', 'starship', ['name', 'id'], unique=False)
+    op.create_index('ix_starship_starship_class_id', 'starship', ['starship_class', 'id'], unique=False)
+    op.create_index('ix_starship_crew_id', 'starship', ['crew', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_starship_crew_id', table_name='starship')
+    op.drop_index('ix_starship_starship_class_id', table_name='starship')
+    op.drop_index('ix_starship_name_id', table_name='starship')
+    op.drop_index('ix_planet_diameter_id', table_name='planet')
+    op.drop_index('ix_planet_population_id', table_name='planet')
+    op.drop_index('ix_planet_climate_id', table_name='planet')
+    op.drop_index('ix_planet_name_id', table_name='planet')
+    op.drop_index('ix_character_eye_color_id', table_name='character')
+    op.drop_index('ix_character_age_id', table_name='character')
+    op.drop_index('ix_character_name_id', table_name='character')
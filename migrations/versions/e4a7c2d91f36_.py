@@ -0,0 +1,49 @@
+"""favorite and comment counters
+
+Revision ID: e4a7c2d91f36
+Revises: b5e81f3c07d2
+Create Date: 2026-10-18 15:20:48.317652
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7c2d91f36'
+down_revision = 'b5e81f3c07d2'
+branch_labels = None
+depends_on = None
+
+# counted table -> its column in favorites and comment, same as src/popularity.py
+TARGETS = [('character', 'character_id'), ('planet', 'planet_id'), ('starship', 'starship_id')]
+
+
+def upgrade():
+    op.create_table('popularity',
+    sa.Column('target_table', sa.String(length=20), nullable=False),
+    sa.Column('target_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('favorites', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('comments', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('target_table', 'target_id')
+    )
+    op.create_index('ix_popularity_favorites', 'popularity', ['target_table', 'favorites', 'target_id'], unique=False)
+    op.create_index('ix_popularity_comments', 'popularity', ['target_table', 'comments', 'target_id'], unique=False)
+
+    # backfill the counters of the items that already have favorites or comments
+    for table, column in TARGETS:
+        op.execute(
+            "INSERT INTO popularity (target_table, target_id, favorites, comments) "
+            "SELECT '{table}', t.id, "
+            "(SELECT COUNT(*) FROM favorites f WHERE f.{column} = t.id), "
+            "(SELECT COUNT(*) FROM comment c WHERE c.{column} = t.id) "
+            "FROM {quoted} t WHERE EXISTS (SELECT 1 FROM favorites f WHERE f.{column} = t.id) "
+            "OR EXISTS (SELECT 1 FROM comment c WHERE c.{column} = t.id)".format(
+                table=table, column=column, quoted=op.get_bind().dialect.identifier_preparer.quote(table))
+        )
+
+
+def downgrade():
+    op.drop_index('ix_popularity_comments', table_name='popularity')
+    op.drop_index('ix_popularity_favorites', table_name='popularity')
+    op.drop_table('popularity')
@@ -1,21 +1,257 @@
 import os
+import time
+import threading
+from collections import OrderedDict
 from flask_admin import Admin
+from flask_admin.babel import lazy_gettext
+from flask_admin.contrib.sqla import ModelView, filters as sqla_filters
+from flask_admin.contrib.sqla.ajax import QueryAjaxModelLoader
+from flask_admin.model.ajax import DEFAULT_PAGE_SIZE
+from sqlalchemy import func, or_, select, text, tuple_
+from sqlalchemy.orm import joinedload
 from models import db, User, Character, Planet, Starship, Favorite, Comment
-from flask_admin.contrib.sqla import ModelView
+from filters import FILTERABLE
+
+# exact counts up to this many rows, above it the list pages show an estimate
+ADMIN_COUNT_LIMIT = int(os.getenv("ADMIN_COUNT_LIMIT", 10000))
+ADMIN_COUNT_TTL = float(os.getenv("ADMIN_COUNT_TTL", 60))
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 50))
+
+
+class Memo:
+    """Small LRU of values that expire after ttl seconds, shared by the requests of one worker"""
+
+    def __init__(self, max_entries=256, ttl=ADMIN_COUNT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.entries.pop(key, None)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def estimated_count(session, model):
+    """Row count from the planner statistics, MAX(id) where there are none (exact when ids are not reused)"""
+    bind = session.get_bind(mapper=model)
+    name = model.__tablename__
+    if bind.dialect.name == "postgresql":
+        # -1 (postgres 14+) or 0 until the table has been analyzed
+        estimate = session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)"), {"name": '"%s"' % name}
+        ).scalar()
+        if estimate and estimate > 0:
+            return estimate
+    elif bind.dialect.name == "mysql":
+        estimate = session.execute(
+            text("SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = :name"),
+            {"name": name}).scalar()
+        if estimate:
+            return estimate
+    return session.execute(select(func.max(model.id))).scalar() or 0
+
+
+class FilterStartsWith(sqla_filters.BaseSQLAFilter):
+    # prefix match: LIKE 'value%' can use the (column, id) index, the stock "contains" filter can not
+    def apply(self, query, value, alias=None):
+        return query.filter(self.get_column(alias).startswith(value, autoescape=True))
+
+    def operation(self):
+        return lazy_gettext('starts with')
+
+
+class PrefixAjaxLoader(QueryAjaxModelLoader):
+    """Type-ahead for the foreign key fields: an id, or the prefix of an indexed column.
+
+    The stock loader runs CAST(field AS TEXT) ILIKE '%term%', a full scan for every key stroke.
+    """
+
+    def get_list(self, term, offset=0, limit=DEFAULT_PAGE_SIZE):
+        term = term.strip()
+        conditions = [field.startswith(term, autoescape=True) for field in self._cached_fields]
+        if term.isdigit():
+            conditions.append(self.model.id == int(term))
+        field = self._cached_fields[0]
+        query = self.get_query().filter(or_(*conditions)).order_by(field, self.model.id)
+        return query.offset(offset).limit(limit).all()
+
+
+def ajax_refs(**targets):
+    # relationship name -> (model, indexed text column searched by prefix)
+    return {name: PrefixAjaxLoader(name, db.session, model, fields=[field], page_size=10)
+            for name, (model, field) in targets.items()}
+
+
+class ScalableModelView(ModelView):
+    """ModelView for tables too big for COUNT(*), OFFSET paging, unindexed sorts and full dropdowns.
+
+    - counts are exact up to ADMIN_COUNT_LIMIT rows and estimated above it, cached for ADMIN_COUNT_TTL
+    - pages sorted by id seek past the last id of the previous page; other sorts page over the index
+      only (the OFFSET walks ids, then only one page of rows is read)
+    - views only list indexed columns in column_sortable_list and column_filters
+    - the many-to-one columns of the list are joined in the same query (column_select_related_list)
+    """
+    page_size = ADMIN_PAGE_SIZE
+    can_set_page_size = False
+    column_display_pk = True
+    column_default_sort = ("id", True)
+
+    def __init__(self, model, session, **kwargs):
+        self.counts = Memo()
+        # last (sort value, id) of every page served recently, the next page seeks from it
+        self.boundaries = Memo(max_entries=1024)
+        super().__init__(model, session, **kwargs)
+
+    def list_count(self, query, key, narrowed):
+        count = self.counts.get(key)
+        if count is None:
+            bounded = query.with_entities(self.model.id).order_by(None).limit(ADMIN_COUNT_LIMIT + 1).subquery()
+            count = self.session.query(func.count()).select_from(bounded).scalar()
+            if count > ADMIN_COUNT_LIMIT:
+                # filtered lists stop at the limit, the whole table uses the statistics
+                count = ADMIN_COUNT_LIMIT if narrowed else max(estimated_count(self.session, self.model), count)
+            self.counts.set(key, count)
+        return count
+
+    def sort_field(self, sort_column, sort_desc):
+        if sort_column is not None and sort_column in self._sortable_columns:
+            field = self._sortable_columns[sort_column]
+            if not isinstance(field, list) and not self._sortable_joins.get(sort_column):
+                return field, bool(sort_desc)
+        return self.model.id, True
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        joins = {}
+        query = self.get_query()
+        if self._search_supported and search:
+            query, _, joins, _ = self._apply_search(query, None, joins, {}, search)
+        if filters and self._filters:
+            query, _, joins, _ = self._apply_filters(query, None, joins, {}, filters)
+
+        key = (search or "", tuple(tuple(flt) for flt in filters or ()))
+        count = self.list_count(query, key, bool(search or filters))
+
+        field, descending = self.sort_field(sort_column, sort_desc)
+        id_field = self.model.id
+        by_id = field.key == id_field.key
+        # id breaks the ties, the order is total and matches the (column, id) indexes
+        columns = (field,) if by_id else (field, id_field)
+        order = [column.desc() if descending else column.asc() for column in columns]
+        page_size = self.page_size if page_size is None else page_size
+        page_key = key + (sort_column, descending)
+
+        # a seek would skip the NULLs, each backend sorts them on another end
+        seekable = by_id or not self.model.__table__.c[field.key].nullable
+        boundary = self.boundaries.get(page_key + (page - 1,)) if page and seekable else None
+        if boundary is not None:
+            position = id_field if by_id else tuple_(field, id_field)
+            value = boundary[1] if by_id else tuple_(*boundary)
+            query = query.filter(position < value if descending else position > value)
+        elif page and page_size:
+            # OFFSET over the ids only (an index scan), then read just the rows of the page
+            ids = query.with_entities(id_field).order_by(*order).limit(page_size).offset(page * page_size).subquery()
+            query = query.join(ids, id_field == ids.c.id)
+
+        for relation in self._auto_joins:
+            query = query.options(joinedload(relation))
+        query = query.order_by(*order)
+        if page_size:
+            query = query.limit(page_size)
+        if not execute:
+            return count, query
+
+        items = query.all()
+        if items and page_size and len(items) == page_size:
+            last = items[-1]
+            self.boundaries.set(page_key + (page,), (getattr(last, field.key), last.id))
+        return count, items
+
+
+class UserView(ScalableModelView):
+    column_list = ["id", "email", "is_active"]
+    column_sortable_list = ["id", "email"]
+    column_filters = [FilterStartsWith(User.email, "Email"), sqla_filters.FilterEqual(User.email, "Email")]
+    form_excluded_columns = ["favorites", "comment"]
+
+
+class CatalogView(ScalableModelView):
+    # the relationship lists would load every favorite and comment of the item into the form
+    form_excluded_columns = ["favorite", "favorites", "comment", "comments"]
+
+    def __init__(self, model, session, **kwargs):
+        # sorts and filters on the (column, id) indexes of the list endpoint
+        self.column_sortable_list = ["id"] + FILTERABLE[model]
+        self.column_filters = []
+        for name in FILTERABLE[model]:
+            column = getattr(model, name)
+            if isinstance(column.type, db.Integer):
+                self.column_filters += [sqla_filters.IntEqualFilter(column, name), sqla_filters.IntGreaterFilter(column, name),
+                                        sqla_filters.IntSmallerFilter(column, name)]
+            else:
+                self.column_filters += [sqla_filters.FilterEqual(column, name), FilterStartsWith(column, name)]
+        super().__init__(model, session, **kwargs)
+
+
+class FavoriteView(ScalableModelView):
+    column_list = ["id", "user", "character", "planet", "starship"]
+    column_select_related_list = ["user", "character", "planet", "starship"]
+    column_sortable_list = ["id"]
+    # each one is the leading column of an index
+    column_filters = [sqla_filters.IntEqualFilter(Favorite.user_id, "User id"),
+                      sqla_filters.IntEqualFilter(Favorite.character_id, "Character id"),
+                      sqla_filters.IntEqualFilter(Favorite.planet_id, "Planet id"),
+                      sqla_filters.IntEqualFilter(Favorite.starship_id, "Starship id")]
+
+    def __init__(self, model, session, **kwargs):
+        self.form_ajax_refs = ajax_refs(user=(User, "email"), character=(Character, "name"),
+                                        planet=(Planet, "name"), starship=(Starship, "name"))
+        super().__init__(model, session, **kwargs)
+
+
+class CommentView(ScalableModelView):
+    column_list = ["id", "created_at", "comment_text", "user", "character", "planet", "starship"]
+    column_select_related_list = ["user", "character", "planet", "starship"]
+    column_sortable_list = ["id"]
+    column_filters = [sqla_filters.IntEqualFilter(Comment.user_id, "User id"),
+                      sqla_filters.IntEqualFilter(Comment.character_id, "Character id"),
+                      sqla_filters.IntEqualFilter(Comment.planet_id, "Planet id"),
+                      sqla_filters.IntEqualFilter(Comment.starship_id, "Starship id")]
+    # filled in by the model default
+    form_excluded_columns = ["created_at"]
+
+    def __init__(self, model, session, **kwargs):
+        self.form_ajax_refs = ajax_refs(user=(User, "email"), character=(Character, "name"),
+                                        planet=(Planet, "name"), starship=(Starship, "name"))
+        super().__init__(model, session, **kwargs)
+
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
 
-    
+
     # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView (Character, db.session))
-    admin.add_view(ModelView (Planet, db.session))
-    admin.add_view(ModelView (Starship, db.session))
-    admin.add_view(ModelView (Favorite, db.session))
-    admin.add_view(ModelView (Comment, db.session))
+    # the views page, count, sort and look up foreign keys in ways that stay fast on million-row tables
+    admin.add_view(UserView(User, db.session))
+    admin.add_view(CatalogView(Character, db.session))
+    admin.add_view(CatalogView(Planet, db.session))
+    admin.add_view(CatalogView(Starship, db.session))
+    admin.add_view(FavoriteView(Favorite, db.session))
+    admin.add_view(CommentView(Comment, db.session))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ModelView(YourModelName, db.session))
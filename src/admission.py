@@ -0,0 +1,162 @@
+"""
+Admission control: per client token buckets and load shedding in front of the handlers.
+
+- every client (IP) gets one bucket for reads (GET/HEAD/OPTIONS) and one for writes, an empty
+  bucket answers 429 with Retry-After
+- a worker with more than SHED_MAX_IN_FLIGHT requests, or whose pool is busy and has recently made
+  checkouts wait longer than SHED_POOL_WAIT_MS, answers 503 with Retry-After before touching the database
+- a pool timeout inside a handler turns its 500 into the same 503
+
+The buckets and counters live in each worker: with N gunicorn workers a client can get up to N times the rate.
+Shedding needs threaded workers (--worker-class gthread --threads T, see the Procfile): a sync worker
+serves one request at a time, so it never has more than one in flight nor a busy pool to shed on.
+"""
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from flask import g, request, jsonify
+from models import db
+from db_config import InstrumentedQueuePool
+from metrics import request_metrics
+
+# tokens per second and bucket size of every client, RATE_LIMIT_ENABLED=0 or a rate of 0 turns them off
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1").lower() in ("1", "true", "yes")
+RATE_LIMIT_READ_RATE = float(os.getenv("RATE_LIMIT_READ_RATE", 100))
+RATE_LIMIT_READ_BURST = float(os.getenv("RATE_LIMIT_READ_BURST", 200))
+RATE_LIMIT_WRITE_RATE = float(os.getenv("RATE_LIMIT_WRITE_RATE", 20))
+RATE_LIMIT_WRITE_BURST = float(os.getenv("RATE_LIMIT_WRITE_BURST", 40))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", 10000))
+# reverse proxies in front of the app (1 on Render/Heroku): the client is that many hops back in X-Forwarded-For
+RATE_LIMIT_PROXIES = int(os.getenv("RATE_LIMIT_PROXIES", 0))
+# shedding thresholds of one worker, 0 turns a check off
+# in flight requests are at most the worker threads (16 in the Procfile), the rest wait in gunicorn
+SHED_MAX_IN_FLIGHT = int(os.getenv("SHED_MAX_IN_FLIGHT", 12))
+SHED_POOL_WAIT_MS = float(os.getenv("SHED_POOL_WAIT_MS", 250))
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", 2))
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+# operators still need these while the API sheds
+EXEMPT_ENDPOINTS = ("metrics", "static", "api.get_pool_stats")
+
+
+class TokenBuckets:
+    """Token bucket per (client, route class), the least recently seen clients are forgotten first"""
+
+    def __init__(self, limits, max_entries):
+        # route class -> (tokens per second, burst)
+        self.limits = limits
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, client, route_class):
+        """0 when the request may go on, otherwise the seconds until the bucket has a token again"""
+        rate, burst = self.limits[route_class]
+        if rate <= 0:
+            return 0
+        key = (client, route_class)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+                while len(self.buckets) > self.max_entries:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+    def size(self):
+        with self.lock:
+            return len(self.buckets)
+
+
+class AdmissionStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"rate_limited": 0, "shed_in_flight": 0, "shed_pool_wait": 0, "pool_timeouts": 0}
+
+    def add(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+buckets = TokenBuckets({"read": (RATE_LIMIT_READ_RATE, RATE_LIMIT_READ_BURST),
+                        "write": (RATE_LIMIT_WRITE_RATE, RATE_LIMIT_WRITE_BURST)}, RATE_LIMIT_MAX_CLIENTS)
+admission_stats = AdmissionStats()
+
+
+def client_key():
+    if RATE_LIMIT_PROXIES > 0 and len(request.access_route) >= RATE_LIMIT_PROXIES:
+        # the proxies append the address they got the request from, the earlier entries can be forged
+        return request.access_route[-RATE_LIMIT_PROXIES]
+    return request.remote_addr or "unknown"
+
+
+def pool_overloaded():
+    """True when a pool has no idle connection left and its checkouts have been waiting too long"""
+    if SHED_POOL_WAIT_MS <= 0:
+        return False
+    for engine in db.engines.values():
+        pool = engine.pool
+        if not isinstance(pool, InstrumentedQueuePool):
+            continue
+        # the wait average only moves on checkouts: once the pool has idle connections again it is ignored
+        busy = pool.checkedout() >= pool.size()
+        if busy and pool.checkout_stats.recent_wait * 1000 >= SHED_POOL_WAIT_MS:
+            return True
+    return False
+
+
+def refuse(status, message, retry_after):
+    response = jsonify({"message": message})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(int(math.ceil(retry_after)), 1))
+    return response
+
+
+def admit():
+    if request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if RATE_LIMIT_ENABLED:
+        wait = buckets.take(client_key(), "read" if request.method in READ_METHODS else "write")
+        if wait:
+            admission_stats.add("rate_limited")
+            return refuse(429, "Too many requests", wait)
+    # in_flight already counts this request (metrics runs first)
+    if SHED_MAX_IN_FLIGHT > 0 and request_metrics.in_flight > SHED_MAX_IN_FLIGHT:
+        admission_stats.add("shed_in_flight")
+        return refuse(503, "Server busy, try again later", SHED_RETRY_AFTER)
+    if pool_overloaded():
+        admission_stats.add("shed_pool_wait")
+        return refuse(503, "Server busy, try again later", SHED_RETRY_AFTER)
+    return None
+
+
+def pool_timeout_to_503(response):
+    # the handlers catch every exception and answer 500, a pool timeout means overload, not a bug
+    if response.status_code == 500 and g.get("pool_timed_out"):
+        admission_stats.add("pool_timeouts")
+        return refuse(503, "Server busy, try again later", SHED_RETRY_AFTER)
+    return response
+
+
+def admission_metrics():
+    # counters for /metrics, gauge_ keys are exported as gauges
+    return dict(admission_stats.to_dict(), gauge_clients=buckets.size())
+
+
+def init_admission(app):
+    app.before_request(admit)
+    app.after_request(pool_timeout_to_503)
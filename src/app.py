@@ -2,72 +2,175 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate, upgrade, migrate
-from flask_swagger import swagger
+from flask import Flask, Blueprint, request, jsonify, current_app
 from flask_cors import CORS
 from utils import APIException, generate_sitemap
-from admin import setup_admin
 from models import db, User, Favorite, Character, Planet, Starship, Comment
+from pagination import page_args, paginate_serialized, with_next_link, next_link, encode_cursor, \
+    newest_first_args, paginate_newest
+from serializers import fields_arg
+from filters import list_args
+from streaming import wants_stream, stream_collection
+from favorites import add_favorite, remove_favorite, apply_favorite_batch
+from cache import cached_response, entity_cache, entity_cache_metrics
+from json_provider import init_json
+from db_config import engine_options, pool_stats, pool_metrics, dispose_after_fork, sqlite_foreign_keys
+from metrics import init_metrics, request_metrics
+from profiling import init_profiling, query_budget
+from compression import init_compression
+from admission import init_admission, admission_metrics, refuse, SHED_RETRY_AFTER
+from comment_queue import comment_queue, comment_values, init_comment_queue, comments_replay_command
+from seed import seed_command
+from search import search, kinds_arg, include_object, search_reindex_command
+from popularity import top, top_args, popularity_reconcile_command
+from routing import read_only, replica_binds, init_routing, REPLICA_BIND
+from ingest import CATALOG, to_row, batch_size_arg, request_items, ingest, sync_id_sequence, delete_with_dependents
+from boot import boot_time_command
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, joinedload
 #from models import Person
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-#db = SQLAlchemy(app)
-
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+api = Blueprint("api", __name__)
+
+
+def env_flag(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+
+def create_app(config=None):
+    """Build the app: configuration from the environment, overridden by config, then the extensions.
+
+    Flask-Admin, Flask-Migrate and the swagger spec are only imported when enabled. `flask ...` commands
+    call create_app() with everything on, src/wsgi.py builds the web server app without the migrations.
+    """
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    init_json(app)
+
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['ADMIN_ENABLED'] = env_flag("ENABLE_ADMIN", True)
+    app.config['MIGRATE_ENABLED'] = env_flag("ENABLE_MIGRATE", True)
+    app.config['SWAGGER_ENABLED'] = env_flag("ENABLE_SWAGGER", False)
+    app.config.update(config or {})
+    # pool size/overflow/timeout/recycle/pre-ping from the DB_* variables, with per driver defaults
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    # optional read replica, used by the handlers marked with @read_only
+    app.config.setdefault('SQLALCHEMY_BINDS', replica_binds(os.getenv("DATABASE_REPLICA_URL"), engine_options))
+
+    db.init_app(app)
+    # gunicorn --preload builds the app once in the master, the workers must not share its connections
+    with app.app_context():
+        dispose_after_fork(list(db.engines.values()))
+        # the favorite and comment handlers answer 404 on foreign key violations
+        sqlite_foreign_keys(db.engines.values())
+    if app.config['MIGRATE_ENABLED']:
+        from flask_migrate import Migrate
+        # the search_index table has its own migration, autogenerate leaves it alone
+        Migrate(app, db, include_object=include_object)
+    CORS(app, expose_headers=["Link"])
+    # /metrics: latency histograms, query counters and in-flight requests of all the workers
+    init_metrics(app)
+    request_metrics.collectors["entity_cache"] = entity_cache_metrics
+    request_metrics.collectors["db_pool"] = lambda: pool_metrics(db.engine)
+    # 429 per client token buckets, 503 when this worker or its pool is overloaded
+    init_admission(app)
+    request_metrics.collectors["admission"] = admission_metrics
+    # slow query log with EXPLAIN, N+1 warnings, SQL_PROFILE=1 logs every statement
+    init_profiling(app)
+    init_routing(app)
+    # gzip/deflate/br for the JSON bodies above COMPRESS_MIN_SIZE, the response cache keeps its own compressed copies
+    init_compression(app)
+    app.register_blueprint(api)
+    if app.config['ADMIN_ENABLED']:
+        from admin import setup_admin
+        setup_admin(app)
+    if app.config['SWAGGER_ENABLED']:
+        from flask_swagger import swagger
+        app.add_url_rule('/swagger.json', 'swagger', lambda: jsonify(swagger(app)), methods=['GET'])
+
+    # flask seed --scale small | --from data/: bulk load of the whole schema
+    app.cli.add_command(seed_command)
+    app.cli.add_command(search_reindex_command)
+    app.cli.add_command(popularity_reconcile_command)
+    app.cli.add_command(boot_time_command)
+    # COMMENTS_WRITE_BEHIND=1: the comment handlers queue, a background thread writes in batches
+    init_comment_queue(app)
+    request_metrics.collectors["comment_queue"] = comment_queue.stats
+    app.cli.add_command(comments_replay_command)
+    return app
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
+
+# live connection pool usage and checkout wait times of this worker
+@api.route('/pool/stats', methods=['GET'])
+def get_pool_stats():
+    stats = pool_stats(db.engine)
+    if REPLICA_BIND in db.engines:
+        stats["replica"] = pool_stats(db.engines[REPLICA_BIND])
+    return jsonify(stats), 200
+
+# hit/miss/eviction counters of the single object cache of this worker
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(entity_cache.stats()), 200
 
 
 ##Create an API that connects to a database and implements the following endpoints (very similar to SWAPI.dev or SWAPI.tech):
 #[GET] /people Get a list of all the people in the database.
-@app.route('/people', methods=['GET'])
+@api.route('/people', methods=['GET'])
+@cached_response("people")
+@read_only
+@query_budget(2)
 def get_all_people():
+    #read ?fields=, ?limit=, ?after= and the filters (?age[gte]=30&sort=-name) before touching the database
+    limit, after = page_args()
+    filters, sort = list_args(Character, after)
+    #?stream=1 or Accept: application/x-ndjson sends the whole collection in batches
+    if wants_stream():
+        return stream_collection(Character, filters, sort)
+    fields = fields_arg(Character)
     try:
-        # Query all characters from the database
-        characters = Character.query.all()
-        #serialize the rssults
-        characters_list = [character.serialize() for character in characters]
+        # Query one page of characters from the database, serialized straight from the rows
+        characters_list, next_url = paginate_serialized(Character, fields, limit, after, filters, sort)
+        #hot characters are already encoded in the identity cache
+        if fields is None:
+            characters_list = entity_cache.with_fragments(Character, characters_list, current_app.json.dumps)
         #return th serialized list
-        return jsonify(characters_list), 200
+        return with_next_link(jsonify(characters_list), next_url), 200
     except Exception as error:
         print(error)
         return jsonify({"message": "Error fetching people from database"}), 500
 
 
 #[GET] /people/<int:people_id> Get one single person's information.
-@app.route('/people/<int:people_id>', methods=['GET'])
+@api.route('/people/<int:people_id>', methods=['GET'])
+@cached_response("people")
+@read_only
+@query_budget(2)
 def get_single_person(people_id):
     try:
-        #do the query for the peopli_id
-        character = Character.query.get(people_id)
+        #serialized person from the identity cache, only a miss queries the database
+        character_data = entity_cache.get_or_load(Character, people_id)
 
         #if character is not found, return 404
-        if character is None:
+        if character_data is None:
             return jsonify({"message": "Person not found"}), 404
-        
-        #serialize the result of request
-        character_data = character.serialize()
 
         #return serialized person    
         return jsonify(character_data), 200
@@ -77,14 +180,22 @@ def get_single_person(people_id):
 
 
 #[GET] /planets Get a list of all the planets in the database.
-@app.route('/planets', methods=['GET'])
+@api.route('/planets', methods=['GET'])
+@cached_response("planets")
+@read_only
+@query_budget(2)
 def get_all_the_planets():
+    limit, after = page_args()
+    filters, sort = list_args(Planet, after)
+    if wants_stream():
+        return stream_collection(Planet, filters, sort)
+    fields = fields_arg(Planet)
     try:
-        planets = Planet.query.all()
-
-        planets_lists = [planet.serialize() for planet in planets]
+        planets_lists, next_url = paginate_serialized(Planet, fields, limit, after, filters, sort)
+        if fields is None:
+            planets_lists = entity_cache.with_fragments(Planet, planets_lists, current_app.json.dumps)
 
-        return jsonify(planets_lists), 200
+        return with_next_link(jsonify(planets_lists), next_url), 200
     except Exception as  error:
         print(error)
         return jsonify({"message": "Error fetching planets from database"}), 500
@@ -92,15 +203,16 @@ def get_all_the_planets():
 
 
 #[GET] /planets/<int:planet_id> Get one single planet's information.
-@app.route('/planets/<int:planet_id>', methods=['GET'])
+@api.route('/planets/<int:planet_id>', methods=['GET'])
+@cached_response("planets")
+@read_only
+@query_budget(2)
 def get_single_planet(planet_id):
     try:
-        planet = Planet.query.get(planet_id)
+        planet_data = entity_cache.get_or_load(Planet, planet_id)
 
-        if planet in None:
+        if planet_data is None:
             return jsonify({"message": "planet not found"}), 404
-        
-        planet_data =planet.serialize()
 
         return jsonify(planet_data), 200
     except Exception as error:
@@ -108,42 +220,50 @@ def get_single_planet(planet_id):
         return jsonify({"message": "Error fetching planet from the dstabase"}), 500
 
 #[GET] /starships Get a list of all the starships in the database.
-@app.route('/starships', methods=['GET'])
+@api.route('/starships', methods=['GET'])
+@cached_response("starships")
+@read_only
+@query_budget(2)
 def get_all_the_starships():
+    limit, after = page_args()
+    filters, sort = list_args(Starship, after)
+    if wants_stream():
+        return stream_collection(Starship, filters, sort)
+    fields = fields_arg(Starship)
     try:
-        # Realiza la consulta para obtener todas las naves estelares
-        starships = Starship.query.all()
-        
-        # Serializa los resultados de la consulta
-        starships_list = [starship.serialize() for starship in starships]
+        # Realiza la consulta para obtener una pagina de naves estelares ya serializadas
+        starships_list, next_url = paginate_serialized(Starship, fields, limit, after, filters, sort)
+        if fields is None:
+            starships_list = entity_cache.with_fragments(Starship, starships_list, current_app.json.dumps)
 
         # Retorna la lista serializada de naves estelares
-        return jsonify(starships_list), 200
+        return with_next_link(jsonify(starships_list), next_url), 200
     except Exception as error:
         print(error)
         return jsonify({"message": "Error fetching starships from the database"}), 500
 
 
-#[GET] /starships/<int:planet_id> Get one single planet's information.
-@app.route('/starships/<int:starship>', methods=['GET'])
+#[GET] /starships/<int:starship_id> Get one single starship's information.
+@api.route('/starships/<int:starship_id>', methods=['GET'])
+@cached_response("starships")
+@read_only
+@query_budget(2)
 def get_a_starship(starship_id):
     try:
-        starship = Starship.query.get(starship_id)
+        starship_data = entity_cache.get_or_load(Starship, starship_id)
 
-        if starship in None:
+        if starship_data is None:
             return jsonify({"message": "starship not found"}), 404
-        
-        starship_data =starship.serialize()
 
         return jsonify(starship_data), 200
     except Exception as error:
         print(error)
-        return jsonify({"message": "Error fetching starship from the dstabase"})
+        return jsonify({"message": "Error fetching starship from the dstabase"}), 500
 
 
 ##Additionally, create the following endpoints to allow your StarWars blog to have users and favorites:
 #[POST] /users Create users. 
-@app.route("/user", methods=["POST"])
+@api.route("/user", methods=["POST"])
 def create_user():
     #Extract data from request
     data = request.json
@@ -169,26 +289,32 @@ def create_user():
 
 
 #[GET] /users Get a list of all the blog post users. [POSTS.COMMENTS]
-@app.route('/users', methods=["GET"])
+@api.route('/users', methods=["GET"])
+@read_only
+@query_budget(2)
 def get_users():
+    if wants_stream():
+        return stream_collection(User)
+    fields = fields_arg(User)
+    limit, after = page_args()
     try:
-        # Realiza la consulta para obtener todas las naves estelares
-        users = User.query.all()
+        # Realiza la consulta para obtener una pagina de usuarios ya serializados
+        users_list, next_url = paginate_serialized(User, fields, limit, after)
 
-        if not users:
+        if not users_list and after is None:
             return jsonify({"message": "No users found"}), 404
-        
-        # Serializa los resultados de la consulta
-        users_list = [user.serialize() for user in users]
 
-        # Retorna la lista serializada de naves estelares
-        return jsonify(users_list), 200
+        # Retorna la lista serializada de usuarios
+        return with_next_link(jsonify(users_list), next_url), 200
     except Exception as error:
         print(error)
         return jsonify({"message": "Error fetching users from the database"}), 500
 
 #[GET] /users/favorites Get all the favorites that belong to the current user.
-@app.route("/users/<int:user_id>/favorites", methods=["GET"])
+#?expand=1 embeds the planet/character/starship of each favorite, always in 2 queries
+@api.route("/users/<int:user_id>/favorites", methods=["GET"])
+@read_only
+@query_budget(2)
 def get_users_favorites(user_id):
     try:
         # Obtén el ID del usuario actual (por ejemplo, desde un token de autenticación)
@@ -196,12 +322,26 @@ def get_users_favorites(user_id):
         if not user_id:
             return jsonify({"message": "User ID is missing"}), 400
         
-        user = User.query.get(user_id)
+        expand = request.args.get("expand", "").lower() in ("1", "true", "yes")
+        if expand:
+            # one query for the user, one for the favorites joined with their targets
+            user = User.query.options(
+                selectinload(User.favorites).options(
+                    joinedload(Favorite.planet),
+                    joinedload(Favorite.character),
+                    joinedload(Favorite.starship),
+                )
+            ).filter_by(id=user_id).one_or_none()
+        else:
+            user = User.query.get(user_id)
 
         if user is None:
             return jsonify({"message": "user has not favorites"}), 404
         
-        favorites_data =[favorite.serialize() for favorite in user.favorites]
+        if expand:
+            favorites_data = [favorite.serialize_expanded() for favorite in user.favorites]
+        else:
+            favorites_data =[favorite.serialize() for favorite in user.favorites]
 
         if not favorites_data:
             return jsonify({"message": "User has no favorites"}), 404
@@ -210,82 +350,112 @@ def get_users_favorites(user_id):
     
     except Exception as error:
         print(error)
-        return jsonify({"message": "Error fetching starship from the database"})
+        return jsonify({"message": "Error fetching favorites from the database"}), 500
 
 #[POST] /favorite/planet/<int:planet_id> Add a new favorite planet to the current user with the planet id = planet_id.
-@app.route("/favorites/user/<int:user_id>/planet/<int:planet_id>", methods=["POST"])
+@api.route("/favorites/user/<int:user_id>/planet/<int:planet_id>", methods=["POST"])
+@query_budget(4)
 def add_favorite_planet_to_user(planet_id, user_id):
     #Verifying we are receiving all required data in the request
     if not user_id:
         return jsonify({"message": "User ID is required"}), 400
     
-    #Check if the planet is already a favorite
-    existing_favorite = Favorite.query.filter_by(user_id=user_id, planet_id=planet_id).first()
-    if existing_favorite:
-        return jsonify({"message": "Planet already a favorite"}), 400 
-    
-    #Add a new favorite
-    new_favorite = Favorite(user_id= user_id, planet_id= planet_id)
+    #Add a new favorite, the unique index tells us if the planet was already a favorite
     try:
-        db.session.add(new_favorite)
+        added = add_favorite(user_id, "planet", planet_id)
         db.session.commit()
+    except IntegrityError as error:
+        #foreign key violation, the user or the planet does not exist
+        print(error)
+        db.session.rollback()
+        return jsonify({"message": "User or planet not found"}), 404
     except Exception as error:
         print(error)
         db.session.rollback()
         return jsonify({"message":"Error in server"}), 500
+    if not added:
+        return jsonify({"message": "Planet already a favorite"}), 400 
     return jsonify({"massage": "Planet added to favorites"}), 201
 
 
 #[POST] /favorite/people/<int:people_id> Add new favorite people to the current user with the people id = people_id.
-@app.route("/favorites/user/<int:user_id>/people/<int:people_id>", methods=["POST"])
+@api.route("/favorites/user/<int:user_id>/people/<int:people_id>", methods=["POST"])
+@query_budget(4)
 def add_favorite_character_to_user(people_id, user_id):
-    
     #Verifying we are receiving all required data in the request
     if not user_id:
         return jsonify({"message": "User ID is required"}), 400
     
-    #Check if the people is already a favorite
-    existing_favorite = Favorite.query.filter_by(user_id=user_id, character_id=people_id).first()
-    if existing_favorite:
-        return jsonify({"message": "Character already a favorite"}), 400 
-    
-    #Add a new favorite
-    new_favorite = Favorite(user_id= user_id, character_id= people_id)
+    #Add a new favorite, the unique index tells us if the character was already a favorite
     try:
-        db.session.add(new_favorite)
+        added = add_favorite(user_id, "people", people_id)
         db.session.commit()
+    except IntegrityError as error:
+        #foreign key violation, the user or the character does not exist
+        print(error)
+        db.session.rollback()
+        return jsonify({"message": "User or character not found"}), 404
     except Exception as error:
         print(error)
         db.session.rollback()
         return jsonify({"message":"Error in server"}), 500
+    if not added:
+        return jsonify({"message": "Character already a favorite"}), 400 
     return jsonify({"massage": "Character added to favorites"}), 201
 
 #[POST] /favorite/starship/<int:starship_id> Add new favorite starship to the current user with the starship id = starship_id.
-@app.route("/favorites/user/<int:user_id>/starship/<int:starship_id>", methods=["POST"])
+@api.route("/favorites/user/<int:user_id>/starship/<int:starship_id>", methods=["POST"])
+@query_budget(4)
 def add_favorite_starship_to_user(starship_id, user_id):
     #Verifying we are receiving all required data in the request
     if not user_id:
         return jsonify({"message": "User ID is required"}), 400
     
-    #Check if the starship is already a favorite
-    existing_favorite = Favorite.query.filter_by(user_id=user_id, starship_id=starship_id).first()
-    if existing_favorite:
-        return jsonify({"message": "Starship already a favorite"}), 400 
-    
-    #Add a new favorite
-    new_favorite = Favorite(user_id= user_id, starship_id= starship_id)
+    #Add a new favorite, the unique index tells us if the starship was already a favorite
     try:
-        db.session.add(new_favorite)
+        added = add_favorite(user_id, "starship", starship_id)
         db.session.commit()
+    except IntegrityError as error:
+        #foreign key violation, the user or the starship does not exist
+        print(error)
+        db.session.rollback()
+        return jsonify({"message": "User or starship not found"}), 404
     except Exception as error:
         print(error)
         db.session.rollback()
         return jsonify({"message":"Error in server"}), 500
+    if not added:
+        return jsonify({"message": "Starship already a favorite"}), 400 
     return jsonify({"massage": "Starship added to favorites"}), 201
 
 
+#[POST] /favorites/user/<int:user_id>/batch Add and remove many favorites of the user in one transaction.
+#body: {"add": [{"kind": "planet", "id": 1}], "remove": [{"kind": "people", "id": 2}]}, kind is planet, people or starship
+@api.route("/favorites/user/<int:user_id>/batch", methods=["POST"])
+def batch_favorites_of_user(user_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"message": "A JSON object with add and/or remove lists is required"}), 400
+
+    if db.session.get(User, user_id) is None:
+        return jsonify({"message": "User not found"}), 404
+
+    try:
+        results = apply_favorite_batch(user_id, data)
+        db.session.commit()
+    except APIException:
+        #validation errors are raised before anything is written
+        db.session.rollback()
+        raise
+    except Exception as error:
+        print(error)
+        db.session.rollback()
+        return jsonify({"message":"Error in server"}), 500
+    return jsonify({"results": results}), 200
+
+
 #[DELETE] /favorite/planet/<int:planet_id> Delete a favorite planet with the id = planet_id.
-@app.route("/favorite/planet/<int:planet_id>", methods=["DELETE"])
+@api.route("/favorite/planet/<int:planet_id>", methods=["DELETE"])
 def delete_favorite_planet(planet_id):
     try:
         # Obtén el ID del usuario actual (por ejemplo, desde un token de autenticación)
@@ -294,23 +464,21 @@ def delete_favorite_planet(planet_id):
         if not user_id:
             return jsonify({"message": "User ID is required"}), 400
         
-        # Busca el registro de favorito correspondiente al usuario y al planeta
-        favorite = Favorite.query.filter_by(user_id=user_id, planet_id=planet_id).first()
+        # Elimina el registro de favorito con un solo DELETE (usa el indice user_id, planet_id)
+        deleted = remove_favorite(user_id, "planet", planet_id)
+        db.session.commit()
 
-        if not favorite:
+        if not deleted:
             return jsonify({"message": "Favorite planet not found"}), 404
-        
-        # Elimina el registro de favorito
-        db.session.delete(favorite)
-        db.session.commit()
 
         return jsonify({"message": "Favorite planet deleted successfully"}), 200
     except Exception as error:
         print(error)
+        db.session.rollback()
         return jsonify({"message": "Error deleting favorite planet from the database"}), 500
 
 #[DELETE] /favorite/people/<int:people_id> Delete a favorite people with the id = people_id.
-@app.route("/favorites/people/<int:people_id>", methods=["DELETE"])
+@api.route("/favorites/people/<int:people_id>", methods=["DELETE"])
 def delete_favorite_caracter(people_id):
      try:
         # Obtén el ID del usuario actual (por ejemplo, desde un token de autenticación)
@@ -319,23 +487,21 @@ def delete_favorite_caracter(people_id):
         if not user_id:
             return jsonify({"message": "User ID is required"}), 400
         
-        # Busca el registro de favorito correspondiente al usuario y al character
-        favorite = Favorite.query.filter_by(user_id=user_id, people_id=people_id).first()
+        # Elimina el registro de favorito con un solo DELETE (usa el indice user_id, character_id)
+        deleted = remove_favorite(user_id, "people", people_id)
+        db.session.commit()
 
-        if not favorite:
+        if not deleted:
             return jsonify({"message": "Favorite people not found"}), 404
-        
-        # Elimina el registro de favorito
-        db.session.delete(favorite)
-        db.session.commit()
 
         return jsonify({"message": "Favorite people deleted successfully"}), 200
      except Exception as error:
         print(error)
+        db.session.rollback()
         return jsonify({"message": "Error deleting favorite planet from the database"}), 500
 
 #[DELETE] /favorite/starship/<int:starship_id> Delete a favorite starship with the id = starship_id.
-@app.route("/favorites/starship/<int:starship_id>", methods=["DELETE"])
+@api.route("/favorites/starship/<int:starship_id>", methods=["DELETE"])
 def delete_favorite_starship(starship_id):
      try:
         # Obtén el ID del usuario actual (por ejemplo, desde un token de autenticación)
@@ -344,26 +510,24 @@ def delete_favorite_starship(starship_id):
         if not user_id:
             return jsonify({"message": "User ID is required"}), 400
         
-        # Busca el registro de favorito correspondiente al usuario y al character
-        favorite = Favorite.query.filter_by(user_id=user_id, starship_id=starship_id).first()
+        # Elimina el registro de favorito con un solo DELETE (usa el indice user_id, starship_id)
+        deleted = remove_favorite(user_id, "starship", starship_id)
+        db.session.commit()
 
-        if not favorite:
+        if not deleted:
             return jsonify({"message": "Favorite starship not found"}), 404
-        
-        # Elimina el registro de favorito
-        db.session.delete(favorite)
-        db.session.commit()
 
         return jsonify({"message": "Favorite starship deleted successfully"}), 200
      except Exception as error:
         print(error)
+        db.session.rollback()
         return jsonify({"message": "Error deleting favorite planet from the database"}), 500
     
 
 ###Additionally, create the following endpoints to allow users comment elements:
 
 #[POST] /comment/planet/<int:planet_id> Add a new comment planet to the current user with the planet id = planet_id.
-@app.route("/comment/planet/<int:planet_id>", methods=["POST"])
+@api.route("/comment/planet/<int:planet_id>", methods=["POST"])
 def add_comment_in_planet(planet_id):
     #Extract data from request
     user_id= request.json.get("user_id")
@@ -372,9 +536,25 @@ def add_comment_in_planet(planet_id):
     #Verifying we are receiving all required data in the request
     if not user_id or not comment_text:
         return jsonify({"message": "User ID and comment text are required"}), 400
+    #the values the database would refuse never reach the write-behind queue
+    try:
+        user_id, comment_text = comment_values(user_id, comment_text)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
     
+    #write-behind mode: queued, then written together with the other comments of the batch
+    if comment_queue.enabled:
+        try:
+            queued = comment_queue.submit(user_id=user_id, planet_id=planet_id, comment_text=comment_text)
+        except Exception as error:
+            print(error)
+            return jsonify({"message":"Error in server"}), 500
+        if not queued:
+            return refuse(503, "Too many comments waiting, try again later", SHED_RETRY_AFTER)
+        return jsonify({"message": "Comment accepted"}), 202
+
     #Add a comment
-    new_comment = Comment(user_id= user_id, planet_id= planet_id, comment_text=comment_text, is_active=True)
+    new_comment = Comment(user_id= user_id, planet_id= planet_id, comment_text=comment_text)
     try:
         db.session.add(new_comment)
         db.session.commit()
@@ -386,7 +566,7 @@ def add_comment_in_planet(planet_id):
 
 
 #[POST] /comment/people/<int:people_id> Add new comment people to the current user with the people id = people_id.
-@app.route("/comments/people/>int:people_id>", methods=["POST"])
+@api.route("/comment/people/<int:people_id>", methods=["POST"])
 def add_comment_in_character(people_id):
     #Extract data from request
     user_id= request.json.get("user_id")
@@ -395,9 +575,25 @@ def add_comment_in_character(people_id):
     #Verifying we are receiving all required data in the request
     if not user_id or not comment_text:
         return jsonify({"message": "User ID and comment text are required"}), 400
+    #the values the database would refuse never reach the write-behind queue
+    try:
+        user_id, comment_text = comment_values(user_id, comment_text)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
     
+    #write-behind mode: queued, then written together with the other comments of the batch
+    if comment_queue.enabled:
+        try:
+            queued = comment_queue.submit(user_id=user_id, character_id=people_id, comment_text=comment_text)
+        except Exception as error:
+            print(error)
+            return jsonify({"message":"Error in server"}), 500
+        if not queued:
+            return refuse(503, "Too many comments waiting, try again later", SHED_RETRY_AFTER)
+        return jsonify({"message": "Comment accepted"}), 202
+
     #Add a comment
-    new_comment = Comment(user_id= user_id, people_id= people_id, comment_text=comment_text, is_active=True)
+    new_comment = Comment(user_id= user_id, character_id= people_id, comment_text=comment_text)
     try:
         db.session.add(new_comment)
         db.session.commit()
@@ -408,7 +604,7 @@ def add_comment_in_character(people_id):
     return jsonify({"massage": "Comment added to character"}), 201
 
 #[POST] /comment/starship/<int:starship_id> Add new comment starship to the current user with the starship id = starship_id.
-@app.route("/comments/starship/>int:starship_id>", methods=["POST"])
+@api.route("/comment/starship/<int:starship_id>", methods=["POST"])
 def add_comment_in_starship(starship_id):
     #Extract data from request
     user_id= request.json.get("user_id")
@@ -417,9 +613,25 @@ def add_comment_in_starship(starship_id):
     #Verifying we are receiving all required data in the request
     if not user_id or not comment_text:
         return jsonify({"message": "User ID and comment text are required"}), 400
+    #the values the database would refuse never reach the write-behind queue
+    try:
+        user_id, comment_text = comment_values(user_id, comment_text)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
     
+    #write-behind mode: queued, then written together with the other comments of the batch
+    if comment_queue.enabled:
+        try:
+            queued = comment_queue.submit(user_id=user_id, starship_id=starship_id, comment_text=comment_text)
+        except Exception as error:
+            print(error)
+            return jsonify({"message":"Error in server"}), 500
+        if not queued:
+            return refuse(503, "Too many comments waiting, try again later", SHED_RETRY_AFTER)
+        return jsonify({"message": "Comment accepted"}), 202
+
     #Add a comment
-    new_comment = Comment(user_id= user_id, starship_id= starship_id, comment_text=comment_text, is_active=True)
+    new_comment = Comment(user_id= user_id, starship_id= starship_id, comment_text=comment_text)
     try:
         db.session.add(new_comment)
         db.session.commit()
@@ -429,8 +641,164 @@ def add_comment_in_starship(starship_id):
         return jsonify({"message":"Error in server"}), 500
     return jsonify({"massage": "Comment added to starship"}), 201
 
+
+#[GET] /people/<int:id>/comments, /planets/<int:id>/comments, /starships/<int:id>/comments The comments of one item, newest first.
+#?limit= and ?after= page through them, next page on the Link header
+@api.route("/<any(people, planets, starships):kind>/<int:item_id>/comments", methods=["GET"])
+@read_only
+@query_budget(2)
+def get_item_comments(kind, item_id):
+    model = CATALOG[kind]
+    fields = fields_arg(Comment)
+    limit, after = newest_first_args()
+    try:
+        #the item itself usually comes from the identity cache
+        if entity_cache.get_or_load(model, item_id) is None:
+            return jsonify({"message": "Item not found"}), 404
+        column = getattr(Comment, model.__tablename__ + "_id")
+        comments_list, next_url = paginate_newest(Comment, column == item_id, fields, limit, after)
+        return with_next_link(jsonify(comments_list), next_url), 200
+    except Exception as error:
+        print(error)
+        return jsonify({"message": "Error fetching comments from the database"}), 500
+
+
+#[GET] /users/<int:user_id>/comments The comments written by the user, newest first, paginated like the item comments.
+@api.route("/users/<int:user_id>/comments", methods=["GET"])
+@read_only
+@query_budget(2)
+def get_user_comments(user_id):
+    fields = fields_arg(Comment)
+    limit, after = newest_first_args()
+    try:
+        if db.session.get(User, user_id) is None:
+            return jsonify({"message": "User not found"}), 404
+        comments_list, next_url = paginate_newest(Comment, Comment.user_id == user_id, fields, limit, after)
+        return with_next_link(jsonify(comments_list), next_url), 200
+    except Exception as error:
+        print(error)
+        return jsonify({"message": "Error fetching comments from the database"}), 500
+
 ###+4 Create also endpoints to add (POST), update (PUT), and delete (DELETE) character, planet and starship. That way all the database information can be managed using the API instead of having to rely on the Flask admin to create the planets and people.
 
+#[POST] /people, /planets, /starships Create one item (JSON object) or load many (JSON array, or NDJSON with Content-Type: application/x-ndjson).
+#bulk loads are written in batches of ?batch_size= rows, one transaction per batch, and answer with a report of the failed batches/items
+@api.route("/<any(people, planets, starships):kind>", methods=["POST"])
+def create_catalog_items(kind):
+    model = CATALOG[kind]
+    batch_size = batch_size_arg()
+    items, single = request_items()
+
+    if not single:
+        report = ingest(model, items, batch_size)
+        return jsonify(report), 201 if not report["failed"] else 207
+
+    try:
+        row = to_row(model, items)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    new_item = model(**row)
+    try:
+        db.session.add(new_item)
+        db.session.commit()
+        if "id" in row:
+            sync_id_sequence(model)
+    except Exception as error:
+        print(error)
+        db.session.rollback()
+        return jsonify({"message":"Error in server"}), 500
+    return jsonify(new_item.serialize()), 201
+
+
+#[PUT] /people, /planets, /starships Create or replace many items by id (JSON array or NDJSON), same batching and report as POST.
+@api.route("/<any(people, planets, starships):kind>", methods=["PUT"])
+def upsert_catalog_items(kind):
+    model = CATALOG[kind]
+    batch_size = batch_size_arg()
+    items, single = request_items()
+    if single:
+        items = [(0, items)]
+
+    report = ingest(model, items, batch_size, upsert=True)
+    return jsonify(report), 200 if not report["failed"] else 207
+
+
+#[PUT] /people/<int:id>, /planets/<int:id>, /starships/<int:id> Update the fields sent in the body.
+@api.route("/<any(people, planets, starships):kind>/<int:item_id>", methods=["PUT"])
+def update_catalog_item(kind, item_id):
+    model = CATALOG[kind]
+    data = request.get_json(silent=True)
+    try:
+        row = to_row(model, data)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    if row.pop("id", item_id) != item_id:
+        return jsonify({"message": "id can not be changed"}), 400
+
+    try:
+        item = db.session.get(model, item_id)
+        if item is None:
+            return jsonify({"message": "Item not found"}), 404
+        for key, value in row.items():
+            setattr(item, key, value)
+        db.session.commit()
+    except Exception as error:
+        print(error)
+        db.session.rollback()
+        return jsonify({"message":"Error in server"}), 500
+    return jsonify(item.serialize()), 200
+
+
+#[DELETE] /people/<int:id>, /planets/<int:id>, /starships/<int:id> Delete the item with its favorites and comments.
+@api.route("/<any(people, planets, starships):kind>/<int:item_id>", methods=["DELETE"])
+def delete_catalog_item(kind, item_id):
+    model = CATALOG[kind]
+    try:
+        item = db.session.get(model, item_id)
+        if item is None:
+            return jsonify({"message": "Item not found"}), 404
+        delete_with_dependents(model, item)
+        db.session.commit()
+    except Exception as error:
+        print(error)
+        db.session.rollback()
+        return jsonify({"message":"Error in server"}), 500
+    return jsonify({"message": "Item deleted successfully"}), 200
+
+
+#[GET] /search?q=sky walker&type=people,starships Ranked full-text search over names, climates, models and comments.
+#every word matches as a prefix, best matches first, next page on the Link header
+@api.route("/search", methods=["GET"])
+@read_only
+def search_everything():
+    query = request.args.get("q", "")
+    kinds = kinds_arg(request.args.get("type"))
+    limit, after = page_args()
+    try:
+        results, cursor = search(query, kinds, after, limit)
+    except APIException:
+        raise
+    except Exception as error:
+        print(error)
+        return jsonify({"message": "Error searching the database"}), 500
+    next_url = next_link(encode_cursor(cursor)) if cursor is not None else None
+    return with_next_link(jsonify(results), next_url), 200
+
+
+#[GET] /top/people, /top/planets, /top/starships?by=favorites|comments&limit=10 The most favorited (or commented) items with their counters.
+#served from the counters that the favorite and comment writes keep up to date, never from a COUNT(*)
+@api.route("/top/<any(people, planets, starships):kind>", methods=["GET"])
+@cached_response("top")
+@read_only
+@query_budget(1)
+def get_top_items(kind):
+    by, limit = top_args()
+    try:
+        return jsonify(top(CATALOG[kind], by, limit)), 200
+    except Exception as error:
+        print(error)
+        return jsonify({"message": "Error fetching the top items from the database"}), 500
+
 
 # new_user = User(email="john.doe@example.com", password="password123", is_active=True)
 # db.session.add(new_user)
@@ -440,5 +808,5 @@ def add_comment_in_starship(starship_id):
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
 
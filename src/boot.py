@@ -0,0 +1,74 @@
+"""
+Cold start measurement: how long a fresh interpreter takes to import the app and build it.
+
+    flask boot-time --runs 5              # what a gunicorn worker does (src/wsgi.py)
+    flask boot-time --entry cli --top 20  # what every `flask ...` command does
+
+Each run is a new python process, nothing is shared with the process running the command.
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+import click
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+# imports the app module, then builds the app the way the entry point does, prints the timings in ms
+PROBE = """
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+%s
+built = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "create_ms": (built - imported) * 1000}))
+"""
+ENTRIES = {
+    "wsgi": "import wsgi",
+    "cli": "create_app()",
+}
+
+
+def _probe(entry, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", PROBE % ENTRIES[entry]]
+    result = subprocess.run(command, cwd=SRC, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise click.ClickException(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "probe failed")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, result.stderr
+
+
+def slowest_imports(importtime_log, top):
+    """(cumulative ms, module) of the slowest imports of a `python -X importtime` log"""
+    found = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        found.append((int(cumulative) / 1000.0, name.rstrip()))
+    found.sort(reverse=True)
+    return found[:top]
+
+
+def measure(entry, runs):
+    timings = [_probe(entry)[0] for _ in range(runs)]
+    return {key: statistics.median(timing[key] for timing in timings) for key in ("import_ms", "create_ms")}
+
+
+@click.command("boot-time")
+@click.option("--entry", type=click.Choice(sorted(ENTRIES)), default="wsgi", show_default=True,
+              help="wsgi: a web worker, cli: a flask command")
+@click.option("--runs", type=int, default=5, show_default=True, help="fresh processes, the median is reported")
+@click.option("--top", type=int, default=15, show_default=True, help="slowest imports to list")
+def boot_time_command(entry, runs, top):
+    """Measure the import and create_app time of a cold worker and list the slowest imports"""
+    median = measure(entry, max(runs, 1))
+    click.echo("%s, median of %d runs: import %.1f ms, create_app %.1f ms, total %.1f ms" % (
+        entry, max(runs, 1), median["import_ms"], median["create_ms"], median["import_ms"] + median["create_ms"]))
+    if top > 0:
+        # one more run under -X importtime, that slows the imports down a little
+        _, log = _probe(entry, importtime=True)
+        click.echo("slowest imports (cumulative ms, with -X importtime):")
+        for cumulative, name in slowest_imports(log, top):
+            click.echo("%9.1f  %s" % (cumulative, name))
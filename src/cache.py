@@ -0,0 +1,331 @@
+"""
+Caches for the read mostly catalog endpoints (people, planets and starships)
+"""
+import os
+import hashlib
+import tempfile
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, request, make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from models import db, Character, Planet, Starship
+from streaming import wants_stream
+from json_provider import RawJSON
+from routing import maybe_lagging
+from compression import COMPRESS_MIN_SIZE, COMPRESSIBLE_MIMETYPES, negotiate, compress, set_encoding
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", 1024))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", 60))
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "starwars-api-cache"))
+
+# every cached model invalidates its own namespace
+MODEL_NAMESPACES = {
+    Character: "people",
+    Planet: "planets",
+    Starship: "starships",
+}
+
+
+class NamespaceVersions:
+    """Version stamps shared by all the gunicorn workers of the host through one small file per namespace"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, namespace):
+        return os.path.join(self.directory, namespace + ".version")
+
+    def current(self, namespace):
+        try:
+            stat = os.stat(self._path(namespace))
+        except FileNotFoundError:
+            return (0, 0)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def bump(self, namespace):
+        path = self._path(namespace)
+        # appending one byte changes both size and mtime, start over once the file gets big
+        mode = "wb" if self.current(namespace)[0] > 1024 * 1024 else "ab"
+        with open(path, mode) as version_file:
+            version_file.write(b".")
+
+
+class CachedResponse:
+
+    def __init__(self, body, mimetype, headers, version):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers
+        self.version = version
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        # Content-Encoding -> compressed body, made by the first request that accepts it
+        self.variants = {}
+
+    @classmethod
+    def from_response(cls, response, version):
+        headers = {}
+        if "Link" in response.headers:
+            headers["Link"] = response.headers["Link"]
+        return cls(response.get_data(), response.mimetype, headers, version)
+
+    def variant(self, coding):
+        body = self.variants.get(coding)
+        if body is None:
+            # concurrent first requests may both compress, they store the same bytes
+            body = self.variants[coding] = compress(self.body, coding)
+        return body
+
+    def to_response(self):
+        coding = None
+        if self.mimetype in COMPRESSIBLE_MIMETYPES and len(self.body) >= COMPRESS_MIN_SIZE:
+            coding = negotiate()
+        body = self.variant(coding) if coding is not None else self.body
+        response = Response(body, status=200, mimetype=self.mimetype, headers=self.headers)
+        response.set_etag(self.etag)
+        if coding is not None:
+            set_encoding(response, coding)
+        response.vary.add("Accept-Encoding")
+        # clients may keep the body but always have to revalidate it with If-None-Match
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
+
+
+class ResponseCache:
+    """Bounded LRU of serialized response bodies, keyed by namespace and request path"""
+
+    def __init__(self, max_entries, versions):
+        self.max_entries = max_entries
+        self.versions = versions
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, namespace, key):
+        version = self.versions.current(namespace)
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is None:
+                return None
+            if entry.version != version:
+                # another worker (or this one) wrote to the namespace since the entry was stored
+                del self.entries[(namespace, key)]
+                return None
+            self.entries.move_to_end((namespace, key))
+            return entry
+
+    def set(self, namespace, key, entry):
+        with self.lock:
+            self.entries[(namespace, key)] = entry
+            self.entries.move_to_end((namespace, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, namespace):
+        self.versions.bump(namespace)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == namespace]:
+                del self.entries[key]
+
+
+class _Flight:
+    # one database load shared by every request that missed the same key at the same time
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.invalidated = False
+
+
+class EntityCache:
+    """LRU + TTL cache of serialized objects by id, concurrent misses on one id share a single query"""
+
+    def __init__(self, max_entries, ttl, versions):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.versions = versions
+        self.entries = OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_or_load(self, model, entity_id, loader=None):
+        key = (model, entity_id)
+        version = self.versions.current(MODEL_NAMESPACES[model])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, entry_version, data, fragment = entry
+                if expires_at > time.monotonic() and entry_version == version:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return data
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = (loader or load_serialized)(model, entity_id)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                # missing rows are not cached, and a write during the load makes the value stale
+                if flight.error is None and flight.value is not None and not flight.invalidated \
+                        and not maybe_lagging(version[1]):
+                    # the last slot keeps the encoded JSON once a list response asked for it
+                    self.entries[key] = [time.monotonic() + self.ttl, version, flight.value, None]
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                        self.evictions += 1
+            flight.done.set()
+        return flight.value
+
+    def with_fragments(self, model, items, encode):
+        """Swap the serialized items that match a fresh cached entry for its pre-encoded JSON"""
+        version = self.versions.current(MODEL_NAMESPACES[model])
+        now = time.monotonic()
+        swapped = []
+        with self.lock:
+            for item in items:
+                entry = self.entries.get((model, item.get("id")))
+                if entry is None or entry[0] <= now or entry[1] != version or entry[2] != item:
+                    swapped.append(item)
+                    continue
+                if entry[3] is None:
+                    entry[3] = RawJSON(encode(entry[2]))
+                swapped.append(entry[3])
+        return swapped
+
+    def invalidate(self, model, entity_id):
+        key = (model, entity_id)
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+            flight = self.flights.get(key)
+            if flight is not None:
+                flight.invalidated = True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def entity_cache_metrics():
+    # counters for /metrics, gauge_ keys are exported as gauges
+    stats = entity_cache.stats()
+    return {
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "coalesced": stats["coalesced"],
+        "evictions": stats["evictions"],
+        "expirations": stats["expirations"],
+        "invalidations": stats["invalidations"],
+        "gauge_entries": stats["size"],
+    }
+
+
+def load_serialized(model, entity_id):
+    entity = db.session.get(model, entity_id)
+    return entity.serialize() if entity is not None else None
+
+
+namespace_versions = NamespaceVersions(CACHE_DIR)
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, namespace_versions)
+entity_cache = EntityCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL, namespace_versions)
+
+
+def cached_response(namespace):
+    """Serve the view from the response cache, answering If-None-Match with 304"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if wants_stream():
+                return view(*args, **kwargs)
+
+            key = request.full_path
+            entry = response_cache.get(namespace, key)
+            if entry is None:
+                # read the version before the query, a write that lands meanwhile makes the entry stale
+                version = namespace_versions.current(namespace)
+                response = make_response(view(*args, **kwargs))
+                # only successful bodies are kept, the handlers answer their errors with a 4xx/5xx status
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = CachedResponse.from_response(response, version)
+                if not maybe_lagging(version[1]):
+                    response_cache.set(namespace, key, entry)
+            return entry.to_response()
+        return wrapper
+    return decorator
+
+
+def invalidate_model(model):
+    # used by the bulk write paths, Core statements do not fire the mapper events below
+    namespace = MODEL_NAMESPACES.get(model)
+    if namespace is not None:
+        response_cache.invalidate(namespace)
+
+
+def _invalidate(model, entity_id):
+    response_cache.invalidate(MODEL_NAMESPACES[model])
+    entity_cache.invalidate(model, entity_id)
+
+
+def _invalidate_target(mapper, connection, target):
+    _invalidate(mapper.class_, target.id)
+    # invalidate again on commit, a reader could have cached the old rows between flush and commit
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("invalidate_targets", set()).add((mapper.class_, target.id))
+
+
+def _invalidate_on_commit(session):
+    for model, entity_id in session.info.pop("invalidate_targets", ()):
+        _invalidate(model, entity_id)
+
+
+def _forget_on_rollback(session):
+    session.info.pop("invalidate_targets", None)
+
+
+# writes from the API handlers and from the Flask-Admin views go through the same mapper events
+for cached_model in MODEL_NAMESPACES:
+    event.listen(cached_model, "after_insert", _invalidate_target)
+    event.listen(cached_model, "after_update", _invalidate_target)
+    event.listen(cached_model, "after_delete", _invalidate_target)
+event.listen(Session, "after_commit", _invalidate_on_commit)
+event.listen(Session, "after_rollback", _forget_on_rollback)
@@ -0,0 +1,353 @@
+"""
+Write-behind mode of the comment handlers (COMMENTS_WRITE_BEHIND=1).
+
+The handlers answer 202 as soon as the comment is in a bounded in-process queue. A background thread
+writes the queue in multi-row INSERTs, one transaction per batch of COMMENTS_BATCH_SIZE rows or every
+COMMENTS_FLUSH_MS, and keeps the popularity counters and the search index in the same transaction.
+When the queue is full the handlers wait COMMENTS_QUEUE_TIMEOUT for room, then answer 503.
+
+With COMMENTS_JOURNAL_DIR every accepted comment is first appended to a journal file of the worker
+(held with flock while the worker lives). A worker that starts replays the journals of dead workers,
+`flask comments-replay` does it by hand. Delivery is at least once: a crash between the commit of a
+batch and its journal mark writes that batch twice.
+"""
+import os
+import json
+import time
+import fcntl
+import atexit
+import threading
+from collections import deque
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, insert, func
+from sqlalchemy.exc import IntegrityError, DataError, StatementError, DBAPIError
+from models import db, Comment
+from popularity import TARGET_COLUMNS, TOP_NAMESPACE, count_changes
+from search import reindex, change_log
+from cache import response_cache
+
+COMMENTS_WRITE_BEHIND = os.getenv("COMMENTS_WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+COMMENTS_QUEUE_SIZE = int(os.getenv("COMMENTS_QUEUE_SIZE", 10000))
+COMMENTS_BATCH_SIZE = int(os.getenv("COMMENTS_BATCH_SIZE", 500))
+COMMENTS_FLUSH_MS = float(os.getenv("COMMENTS_FLUSH_MS", 200))
+# seconds a handler waits for room in a full queue before answering 503
+COMMENTS_QUEUE_TIMEOUT = float(os.getenv("COMMENTS_QUEUE_TIMEOUT", 0.5))
+# seconds a stopping worker keeps writing what is left in the queue
+COMMENTS_DRAIN_SECONDS = float(os.getenv("COMMENTS_DRAIN_SECONDS", 10))
+COMMENTS_JOURNAL_DIR = os.getenv("COMMENTS_JOURNAL_DIR", "")
+# fsync every append: survives a machine crash too, not just a worker crash
+COMMENTS_JOURNAL_FSYNC = os.getenv("COMMENTS_JOURNAL_FSYNC", "0").lower() in ("1", "true", "yes")
+COLUMNS = ("user_id", "character_id", "planet_id", "starship_id", "comment_text", "created_at")
+COMMENT_TEXT_MAX = Comment.__table__.c.comment_text.type.length
+
+comments = Comment.__table__
+
+
+########## WRITES ##########
+
+def comment_values(user_id, comment_text):
+    """(user_id as int, comment_text) of the request body, raises ValueError when the database would refuse them"""
+    if isinstance(user_id, str) and user_id.isdigit():
+        user_id = int(user_id)
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise ValueError("user_id must be an integer")
+    if not isinstance(comment_text, str) or len(comment_text) > COMMENT_TEXT_MAX:
+        raise ValueError("comment_text must be a text of at most %d characters" % COMMENT_TEXT_MAX)
+    return user_id, comment_text
+
+
+def _row(values):
+    # executemany needs the same keys in every row
+    row = {name: values.get(name) for name in COLUMNS}
+    if row["created_at"] is None:
+        row["created_at"] = datetime.utcnow()
+    return row
+
+
+def write_comments(connection, rows):
+    """Insert the rows in one multi-row statement, with their counters and search documents.
+
+    Returns the search changes to log again once the transaction is committed.
+    """
+    last_id = connection.execute(select(func.max(comments.c.id))).scalar() or 0
+    connection.execute(insert(comments), rows)
+    for model, key in TARGET_COLUMNS.items():
+        changes = {}
+        for row in rows:
+            if row[key] is not None:
+                changes[row[key]] = changes.get(row[key], 0) + 1
+        count_changes(connection, model, {target_id: (0, count) for target_id, count in changes.items()})
+    # every new comment has an id above the ones that existed before the insert
+    return reindex(connection, Comment, comments.c.id > last_id)
+
+
+def _refused(error):
+    # the database refused the values (constraint, type, length) or they could not be bound: a retry never helps,
+    # the other DBAPI errors (connection lost, lock timeout...) are retried
+    return isinstance(error, (IntegrityError, DataError)) or not isinstance(error, DBAPIError)
+
+
+def write_batch(engine, rows):
+    """Write the rows, one by one when the batch has refused values. Returns the rows that were dropped."""
+    try:
+        with engine.begin() as connection:
+            changes = write_comments(connection, rows)
+        # what the session events do on commit for the ORM writes
+        response_cache.invalidate(TOP_NAMESPACE)
+        change_log.append(changes)
+        return []
+    except StatementError as error:
+        if not _refused(error):
+            raise
+        if len(rows) == 1:
+            print(error)
+            return rows
+    # one bad row (missing user or item, value out of range) fails the whole statement, keep the good rows
+    dropped = []
+    for row in rows:
+        dropped += write_batch(engine, [row])
+    return dropped
+
+
+########## JOURNAL ##########
+
+class Journal:
+    """Append-only file of the accepted comments of one worker, with marks for the written ones"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.done = 0
+        os.makedirs(directory, exist_ok=True)
+        # locked under a temporary name, the other workers only replay the files they can lock
+        temporary = os.path.join(directory, ".comments-%d.tmp" % os.getpid())
+        self.file = open(temporary, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.path = os.path.join(directory, "comments-%d.journal" % os.getpid())
+        os.replace(temporary, self.path)
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if COMMENTS_JOURNAL_FSYNC:
+            os.fsync(self.file.fileno())
+
+    def append(self, row):
+        with self.lock:
+            self.seq += 1
+            self._write({"seq": self.seq, "row": dict(row, created_at=row["created_at"].isoformat())})
+            return self.seq
+
+    def mark_done(self, seq):
+        with self.lock:
+            self.done = max(self.done, seq)
+            if self.done == self.seq:
+                # everything is in the database, start the file over
+                self.file.truncate(0)
+            else:
+                self._write({"done": self.done})
+
+    def close(self):
+        if self.done == self.seq:
+            # nothing left to replay
+            os.unlink(self.path)
+        self.file.close()
+
+
+def pending_rows(path):
+    """The rows of a journal file that were accepted but not marked as written"""
+    rows, done = {}, 0
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of a crashed worker can be cut short
+                continue
+            if "done" in record:
+                done = max(done, record["done"])
+            else:
+                row = record["row"]
+                row["created_at"] = datetime.fromisoformat(row["created_at"])
+                rows[record["seq"]] = row
+    return [row for seq, row in sorted(rows.items()) if seq > done]
+
+
+def replay_journals(engine, directory, echo=None):
+    """Write the pending comments of the journals of dead workers, then remove the files"""
+    echo = echo or (lambda message: None)
+    replayed = 0
+    if not directory or not os.path.isdir(directory):
+        return replayed
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("comments-") and name.endswith(".journal")):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            journal_file = open(path, "a")
+        except OSError:
+            continue
+        with journal_file:
+            try:
+                fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # a live worker holds it
+                continue
+            rows = pending_rows(path)
+            dropped = []
+            for start in range(0, len(rows), COMMENTS_BATCH_SIZE):
+                dropped += write_batch(engine, rows[start:start + COMMENTS_BATCH_SIZE])
+            os.unlink(path)
+        replayed += len(rows) - len(dropped)
+        echo("%s: %d comments replayed, %d dropped" % (name, len(rows) - len(dropped), len(dropped)))
+    return replayed
+
+
+########## QUEUE ##########
+
+class CommentQueue:
+
+    def __init__(self, max_size, batch_size, flush_seconds):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.app = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.counts = {"accepted": 0, "written": 0, "dropped": 0, "rejected": 0, "batches": 0}
+        self._reset()
+
+    def _reset(self):
+        # also after a fork: the parent's thread, items and journal stay with the parent
+        self.slots = threading.BoundedSemaphore(self.max_size)
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.deadline = 0
+        self.thread = None
+        self.journal = None
+        self.engine = None
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid() and self.thread is not None:
+                return
+            self._reset()
+            self.pid = os.getpid()
+            with self.app.app_context():
+                self.engine = db.engine
+            if COMMENTS_JOURNAL_DIR:
+                try:
+                    replay_journals(self.engine, COMMENTS_JOURNAL_DIR)
+                except Exception as error:
+                    # the files stay, the next worker (or flask comments-replay) tries again
+                    print(error)
+                self.journal = Journal(COMMENTS_JOURNAL_DIR)
+            self.thread = threading.Thread(target=self.run, name="comment-writer", daemon=True)
+            self.thread.start()
+
+    def submit(self, **values):
+        """Queue one comment, False when the queue stayed full for COMMENTS_QUEUE_TIMEOUT"""
+        self.start()
+        if not self.slots.acquire(timeout=COMMENTS_QUEUE_TIMEOUT):
+            with self.condition:
+                self.counts["rejected"] += 1
+            return False
+        row = _row(values)
+        # numbered and queued under one lock: the batches leave in seq order, so the done mark of a batch
+        # never passes a comment that is still waiting
+        with self.condition:
+            try:
+                seq = self.journal.append(row) if self.journal is not None else None
+            except Exception:
+                # disk full, permissions...: the comment is not queued, its slot must not stay taken
+                self.slots.release()
+                raise
+            self.items.append((seq, row))
+            self.counts["accepted"] += 1
+            if len(self.items) >= self.batch_size:
+                self.condition.notify()
+        return True
+
+    def _take(self):
+        with self.condition:
+            if len(self.items) < self.batch_size and not self.stopping:
+                self.condition.wait(self.flush_seconds)
+            return [self.items.popleft() for _ in range(min(self.batch_size, len(self.items)))]
+
+    def run(self):
+        while True:
+            batch = self._take()
+            if not batch:
+                if self.stopping:
+                    return
+                continue
+            self._write(batch)
+
+    def _write(self, batch):
+        delay = 0.1
+        while True:
+            try:
+                dropped = write_batch(self.engine, [row for seq, row in batch])
+                break
+            except Exception as error:
+                # the database is away: keep the batch and try again, the journal still has it
+                print(error)
+                if self.stopping and time.monotonic() > self.deadline:
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+        with self.condition:
+            self.counts["batches"] += 1
+            self.counts["written"] += len(batch) - len(dropped)
+            self.counts["dropped"] += len(dropped)
+        if self.journal is not None:
+            self.journal.mark_done(max(seq for seq, row in batch))
+        for _ in batch:
+            self.slots.release()
+
+    def stop(self, timeout=COMMENTS_DRAIN_SECONDS):
+        """Write what is left in the queue, for at most timeout seconds"""
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.deadline = time.monotonic() + timeout
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        if self.journal is not None and not self.thread.is_alive():
+            self.journal.close()
+            # stop() runs again at exit
+            self.journal = None
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counts, gauge_pending=len(self.items))
+
+
+comment_queue = CommentQueue(COMMENTS_QUEUE_SIZE, COMMENTS_BATCH_SIZE, COMMENTS_FLUSH_MS / 1000.0)
+# gunicorn stops a worker with sys.exit, the queue is drained before the interpreter goes away
+atexit.register(comment_queue.stop)
+
+
+def init_comment_queue(app):
+    if COMMENTS_WRITE_BEHIND:
+        # the thread starts with the first comment, in the worker process (after a --preload fork)
+        comment_queue.app = app
+
+
+@click.command("comments-replay")
+@with_appcontext
+def comments_replay_command():
+    """Write the comments left in the journals of stopped workers (COMMENTS_JOURNAL_DIR)"""
+    if not COMMENTS_JOURNAL_DIR:
+        raise click.UsageError("COMMENTS_JOURNAL_DIR is not set")
+    replayed = replay_journals(db.engine, COMMENTS_JOURNAL_DIR, echo=click.echo)
+    click.echo("%d comments replayed" % replayed)
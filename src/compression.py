@@ -0,0 +1,107 @@
+"""
+Content-Encoding negotiation for the API responses: brotli (when installed), gzip or deflate.
+
+Buffered responses above COMPRESS_MIN_SIZE bytes are compressed once, in an after_request hook.
+The response cache keeps the compressed variants next to the plain body (CachedResponse.variant),
+so a hot list is compressed once per ETag instead of once per request. Streamed responses are
+compressed chunk by chunk, every batch is flushed so NDJSON clients still get rows as they come.
+"""
+import os
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+# zlib level 1-9 for gzip and deflate, brotli quality 0-11
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 4))
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "text/html", "text/plain")
+# preferred first when the client accepts several with the same quality
+CODINGS = (("br",) if brotli is not None else ()) + ("gzip", "deflate")
+
+
+def negotiate():
+    """Best Content-Encoding of CODINGS for the request's Accept-Encoding, None for identity"""
+    best, best_quality = None, 0
+    for coding in CODINGS:
+        quality = request.accept_encodings.quality(coding)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compressible(response):
+    return response.mimetype in COMPRESSIBLE_MIMETYPES and "Content-Encoding" not in response.headers
+
+
+def _zlib_compressor(coding):
+    # gzip: gzip header and trailer, deflate: the zlib format that HTTP calls deflate
+    wbits = zlib.MAX_WBITS | 16 if coding == "gzip" else zlib.MAX_WBITS
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+
+
+def compress(body, coding):
+    if coding == "br":
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    compressor = _zlib_compressor(coding)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, coding, charset="utf-8"):
+    """Compress an iterable of str/bytes chunks, every chunk is flushed to the client as it comes"""
+    if coding == "br":
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = _zlib_compressor(coding)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # closes the database cursor of the streamed query
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def set_encoding(response, coding):
+    response.headers["Content-Encoding"] = coding
+    # a compressed body is another representation, its ETag must differ from the plain one
+    etag, weak = response.get_etag()
+    if etag and not etag.endswith("-" + coding):
+        response.set_etag("%s-%s" % (etag, coding), weak)
+
+
+def compress_response(response):
+    if not compressible(response) or response.direct_passthrough or response.status_code != 200:
+        return response
+    response.vary.add("Accept-Encoding")
+    coding = negotiate()
+    if coding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, coding, response.charset)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(body, coding))
+    set_encoding(response, coding)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,212 @@
+"""
+SQLAlchemy engine/pool configuration from the environment, and live connection pool statistics
+"""
+import os
+import time
+import logging
+import threading
+import weakref
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# checkouts slower than this are logged with the pool status
+SLOW_CHECKOUT_MS = float(os.getenv("DB_POOL_SLOW_CHECKOUT_MS", 100))
+
+# defaults per backend, every value can be overridden with the DB_* variables below
+DRIVER_DEFAULTS = {
+    # postgres closes nothing by itself, but proxies and restarts do: recycle and pre-ping
+    "postgresql": {"pool_size": 5, "max_overflow": 10, "pool_timeout": 10, "pool_recycle": 1800, "pool_pre_ping": True},
+    # stay under the server wait_timeout (8h by default, often lowered by hosting providers)
+    "mysql": {"pool_size": 5, "max_overflow": 10, "pool_timeout": 10, "pool_recycle": 280, "pool_pre_ping": True},
+    # sqlite connections are local files, SQLAlchemy picks the pool class itself
+    "sqlite": {},
+}
+
+
+def _env(name, cast, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    if cast is bool:
+        return value.lower() in ("1", "true", "yes")
+    return cast(value)
+
+
+def engine_options(database_url):
+    """Build SQLALCHEMY_ENGINE_OPTIONS for the url"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    defaults = DRIVER_DEFAULTS.get(backend, DRIVER_DEFAULTS["postgresql"])
+    options = {}
+    connect_args = {}
+
+    if backend != "sqlite":
+        options["poolclass"] = InstrumentedQueuePool
+        options["pool_size"] = _env("DB_POOL_SIZE", int, defaults["pool_size"])
+        options["max_overflow"] = _env("DB_MAX_OVERFLOW", int, defaults["max_overflow"])
+        options["pool_timeout"] = _env("DB_POOL_TIMEOUT", float, defaults["pool_timeout"])
+        options["pool_recycle"] = _env("DB_POOL_RECYCLE", int, defaults["pool_recycle"])
+        options["pool_pre_ping"] = _env("DB_POOL_PRE_PING", bool, defaults["pool_pre_ping"])
+        # LIFO keeps the idle connections few and warm, the rest get recycled
+        options["pool_use_lifo"] = True
+        connect_timeout = _env("DB_CONNECT_TIMEOUT", int, 10)
+        if backend == "postgresql":
+            connect_args.update({
+                "connect_timeout": connect_timeout,
+                "keepalives": 1,
+                "keepalives_idle": 30,
+                "keepalives_interval": 10,
+                "keepalives_count": 5,
+            })
+        elif backend == "mysql" and url.get_driver_name() == "mysqldb":
+            connect_args["connect_timeout"] = connect_timeout
+    else:
+        # seconds a worker waits on a locked database file before failing with "database is locked"
+        connect_args["timeout"] = _env("DB_CONNECT_TIMEOUT", int, 15)
+
+    # compiled statement cache of SQLAlchemy (and of the sqlite3 module on sqlite)
+    statement_cache_size = _env("DB_STATEMENT_CACHE_SIZE", int, None)
+    if statement_cache_size is not None:
+        options["query_cache_size"] = statement_cache_size
+        if backend == "sqlite":
+            connect_args["cached_statements"] = statement_cache_size
+
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+
+class CheckoutStats:
+    """Counters of the time spent waiting for a connection in one process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # exponentially weighted average, reacts within a few dozen checkouts
+        self.recent_wait = 0.0
+
+    def record(self, wait, timed_out=False):
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += 1 if timed_out else 0
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.recent_wait += (wait - self.recent_wait) * 0.1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.total_wait, 6),
+                "wait_seconds_max": round(self.max_wait, 6),
+                "wait_seconds_avg": round(self.total_wait / self.checkouts, 6) if self.checkouts else 0.0,
+                "wait_seconds_recent": round(self.recent_wait, 6),
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that measures how long every checkout waits for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        self.checkout_stats = kwargs.pop("checkout_stats", None) or CheckoutStats()
+        super().__init__(*args, **kwargs)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.checkout_stats.record(time.perf_counter() - start, timed_out=True)
+            logger.warning("connection pool timeout: %s", self.status())
+            if has_request_context():
+                # admission.py answers 503 instead of the handler's 500
+                g.pool_timed_out = True
+            raise
+        wait = time.perf_counter() - start
+        self.checkout_stats.record(wait)
+        if wait * 1000 >= SLOW_CHECKOUT_MS:
+            logger.warning("slow connection checkout (%.1f ms): %s", wait * 1000, self.status())
+        return connection
+
+    def recreate(self):
+        # engine.dispose() builds a new pool, keep counting on the same stats
+        pool = super().recreate()
+        pool.checkout_stats = self.checkout_stats
+        return pool
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+            "timeout": pool.timeout(),
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(pool.checkout_stats.to_dict())
+    return stats
+
+
+def pool_metrics(engine):
+    # counters for /metrics, gauge_ keys are exported as gauges
+    stats = pool_stats(engine)
+    metrics = {}
+    for key in ("checked_out", "idle", "overflow"):
+        if key in stats:
+            metrics["gauge_" + key] = stats[key]
+    for key in ("checkouts", "timeouts", "wait_seconds_total"):
+        if key in stats:
+            metrics[key] = stats[key]
+    return metrics
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def sqlite_foreign_keys(engines):
+    """Turn the foreign keys on for every new sqlite connection, sqlite leaves them off by default.
+
+    The favorite and comment writes rely on them: a missing user or item must fail the insert.
+    """
+    for engine in engines:
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "connect", _enable_foreign_keys)
+
+
+# engines of the apps built in this process, see dispose_after_fork
+_fork_engines = weakref.WeakSet()
+
+
+def dispose_after_fork(engines):
+    """Make forked children (gunicorn --preload workers) open their own connections.
+
+    The child only forgets the pooled connections it inherited, dispose(close=False) leaves the
+    sockets alone: they still belong to the parent and closing them would break its sessions.
+    """
+    _fork_engines.update(engines)
+
+
+def _dispose_inherited():
+    for engine in list(_fork_engines):
+        engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_inherited)
@@ -0,0 +1,145 @@
+"""
+Favorite writes that rely on the unique indexes instead of SELECT-then-INSERT
+"""
+import os
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from models import db, Favorite, Character, Planet, Starship
+from utils import APIException
+from popularity import count_favorites
+
+FAVORITES_BATCH_MAX = int(os.getenv("FAVORITES_BATCH_MAX", 1000))
+
+# kind used in the urls -> (target model, favorites column)
+FAVORITE_TARGETS = {
+    "planet": (Planet, Favorite.planet_id),
+    "people": (Character, Favorite.character_id),
+    "starship": (Starship, Favorite.starship_id),
+}
+
+
+def is_duplicate(error):
+    # unique violations read differently on every driver, foreign key violations never mention these words
+    message = str(error.orig).lower()
+    return "unique" in message or "duplicate" in message
+
+
+def conflict_free_insert(kind):
+    # INSERT .. ON CONFLICT DO NOTHING where the backend has it, None otherwise
+    column = FAVORITE_TARGETS[kind][1]
+    dialect = db.session.get_bind(mapper=Favorite).dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(Favorite).on_conflict_do_nothing(index_elements=["user_id", column.key])
+    if dialect == "sqlite":
+        return sqlite.insert(Favorite).on_conflict_do_nothing(index_elements=["user_id", column.key])
+    return None
+
+
+def add_favorite(user_id, kind, target_id):
+    """Insert the favorite in one round trip, returns False if the user already had it"""
+    column = FAVORITE_TARGETS[kind][1]
+    values = {"user_id": user_id, column.key: target_id}
+
+    statement = conflict_free_insert(kind)
+    if statement is not None:
+        if db.session.execute(statement.values(**values)).rowcount != 1:
+            return False
+    else:
+        # other backends: plain INSERT inside a savepoint, the unique index rejects the duplicate
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(Favorite).values(**values))
+        except IntegrityError as error:
+            if not is_duplicate(error):
+                raise
+            return False
+    # the counter moves in the same transaction, only when a row was really inserted
+    count_favorites(FAVORITE_TARGETS[kind][0], {target_id: 1})
+    return True
+
+
+def remove_favorite(user_id, kind, target_id):
+    """Delete the favorite with a single statement, returns False if there was nothing to delete"""
+    column = FAVORITE_TARGETS[kind][1]
+    deleted = Favorite.query.filter(Favorite.user_id == user_id, column == target_id).delete(
+        synchronize_session=False
+    )
+    if deleted:
+        count_favorites(FAVORITE_TARGETS[kind][0], {target_id: -deleted})
+    return deleted > 0
+
+
+def parse_batch_items(data, operation):
+    # -> list of (operation, kind, id), None for the parts that can not be understood
+    items = data.get(operation) or []
+    if not isinstance(items, list):
+        raise APIException("%s must be a list" % operation, status_code=400)
+    parsed = []
+    for item in items:
+        kind = item.get("kind") if isinstance(item, dict) else None
+        target_id = item.get("id") if isinstance(item, dict) else None
+        if kind not in FAVORITE_TARGETS or not isinstance(target_id, int) or isinstance(target_id, bool):
+            kind, target_id = None, item
+        parsed.append((operation, kind, target_id))
+    return parsed
+
+
+def apply_favorite_batch(user_id, data):
+    """Remove then add many favorites of one user, the caller commits everything at once.
+
+    Issues one IN query per kind to validate the targets, one to read the user's current favorites,
+    and one bulk DELETE / bulk INSERT per kind. Returns one result per requested item, in order.
+    """
+    items = parse_batch_items(data, "remove") + parse_batch_items(data, "add")
+    if len(items) > FAVORITES_BATCH_MAX:
+        raise APIException("At most %d items per batch" % FAVORITES_BATCH_MAX, status_code=413)
+
+    results = []
+    for kind in FAVORITE_TARGETS:
+        ids = {target_id for operation, item_kind, target_id in items if item_kind == kind}
+        if not ids:
+            continue
+        model, column = FAVORITE_TARGETS[kind]
+        existing_targets = set(db.session.scalars(select(model.id).where(model.id.in_(ids))))
+        favorites = set(db.session.scalars(
+            select(column).where(Favorite.user_id == user_id, column.in_(ids))
+        ))
+
+        to_remove = set()
+        to_add = []
+        # net change of every target's favorites counter
+        changes = {}
+        for index, (operation, item_kind, target_id) in enumerate(items):
+            if item_kind != kind:
+                continue
+            if operation == "remove":
+                status = "removed" if target_id in favorites else "not_found"
+                if status == "removed":
+                    changes[target_id] = changes.get(target_id, 0) - 1
+                favorites.discard(target_id)
+                to_remove.add(target_id)
+            elif target_id not in existing_targets:
+                status = "not_found"
+            elif target_id in favorites:
+                status = "exists"
+            else:
+                status = "added"
+                favorites.add(target_id)
+                changes[target_id] = changes.get(target_id, 0) + 1
+                to_add.append({"user_id": user_id, column.key: target_id})
+            results.append((index, {"op": operation, "kind": kind, "id": target_id, "status": status}))
+
+        if to_remove:
+            Favorite.query.filter(Favorite.user_id == user_id, column.in_(to_remove)).delete(
+                synchronize_session=False
+            )
+        if to_add:
+            statement = conflict_free_insert(kind)
+            db.session.execute(statement if statement is not None else insert(Favorite), to_add)
+        count_favorites(model, changes)
+
+    for index, (operation, kind, item) in enumerate(items):
+        if kind is None:
+            results.append((index, {"op": operation, "item": item, "status": "invalid"}))
+    return [result for index, result in sorted(results, key=lambda pair: pair[0])]
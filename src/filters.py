@@ -0,0 +1,149 @@
+"""
+Filter and sort query language of the list endpoints: ?population[gte]=1000000&climate=arid&sort=-diameter
+
+Only whitelisted fields can be filtered or sorted, each one is backed by a (column, id) index.
+Values always travel as bound parameters.
+"""
+import re
+from flask import request
+from sqlalchemy import Integer, tuple_
+from models import Character, Planet, Starship
+from serializers import API_NAMES
+from utils import APIException
+
+# api field names per model, each one has a (column, id) index (see the models)
+FILTERABLE = {
+    Character: ["name", "age", "eye_color"],
+    Planet: ["name", "climate", "population", "diameter"],
+    Starship: ["name", "starship_class", "crew"],
+}
+NUMERIC_OPERATORS = ("eq", "ne", "gt", "gte", "lt", "lte", "in", "null")
+TEXT_OPERATORS = ("eq", "ne", "in", "starts", "null")
+# query parameters that belong to the pagination, the serializer or the streaming
+RESERVED_ARGS = ("fields", "limit", "after", "sort", "stream", "expand")
+MAX_IN_VALUES = 100
+ARG_PATTERN = re.compile(r"^(\w+)(?:\[(\w+)\])?$")
+
+
+class Sort:
+    def __init__(self, name, column, descending):
+        self.name = name
+        self.column = column
+        self.descending = descending
+
+    @property
+    def key(self):
+        return ("-" if self.descending else "") + self.name
+
+
+def filter_columns(model):
+    columns = {API_NAMES.get(model, {}).get(column.key, column.key): column for column in model.__table__.columns}
+    return {name: columns[name] for name in FILTERABLE.get(model, [])}
+
+
+def _value(column, name, raw):
+    if isinstance(column.type, Integer):
+        try:
+            return int(raw)
+        except ValueError:
+            raise APIException("%s must be an integer" % name, status_code=400)
+    return raw
+
+
+def _condition(column, name, operator, raw):
+    if operator == "null":
+        if raw.lower() not in ("true", "false", "1", "0"):
+            raise APIException("%s[null] must be true or false" % name, status_code=400)
+        return column.is_(None) if raw.lower() in ("true", "1") else column.isnot(None)
+    if operator == "in":
+        values = [_value(column, name, value) for value in raw.split(",") if value != ""]
+        if not values or len(values) > MAX_IN_VALUES:
+            raise APIException("%s[in] takes 1 to %d comma separated values" % (name, MAX_IN_VALUES), status_code=400)
+        return column.in_(values)
+    if operator == "starts":
+        # prefix match, the LIKE wildcards in the value are escaped
+        return column.startswith(raw, autoescape=True)
+    value = _value(column, name, raw)
+    return {
+        "eq": lambda: column == value,
+        "ne": lambda: column != value,
+        "gt": lambda: column > value,
+        "gte": lambda: column >= value,
+        "lt": lambda: column < value,
+        "lte": lambda: column <= value,
+    }[operator]()
+
+
+def list_args(model, after=None):
+    """(filters, sort) of the request: a list of SQL conditions and a Sort or None
+
+    after is the decoded ?after= cursor, it has to come from a page with the same sort.
+    """
+    columns = filter_columns(model)
+    filters = []
+    for key, raw in request.args.items(multi=True):
+        # _=timestamp cache busters and the other parameters of the endpoint are not filters
+        if key in RESERVED_ARGS or key.startswith("_"):
+            continue
+        match = ARG_PATTERN.match(key)
+        name, operator = (match.group(1), match.group(2) or "eq") if match else (key, None)
+        column = columns.get(name)
+        if column is None:
+            raise APIException("Unknown filter %s, use %s" % (key, ", ".join(columns) or "none"), status_code=400)
+        operators = NUMERIC_OPERATORS if isinstance(column.type, Integer) else TEXT_OPERATORS
+        if operator not in operators:
+            raise APIException("Unknown operator %s, %s takes %s" % (key, name, ", ".join(operators)), status_code=400)
+        filters.append(_condition(column, name, operator, raw))
+
+    sort = None
+    raw_sort = request.args.get("sort")
+    if raw_sort:
+        name = raw_sort.lstrip("-")
+        if name not in columns and not (name == "id" and not raw_sort.startswith("-")):
+            raise APIException("Can not sort by %s, use %s" % (name, ", ".join(columns) or "none"), status_code=400)
+        if name != "id":
+            sort = Sort(name, columns[name], raw_sort.startswith("-"))
+    check_cursor(after, sort)
+    return filters, sort
+
+
+def check_cursor(after, sort):
+    # a cursor only makes sense with the sort it was made for
+    if after is None:
+        return
+    if after.get("sort") != (sort.key if sort is not None else None):
+        raise APIException("The cursor was made for another sort", status_code=400)
+    if sort is not None:
+        value = after.get("value")
+        expected = int if isinstance(sort.column.type, Integer) else str
+        if value is not None and (not isinstance(value, expected) or isinstance(value, bool)):
+            raise APIException("Invalid cursor", status_code=400)
+
+
+def sorted_cursor(sort, entity_id, value):
+    return {"id": entity_id, "sort": sort.key, "value": value}
+
+
+def sorted_page(statement, id_column, sort, after, limit, execute):
+    """Up to limit + 1 rows ordered by the sort column then id, rows without a value come last.
+
+    Two index range scans instead of one ORDER BY with NULLS LAST (that mysql lacks and that
+    keeps postgres from walking a (column, id) index backwards): the rows with a value first,
+    then the rows where the column is NULL, by id.
+    """
+    column = sort.column
+    rows = []
+    if after is None or after.get("value") is not None:
+        with_value = statement.where(column.isnot(None))
+        if after is not None:
+            position = tuple_(column, id_column)
+            bound = tuple_(after["value"], after["id"])
+            with_value = with_value.where(position < bound if sort.descending else position > bound)
+        order = (column.desc(), id_column.desc()) if sort.descending else (column.asc(), id_column.asc())
+        rows = execute(with_value.order_by(*order).limit(limit + 1))
+    if len(rows) <= limit:
+        without_value = statement.where(column.is_(None))
+        if after is not None and after.get("value") is None:
+            without_value = without_value.where(id_column > after["id"])
+        rows += execute(without_value.order_by(id_column).limit(limit + 1 - len(rows)))
+    return rows
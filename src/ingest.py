@@ -0,0 +1,227 @@
+"""
+Write API for the catalog (characters, planets and starships), single objects or bulk loads
+"""
+import os
+import json
+from flask import request
+from sqlalchemy import insert, select, text, func, Integer, String
+from sqlalchemy.dialects import postgresql, sqlite, mysql
+from models import db, Character, Planet, Starship, Favorite, Comment
+from utils import APIException
+from cache import invalidate_model, response_cache
+from popularity import TOP_NAMESPACE
+from search import reindex, unindex, remember_changes
+from serializers import API_NAMES
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 1000))
+INGEST_MAX_BATCH_SIZE = int(os.getenv("INGEST_MAX_BATCH_SIZE", 10000))
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# kind used in the urls -> model
+CATALOG = {
+    "people": Character,
+    "planets": Planet,
+    "starships": Starship,
+}
+
+
+def api_fields(model):
+    # api field -> column
+    names = API_NAMES.get(model, {})
+    return {names.get(column.key, column.key): column for column in model.__table__.columns}
+
+
+def check_value(column, value):
+    if value is None:
+        if not column.nullable and not column.primary_key:
+            raise ValueError("%s can not be null" % column.key)
+        return None
+    if isinstance(column.type, Integer):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("%s must be an integer" % column.key)
+    elif isinstance(column.type, String):
+        if not isinstance(value, str):
+            raise ValueError("%s must be a string" % column.key)
+        if column.type.length is not None and len(value) > column.type.length:
+            raise ValueError("%s is longer than %d characters" % (column.key, column.type.length))
+    return value
+
+
+def to_row(model, item, require_id=False):
+    """Validate one JSON object and map it to column values"""
+    if not isinstance(item, dict):
+        raise ValueError("expected a JSON object")
+    fields = api_fields(model)
+    row = {}
+    for key, value in item.items():
+        column = fields.get(key)
+        if column is None:
+            raise ValueError("unknown field %s" % key)
+        row[column.key] = check_value(column, value)
+    if require_id and row.get("id") is None:
+        raise ValueError("id is required")
+    return row
+
+
+def batch_size_arg():
+    batch_size = request.args.get("batch_size", INGEST_BATCH_SIZE)
+    try:
+        batch_size = int(batch_size)
+    except (TypeError, ValueError):
+        raise APIException("batch_size must be an integer", status_code=400)
+    if batch_size < 1:
+        raise APIException("batch_size must be greater than 0", status_code=400)
+    return min(batch_size, INGEST_MAX_BATCH_SIZE)
+
+
+def is_ndjson():
+    return request.mimetype == NDJSON_MIMETYPE
+
+
+def ndjson_items():
+    # one object per line, read from the request stream so the body is never held in memory
+    for line_number, line in enumerate(request.stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as error:
+            yield line_number, error
+
+
+def _reindex(model, where):
+    # Core statements skip the mapper events, the in-memory search indexes hear about the rows on commit too
+    remember_changes(db.session, reindex(db.session.connection(), model, where))
+
+
+def write_rows(model, rows, upsert):
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    columns = [column.key for column in model.__table__.columns]
+    # executemany needs every row to carry the same keys
+    rows = [{key: row.get(key) for key in columns if key != "id" or "id" in row} for row in rows]
+    with_id = [row for row in rows if "id" in row]
+    without_id = [row for row in rows if "id" not in row]
+
+    if without_id:
+        # Core inserts skip the mapper events: the new rows are the ones above the current max id
+        last_id = db.session.scalar(select(func.max(model.id))) or 0
+        db.session.execute(insert(model), without_id)
+        _reindex(model, model.id > last_id)
+    if not with_id:
+        return
+    if not upsert:
+        db.session.execute(insert(model), with_id)
+        _reindex(model, model.id.in_([row["id"] for row in with_id]))
+        return
+
+    # PUT replaces the whole row, fields that are not sent become NULL
+    updated = [key for key in columns if key != "id"]
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = dialect_insert(model)
+        statement = statement.on_conflict_do_update(
+            index_elements=["id"], set_={key: statement.excluded[key] for key in updated}
+        )
+        db.session.execute(statement, with_id)
+    elif dialect == "mysql":
+        statement = mysql.insert(model)
+        statement = statement.on_duplicate_key_update({key: statement.inserted[key] for key in updated})
+        db.session.execute(statement, with_id)
+    else:
+        ids = [row["id"] for row in with_id]
+        existing = set(db.session.scalars(select(model.id).where(model.id.in_(ids))))
+        db.session.bulk_update_mappings(model, [row for row in with_id if row["id"] in existing])
+        new_rows = [row for row in with_id if row["id"] not in existing]
+        if new_rows:
+            db.session.execute(insert(model), new_rows)
+    _reindex(model, model.id.in_([row["id"] for row in with_id]))
+
+
+def sync_id_sequence(model):
+    # rows loaded with explicit ids do not move the postgres sequence, the next plain insert would collide
+    if db.session.get_bind(mapper=model).dialect.name != "postgresql":
+        return
+    table = model.__table__.name
+    db.session.execute(text(
+        "SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), COALESCE((SELECT MAX(id) FROM \"%s\"), 1))"
+        % (table, table)
+    ))
+    db.session.commit()
+
+
+def ingest(model, items, batch_size, upsert=False):
+    """Write (position, object) pairs in batches of batch_size, one transaction per batch.
+
+    A batch that fails is rolled back and reported, the following batches are still written.
+    """
+    report = {"received": 0, "written": 0, "failed": 0, "batches": 0, "errors": []}
+    rows = []
+    explicit_ids = False
+
+    def flush(first_position):
+        report["batches"] += 1
+        try:
+            write_rows(model, rows, upsert)
+            db.session.commit()
+            report["written"] += len(rows)
+        except Exception as error:
+            db.session.rollback()
+            report["failed"] += len(rows)
+            report["errors"].append({
+                "batch": report["batches"],
+                "first_item": first_position,
+                "rows": len(rows),
+                "error": str(getattr(error, "orig", None) or error),
+            })
+        rows.clear()
+
+    first_position = None
+    for position, item in items:
+        report["received"] += 1
+        try:
+            if isinstance(item, Exception):
+                raise ValueError("invalid JSON: %s" % item)
+            row = to_row(model, item, require_id=upsert)
+        except ValueError as error:
+            report["failed"] += 1
+            report["errors"].append({"item": position, "error": str(error)})
+            continue
+        explicit_ids = explicit_ids or "id" in row
+        if not rows:
+            first_position = position
+        rows.append(row)
+        if len(rows) >= batch_size:
+            flush(first_position)
+    if rows:
+        flush(first_position)
+
+    if report["written"]:
+        invalidate_model(model)
+        # upserts can rename items that the top lists show
+        response_cache.invalidate(TOP_NAMESPACE)
+        if explicit_ids:
+            sync_id_sequence(model)
+    return report
+
+
+def request_items():
+    # NDJSON body, or a JSON array; a single JSON object is returned as is
+    if is_ndjson():
+        return ndjson_items(), False
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        return enumerate(data), False
+    if isinstance(data, dict):
+        return data, True
+    raise APIException("A JSON object, a JSON array or an NDJSON body is required", status_code=400)
+
+
+def delete_with_dependents(model, entity):
+    # favorites and comments point at the row, remove them in the same transaction
+    column = model.__table__.name + "_id"
+    Favorite.query.filter(getattr(Favorite, column) == entity.id).delete(synchronize_session=False)
+    # bulk delete: the search documents of the comments go first, while the rows still exist
+    remember_changes(db.session, unindex(db.session.connection(), Comment, getattr(Comment, column) == entity.id))
+    Comment.query.filter(getattr(Comment, column) == entity.id).delete(synchronize_session=False)
+    db.session.delete(entity)
@@ -0,0 +1,76 @@
+"""
+JSON provider for the API: uses orjson when it is installed, the stdlib json module otherwise
+"""
+import os
+import json
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# auto (orjson if installed) or stdlib
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto").lower()
+
+
+class RawJSON:
+    """A value that is already encoded, written as is inside a list or dict response"""
+    __slots__ = ("encoded",)
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # keys keep the order of serialize(), sorting only costs CPU
+    sort_keys = False
+    ensure_ascii = False
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.use_orjson = orjson is not None and JSON_ENCODER != "stdlib"
+        if JSON_ENCODER == "orjson" and orjson is None:
+            app.logger.warning("JSON_ENCODER=orjson but orjson is not installed, using the stdlib encoder")
+
+    def _encode(self, obj, pretty=False):
+        if self.use_orjson:
+            # datetimes go through self.default so both encoders write the same dates
+            option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if pretty:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+        if pretty:
+            return super().dumps(obj, indent=2, separators=(", ", ": "))
+        return super().dumps(obj, separators=(",", ":"))
+
+    def dumps(self, obj, pretty=False, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        # pre-encoded fragments are spliced in, the rest of the payload is encoded normally
+        if isinstance(obj, RawJSON):
+            return obj.encoded
+        if isinstance(obj, list) and any(isinstance(item, RawJSON) for item in obj):
+            return "[" + ",".join(self.dumps(item, pretty) for item in obj) + "]"
+        if isinstance(obj, dict) and any(isinstance(value, RawJSON) for value in obj.values()):
+            return "{" + ",".join(
+                self._encode(str(key)) + ":" + self.dumps(value, pretty) for key, value in obj.items()
+            ) + "}"
+        return self._encode(obj, pretty)
+
+    def loads(self, s, **kwargs):
+        if self.use_orjson and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self.dumps(obj, pretty) + "\n", mimetype=self.mimetype)
+
+
+def init_json(app):
+    app.json = FastJSONProvider(app)
+    # JSON_PRETTY=1 indents the responses even out of debug mode
+    if os.getenv("JSON_PRETTY") is not None:
+        app.json.compact = os.getenv("JSON_PRETTY", "0").lower() not in ("1", "true", "yes")
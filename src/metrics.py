@@ -0,0 +1,284 @@
+"""
+Request instrumentation: latency histograms, SQL query counters and the Prometheus /metrics endpoint.
+
+Every gunicorn worker keeps its own counters in memory and writes a snapshot to METRICS_DIR
+(at most once every METRICS_FLUSH_SECONDS). /metrics merges the snapshots of all the workers,
+snapshots of dead workers are folded into an archive so their counters are not lost.
+"""
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+from flask import Response, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "starwars-api-metrics"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", 1))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ARCHIVE_FILE = "archive.json"
+
+
+def _new_series():
+    return {
+        "count": 0,
+        "duration_sum": 0.0,
+        "buckets": [0] * len(LATENCY_BUCKETS),
+        "db_queries": 0,
+        "db_seconds": 0.0,
+        "bytes": 0,
+    }
+
+
+def _add_series(total, series):
+    for key in ("count", "duration_sum", "db_queries", "db_seconds", "bytes"):
+        total[key] += series[key]
+    total["buckets"] = [a + b for a, b in zip(total["buckets"], series["buckets"])]
+
+
+class RequestMetrics:
+    """Counters of this process, series are keyed by (endpoint, method, status)"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.series = {}
+        self.in_flight = 0
+        self.last_flush = 0.0
+        # other subsystems add their own numbers to the snapshot (name -> callable returning a dict)
+        self.collectors = {}
+
+    def observe(self, labels, duration, db_queries, db_seconds, size):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = _new_series()
+            series["count"] += 1
+            series["duration_sum"] += duration
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    series["buckets"][index] += 1
+                    break
+            series["db_queries"] += db_queries
+            series["db_seconds"] += db_seconds
+            series["bytes"] += size
+
+    def snapshot(self):
+        with self.lock:
+            data = {
+                "pid": os.getpid(),
+                "in_flight": self.in_flight,
+                "series": [list(labels) + [dict(series, buckets=list(series["buckets"]))]
+                           for labels, series in self.series.items()],
+            }
+        for name, collect in self.collectors.items():
+            try:
+                data[name] = collect()
+            except Exception as error:
+                print(error)
+        return data
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < METRICS_FLUSH_SECONDS:
+            return
+        self.last_flush = now
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "worker-%d.json" % os.getpid())
+        # write and rename, readers never see a half written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(self.snapshot(), tmp_file)
+        os.replace(tmp_path, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge_into(total, snapshot, alive):
+    for endpoint, method, status, series in snapshot.get("series", []):
+        labels = (endpoint, method, status)
+        _add_series(total["series"].setdefault(labels, _new_series()), series)
+    # gauges only make sense for the workers that are still running
+    if alive:
+        total["in_flight"] += snapshot.get("in_flight", 0)
+    for name, values in snapshot.items():
+        if name in ("pid", "in_flight", "series") or not isinstance(values, dict):
+            continue
+        merged = total["collected"].setdefault(name, {})
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if alive or not key.startswith("gauge_"):
+                    merged[key] = merged.get(key, 0) + value
+
+
+def collect_all(directory):
+    """Merge the snapshots of every worker, folding dead workers into the archive"""
+    total = {"series": {}, "in_flight": 0, "collected": {}}
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, ARCHIVE_FILE)
+        archive = {"series": {}, "in_flight": 0, "collected": {}}
+        if os.path.exists(archive_path):
+            with open(archive_path) as archive_file:
+                _merge_into(archive, json.load(archive_file), alive=False)
+
+        archive_changed = False
+        for name in os.listdir(directory):
+            if not (name.startswith("worker-") and name.endswith(".json")):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+            if _alive(snapshot.get("pid", 0)):
+                _merge_into(total, snapshot, alive=True)
+            else:
+                _merge_into(archive, snapshot, alive=False)
+                os.remove(path)
+                archive_changed = True
+
+        if archive_changed:
+            with open(archive_path, "w") as archive_file:
+                json.dump({
+                    "series": [list(labels) + [series] for labels, series in archive["series"].items()],
+                    **archive["collected"],
+                }, archive_file)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    for labels, series in archive["series"].items():
+        _add_series(total["series"].setdefault(labels, _new_series()), series)
+    for name, values in archive["collected"].items():
+        merged = total["collected"].setdefault(name, {})
+        for key, value in values.items():
+            merged[key] = merged.get(key, 0) + value
+    return total
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return "{" + ",".join('%s="%s"' % (key, _escape(value)) for key, value in labels.items()) + "}"
+
+
+def render_prometheus(total):
+    lines = []
+
+    def header(name, kind, help_text):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+    series = sorted(total["series"].items())
+    header("http_requests_total", "counter", "Requests handled, by endpoint, method and status.")
+    for (endpoint, method, status), values in series:
+        lines.append("http_requests_total%s %d" % (_labels(endpoint=endpoint, method=method, status=status), values["count"]))
+
+    header("http_request_duration_seconds", "histogram", "Time until the response headers were ready.")
+    for (endpoint, method, status), values in series:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, values["buckets"]):
+            cumulative += count
+            labels = _labels(endpoint=endpoint, method=method, status=status, le=bound)
+            lines.append("http_request_duration_seconds_bucket%s %d" % (labels, cumulative))
+        labels = _labels(endpoint=endpoint, method=method, status=status, le="+Inf")
+        lines.append("http_request_duration_seconds_bucket%s %d" % (labels, values["count"]))
+        labels = _labels(endpoint=endpoint, method=method, status=status)
+        lines.append("http_request_duration_seconds_sum%s %.6f" % (labels, values["duration_sum"]))
+        lines.append("http_request_duration_seconds_count%s %d" % (labels, values["count"]))
+
+    header("http_request_db_queries_total", "counter", "SQL statements executed while handling the requests.")
+    for (endpoint, method, status), values in series:
+        labels = _labels(endpoint=endpoint, method=method, status=status)
+        lines.append("http_request_db_queries_total%s %d" % (labels, values["db_queries"]))
+
+    header("http_request_db_seconds_total", "counter", "Time spent in SQL statements while handling the requests.")
+    for (endpoint, method, status), values in series:
+        labels = _labels(endpoint=endpoint, method=method, status=status)
+        lines.append("http_request_db_seconds_total%s %.6f" % (labels, values["db_seconds"]))
+
+    header("http_response_bytes_total", "counter", "Response body bytes (streamed bodies are not counted).")
+    for (endpoint, method, status), values in series:
+        labels = _labels(endpoint=endpoint, method=method, status=status)
+        lines.append("http_response_bytes_total%s %d" % (labels, values["bytes"]))
+
+    header("http_requests_in_flight", "gauge", "Requests being handled right now by the live workers.")
+    lines.append("http_requests_in_flight %d" % total["in_flight"])
+
+    # numbers added by the other subsystems: gauge_* keys are gauges, the rest are counters
+    for name, values in sorted(total["collected"].items()):
+        for key, value in sorted(values.items()):
+            kind = "gauge" if key.startswith("gauge_") else "counter"
+            metric = "%s_%s" % (name, key[len("gauge_"):] if kind == "gauge" else key)
+            if kind == "counter" and not metric.endswith("_total"):
+                metric += "_total"
+            header(metric, kind, "%s %s." % (name, key.replace("_", " ")))
+            lines.append("%s %s" % (metric, value))
+    return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics(METRICS_DIR)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("query_start", time.perf_counter())
+    if has_request_context() and "metrics_start" in g:
+        g.db_queries += 1
+        g.db_seconds += elapsed
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+    with request_metrics.lock:
+        request_metrics.in_flight += 1
+
+
+def _record_request(response):
+    if "metrics_start" not in g:
+        return response
+    duration = time.perf_counter() - g.metrics_start
+    size = 0 if response.is_streamed else (response.calculate_content_length() or 0)
+    labels = (request.endpoint or "unmatched", request.method, str(response.status_code))
+    request_metrics.observe(labels, duration, g.db_queries, g.db_seconds, size)
+    return response
+
+
+def _finish_request(error=None):
+    if "metrics_start" in g:
+        with request_metrics.lock:
+            request_metrics.in_flight -= 1
+        request_metrics.flush()
+
+
+def metrics_view():
+    request_metrics.flush(force=True)
+    body = render_prometheus(collect_all(request_metrics.directory))
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+def init_metrics(app):
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.teardown_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view, methods=["GET"])
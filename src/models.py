@@ -1,6 +1,9 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from routing import RoutingSession
 
-db = SQLAlchemy()
+# the session sends the read-only handlers to the replica when DATABASE_REPLICA_URL is set
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 ####### USER ######
 
@@ -35,6 +38,12 @@ class User(db.Model):
 
 class Character(db.Model):
     __tablename__ = 'character'
+    # INDEXES | one per filterable field of the list endpoint (src/filters.py), id keeps the sort stable
+    __table_args__ = (
+        db.Index('ix_character_name_id', 'name', 'id'),
+        db.Index('ix_character_age_id', 'age', 'id'),
+        db.Index('ix_character_eye_color_id', 'eye_color', 'id'),
+    )
     # PK
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250))
@@ -61,6 +70,13 @@ class Character(db.Model):
 
 class Planet(db.Model):
     __tablename__ = 'planet'
+    # INDEXES | one per filterable field of the list endpoint (src/filters.py), id keeps the sort stable
+    __table_args__ = (
+        db.Index('ix_planet_name_id', 'name', 'id'),
+        db.Index('ix_planet_climate_id', 'climate', 'id'),
+        db.Index('ix_planet_population_id', 'population', 'id'),
+        db.Index('ix_planet_diameter_id', 'diameter', 'id'),
+    )
    # PK
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250))
@@ -90,6 +106,12 @@ class Planet(db.Model):
 
 class Starship(db.Model):
     __tablename__ = 'starship'
+    # INDEXES | one per filterable field of the list endpoint (src/filters.py), id keeps the sort stable
+    __table_args__ = (
+        db.Index('ix_starship_name_id', 'name', 'id'),
+        db.Index('ix_starship_starship_class_id', 'starship_class', 'id'),
+        db.Index('ix_starship_crew_id', 'crew', 'id'),
+    )
    # PK 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250))
@@ -119,6 +141,15 @@ class Starship(db.Model):
 
 class Favorite(db.Model):
     __tablename__ = 'favorites'
+    # INDEXES | a user can favorite each target only once, lookups by target use the reverse order
+    __table_args__ = (
+        db.Index('uq_favorites_user_planet', 'user_id', 'planet_id', unique=True),
+        db.Index('uq_favorites_user_character', 'user_id', 'character_id', unique=True),
+        db.Index('uq_favorites_user_starship', 'user_id', 'starship_id', unique=True),
+        db.Index('ix_favorites_planet_user', 'planet_id', 'user_id'),
+        db.Index('ix_favorites_character_user', 'character_id', 'user_id'),
+        db.Index('ix_favorites_starship_user', 'starship_id', 'user_id'),
+    )
     # PK
     id = db.Column(db.Integer, primary_key=True)
 
@@ -149,16 +180,61 @@ class Favorite(db.Model):
             # do not serialize the password, its a security breach
         }
 
+    def serialize_expanded(self):
+        # the targets have to be eager loaded by the caller, otherwise each one is a lazy query
+        data = self.serialize()
+        data["planet"] = self.planet.serialize() if self.planet is not None else None
+        data["character"] = self.character.serialize() if self.character is not None else None
+        data["starship"] = self.starship.serialize() if self.starship is not None else None
+        return data
+
+class Popularity(db.Model):
+    __tablename__ = 'popularity'
+    # INDEXES | the top lists read them backwards, most favorited (or commented) first
+    __table_args__ = (
+        db.Index('ix_popularity_favorites', 'target_table', 'favorites', 'target_id'),
+        db.Index('ix_popularity_comments', 'target_table', 'comments', 'target_id'),
+    )
+    # PK | one row per counted character, planet or starship, kept in sync by src/popularity.py
+    target_table = db.Column(db.String(20), primary_key=True)
+    target_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # INFO | how many favorites and comments point at the target
+    favorites = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comments = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+        return '<Popularity %s %r>' % (self.target_table, self.target_id)
+
+    def serialize(self):
+        return {
+            "target_table": self.target_table,
+            "target_id": self.target_id,
+            "favorites": self.favorites,
+            "comments": self.comments,
+        }
+
 ####### SOCIAL MEDIA STRUCTURE DATABASE ######
 
 
 class Comment(db.Model):
     __tablename__ = 'comment'
+    # INDEXES | the (target, created_at, id) ones serve the newest first comment feeds
+    __table_args__ = (
+        db.Index('ix_comment_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_comment_planet_created', 'planet_id', 'created_at', 'id'),
+        db.Index('ix_comment_character_created', 'character_id', 'created_at', 'id'),
+        db.Index('ix_comment_starship_created', 'starship_id', 'created_at', 'id'),
+        db.Index('ix_comment_planet_user', 'planet_id', 'user_id'),
+        db.Index('ix_comment_character_user', 'character_id', 'user_id'),
+        db.Index('ix_comment_starship_user', 'starship_id', 'user_id'),
+    )
 
     # PK
     id = db.Column(db.Integer, primary_key=True)
     # INFO | the comment text
     comment_text = db.Column(db.String(250))
+    # INFO | when the comment was written (UTC)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     # FK | USER | ONE TO MANY
     #user = db.relationship('user', back_populates='comments' )
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -179,6 +255,7 @@ class Comment(db.Model):
         return {
             "id": self.id,
             "comment_text": self.comment_text,
+            "created_at": self.created_at,
             "user_id": self.user_id,
             "character_id": self.character_id,
             "planet_id": self.planet_id,
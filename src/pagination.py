@@ -0,0 +1,157 @@
+"""
+Keyset (cursor) pagination for the list endpoints
+"""
+import os
+import json
+import base64
+from datetime import datetime
+from flask import request, url_for
+from sqlalchemy import select, tuple_
+from utils import APIException
+from models import db
+from serializers import row_serializer, select_fields
+from filters import sorted_cursor, sorted_page
+
+DEFAULT_PAGE_SIZE = int(os.getenv("PAGE_SIZE", 50))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 500))
+
+
+def encode_cursor(values):
+    # the cursor is opaque for the clients, it only carries the last key they saw
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (ValueError, TypeError):
+        raise APIException("Invalid cursor", status_code=400)
+    if not isinstance(values, dict) or not isinstance(values.get("id"), int):
+        raise APIException("Invalid cursor", status_code=400)
+    return values
+
+
+def page_args():
+    # read ?limit=&after= from the request, the limit is always capped
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise APIException("limit must be an integer", status_code=400)
+    if limit < 1:
+        raise APIException("limit must be greater than 0", status_code=400)
+    limit = min(limit, MAX_PAGE_SIZE)
+    return limit, decode_cursor(request.args.get("after"))
+
+
+def next_link(cursor):
+    args = request.args.to_dict()
+    args["after"] = cursor
+    view_args = request.view_args or {}
+    return url_for(request.endpoint, _external=True, **view_args, **args)
+
+
+def paginate(query, model, limit, after):
+    # seek on the primary key instead of OFFSET, so deep pages cost the same as the first one
+    if after is not None:
+        query = query.filter(model.id > after["id"])
+    items = query.order_by(model.id).limit(limit + 1).all()
+
+    next_url = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_url = next_link(encode_cursor({"id": items[-1].id}))
+    return items, next_url
+
+
+def paginate_serialized(model, fields, limit, after, filters=(), sort=None):
+    """One page of serialized dicts, built from Core rows when the model allows it
+
+    filters and sort come from filters.list_args(), the cursor of a sorted page carries the sort value.
+    """
+    serializer = row_serializer(model)
+    if serializer is None:
+        if sort is None:
+            items, next_url = paginate(model.query.filter(*filters), model, limit, after)
+            return [select_fields(item.serialize(), fields) for item in items], next_url
+        statement = select(model).where(*filters)
+        items = sorted_page(statement, model.id, sort, after, limit,
+                            lambda page: db.session.execute(page).scalars().all())
+        next_url = None
+        if len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            next_url = next_link(encode_cursor(sorted_cursor(sort, last.id, getattr(last, sort.column.key))))
+        return [select_fields(item.serialize(), fields) for item in items], next_url
+
+    keys, statement = serializer.compile(fields)
+    statement = statement.where(*filters)
+    id_column = model.__table__.c.id
+    if sort is not None:
+        # the cursor needs the sort value even when ?fields= leaves it out, zip() drops the extra column
+        if sort.name in keys:
+            value_index = keys.index(sort.name)
+        else:
+            statement = statement.add_columns(sort.column)
+            value_index = len(keys)
+        rows = sorted_page(statement, id_column, sort, after, limit, lambda page: db.session.execute(page).all())
+    else:
+        if after is not None:
+            statement = statement.where(id_column > after["id"])
+        rows = db.session.execute(statement.order_by(id_column).limit(limit + 1)).all()
+
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_id = rows[-1][keys.index("id")]
+        if sort is not None:
+            next_url = next_link(encode_cursor(sorted_cursor(sort, last_id, rows[-1][value_index])))
+        else:
+            next_url = next_link(encode_cursor({"id": last_id}))
+    return serializer.serialize_rows(keys, rows), next_url
+
+
+def newest_first_args():
+    # page_args() for the feeds, their cursor also carries the created_at of the last item
+    limit, after = page_args()
+    if after is not None:
+        try:
+            after["created_at"] = datetime.fromisoformat(after["created_at"])
+        except (KeyError, TypeError, ValueError):
+            raise APIException("Invalid cursor", status_code=400)
+    return limit, after
+
+
+def paginate_newest(model, where, fields, limit, after):
+    """One page of serialized dicts, newest first.
+
+    Seeks on (created_at, id) so a page is one range scan of a (..., created_at, id) index,
+    however many rows match where.
+    """
+    serializer = row_serializer(model)
+    keys, statement = serializer.compile(fields)
+    table = model.__table__
+    # the cursor needs created_at even when ?fields= leaves it out, zip() drops the extra column
+    statement = statement.add_columns(table.c.created_at).where(where)
+    if after is not None:
+        statement = statement.where(tuple_(table.c.created_at, table.c.id) < (after["created_at"], after["id"]))
+    statement = statement.order_by(table.c.created_at.desc(), table.c.id.desc()).limit(limit + 1)
+    rows = db.session.execute(statement).all()
+
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = {"id": rows[-1][keys.index("id")], "created_at": rows[-1][-1].isoformat()}
+        next_url = next_link(encode_cursor(cursor))
+    return serializer.serialize_rows(keys, rows), next_url
+
+
+def with_next_link(response, next_url):
+    # the body stays a plain list, the next page is announced on the Link header
+    if next_url is not None:
+        response.headers["Link"] = '<%s>; rel="next"' % next_url
+    return response
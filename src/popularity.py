@@ -0,0 +1,257 @@
+"""
+Favorite and comment counters of the characters, planets and starships, behind /top/<kind>.
+
+Every write that adds or removes a favorite or a comment moves the counters of its target in the
+same transaction: the Core paths of favorites.py call count_changes(), the ORM writes (comment
+handlers, Flask-Admin) go through the mapper events below. `flask popularity-reconcile` repairs drift.
+"""
+import os
+import click
+from flask import request
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, insert, delete, func, exists, or_, literal, event
+from sqlalchemy.dialects import postgresql, sqlite, mysql
+from sqlalchemy.orm import Session, object_session, attributes
+from models import db, Character, Planet, Starship, Favorite, Comment, Popularity
+from serializers import row_serializer
+from cache import response_cache
+from utils import APIException
+
+TOP_NAMESPACE = "top"
+TOP_DEFAULT_SIZE = int(os.getenv("TOP_DEFAULT_SIZE", 10))
+TOP_MAX_SIZE = int(os.getenv("TOP_MAX_SIZE", 100))
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", 5000))
+COUNTERS = ("favorites", "comments")
+# counted model -> its column in favorites and comment (<table>_id, like ingest.delete_with_dependents)
+TARGET_COLUMNS = {model: model.__tablename__ + "_id" for model in (Character, Planet, Starship)}
+MODELS = {model.__tablename__: model for model in TARGET_COLUMNS}
+
+counters = Popularity.__table__
+
+
+########## WRITES ##########
+
+def _upsert(connection, rows):
+    dialect = connection.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        statement = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(counters)
+        statement = statement.on_conflict_do_update(
+            index_elements=["target_table", "target_id"],
+            set_={name: counters.c[name] + statement.excluded[name] for name in COUNTERS})
+        connection.execute(statement, rows)
+    elif dialect == "mysql":
+        statement = mysql.insert(counters)
+        statement = statement.on_duplicate_key_update(
+            {name: counters.c[name] + statement.inserted[name] for name in COUNTERS})
+        connection.execute(statement, rows)
+    else:
+        for row in rows:
+            moved = connection.execute(
+                update(counters)
+                .where(counters.c.target_table == row["target_table"], counters.c.target_id == row["target_id"])
+                .values({name: counters.c[name] + row[name] for name in COUNTERS}))
+            if moved.rowcount == 0:
+                connection.execute(insert(counters).values(**row))
+
+
+def count_changes(connection, model, changes):
+    """Add {target id: (favorites delta, comments delta)} to the counters of the model's rows.
+
+    One UPDATE ... + delta per target, never read-modify-write, so concurrent writers can not lose
+    increments. Targets are visited in id order, two transactions always lock the rows in the same order.
+    """
+    rows = [{"target_table": model.__tablename__, "target_id": target_id,
+             "favorites": favorites, "comments": comments}
+            for target_id, (favorites, comments) in sorted(changes.items())
+            if target_id is not None and (favorites or comments)]
+    if rows:
+        _upsert(connection, rows)
+    return len(rows)
+
+
+def count_favorites(model, changes):
+    # {target id: delta} from the favorites.py Core statements, on the request's transaction
+    if count_changes(db.session.connection(), model, {target_id: (delta, 0) for target_id, delta in changes.items()}):
+        db.session.info["popularity_changed"] = True
+
+
+def _targets(target):
+    # (model, old id, new id) of every target column of a favorite or a comment that has a value
+    for model, key in TARGET_COLUMNS.items():
+        history = attributes.get_history(target, key)
+        old = history.deleted[0] if history.deleted else (history.unchanged[0] if history.unchanged else None)
+        new = history.added[0] if history.added else old
+        if old is not None or new is not None:
+            yield model, old, new
+
+
+def _moved(connection, target, counter, inserted=False, deleted=False):
+    for model, old, new in _targets(target):
+        changes = {}
+        if old is not None and not inserted and (deleted or old != new):
+            changes[old] = changes.get(old, 0) - 1
+        if new is not None and not deleted and (inserted or old != new):
+            changes[new] = changes.get(new, 0) + 1
+        count_changes(connection, model, {target_id: (delta, 0) if counter == "favorites" else (0, delta)
+                                          for target_id, delta in changes.items()})
+    _flag_changed(target)
+
+
+def _listen(model, counter):
+    event.listen(model, "after_insert", lambda mapper, connection, target: _moved(
+        connection, target, counter, inserted=True))
+    event.listen(model, "after_update", lambda mapper, connection, target: _moved(connection, target, counter))
+    # before the DELETE: an expired target can still load its columns
+    event.listen(model, "before_delete", lambda mapper, connection, target: _moved(
+        connection, target, counter, deleted=True))
+
+
+def _flag_changed(target):
+    session = object_session(target)
+    if session is not None:
+        session.info["popularity_changed"] = True
+
+
+def _forget_target(mapper, connection, target):
+    # the favorites and comments of a deleted item are deleted with it (ingest.delete_with_dependents)
+    connection.execute(delete(counters).where(
+        counters.c.target_table == mapper.class_.__tablename__, counters.c.target_id == target.id))
+    _flag_changed(target)
+
+
+def _target_updated(mapper, connection, target):
+    # the top lists embed the item's columns, a rename has to show up there too
+    _flag_changed(target)
+
+
+def _changed_on_commit(session):
+    if session.info.pop("popularity_changed", False):
+        response_cache.invalidate(TOP_NAMESPACE)
+
+
+def _forget_on_rollback(session):
+    session.info.pop("popularity_changed", None)
+
+
+_listen(Favorite, "favorites")
+_listen(Comment, "comments")
+for counted_model in TARGET_COLUMNS:
+    event.listen(counted_model, "after_delete", _forget_target)
+    event.listen(counted_model, "after_update", _target_updated)
+event.listen(Session, "after_commit", _changed_on_commit)
+event.listen(Session, "after_rollback", _forget_on_rollback)
+
+
+########## READS ##########
+
+def top_args():
+    by = request.args.get("by", "favorites")
+    if by not in COUNTERS:
+        raise APIException("by must be one of %s" % ", ".join(COUNTERS), status_code=400)
+    limit = request.args.get("limit", TOP_DEFAULT_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise APIException("limit must be an integer", status_code=400)
+    if limit < 1:
+        raise APIException("limit must be greater than 0", status_code=400)
+    return by, min(limit, TOP_MAX_SIZE)
+
+
+def top(model, by, limit):
+    """The model's most favorited (or commented) rows with their counters, one index range scan"""
+    serializer = row_serializer(model)
+    keys, statement = serializer.compile()
+    counter = counters.c[by]
+    statement = (
+        statement.add_columns(counters.c.favorites, counters.c.comments)
+        .join_from(model.__table__, counters, counters.c.target_id == model.__table__.c.id)
+        .where(counters.c.target_table == model.__tablename__, counter > 0)
+        .order_by(counter.desc(), counters.c.target_id.desc())
+        .limit(limit)
+    )
+    return serializer.serialize_rows(keys + COUNTERS, db.session.execute(statement).all())
+
+
+########## REPAIRS ##########
+
+def _actual_counts(model):
+    # (favorites, comments) correlated counts of the model's rows, both served by the (target, user) indexes
+    key = TARGET_COLUMNS[model]
+    return (
+        select(func.count()).where(getattr(Favorite, key) == model.id).scalar_subquery(),
+        select(func.count()).where(getattr(Comment, key) == model.id).scalar_subquery(),
+    )
+
+
+def rebuild(connection, model):
+    """Recount every counter of the model set based, for bulk loads that skip the write paths"""
+    key = TARGET_COLUMNS[model]
+    favorites, comments = _actual_counts(model)
+    connection.execute(delete(counters).where(counters.c.target_table == model.__tablename__))
+    connection.execute(insert(counters).from_select(
+        ["target_table", "target_id", "favorites", "comments"],
+        select(literal(model.__tablename__), model.id, favorites, comments).where(or_(
+            exists().where(getattr(Favorite, key) == model.id),
+            exists().where(getattr(Comment, key) == model.id)))))
+
+
+def reconcile(engine, model, batch_size, echo=None):
+    """Compare the counters with COUNT(*) one batch of ids at a time and fix the ones that drifted.
+
+    Each batch is its own short transaction. The counter rows of the batch are locked first
+    (postgres, mysql), so a concurrent write either is counted or lands its delta after the fix.
+    Returns (counters fixed, counters of deleted items removed).
+    """
+    echo = echo or (lambda message: None)
+    key = TARGET_COLUMNS[model]
+    favorite_column, comment_column = getattr(Favorite, key), getattr(Comment, key)
+    fixed, last_id = 0, 0
+    while True:
+        with engine.begin() as connection:
+            ids = connection.execute(
+                select(model.id).where(model.id > last_id).order_by(model.id).limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            low, high = ids[0], ids[-1]
+            stored = {row.target_id: (row.favorites, row.comments) for row in connection.execute(
+                select(counters).where(counters.c.target_table == model.__tablename__,
+                                       counters.c.target_id.between(low, high)).with_for_update())}
+            favorites = dict(connection.execute(
+                select(favorite_column, func.count()).where(favorite_column.between(low, high))
+                .group_by(favorite_column)).all())
+            comments = dict(connection.execute(
+                select(comment_column, func.count()).where(comment_column.between(low, high))
+                .group_by(comment_column)).all())
+            changes = {}
+            for target_id in ids:
+                current = stored.get(target_id, (0, 0))
+                actual = (favorites.get(target_id, 0), comments.get(target_id, 0))
+                if actual != current:
+                    changes[target_id] = (actual[0] - current[0], actual[1] - current[1])
+            fixed += count_changes(connection, model, changes)
+        echo("%s: checked up to id %d, %d counters fixed" % (model.__tablename__, high, fixed))
+        last_id = high
+
+    with engine.begin() as connection:
+        removed = connection.execute(delete(counters).where(
+            counters.c.target_table == model.__tablename__,
+            ~exists().where(model.id == counters.c.target_id))).rowcount
+    return fixed, removed
+
+
+@click.command("popularity-reconcile")
+@click.option("--batch-size", type=int, default=RECONCILE_BATCH_SIZE, show_default=True,
+              help="ids checked per transaction")
+@click.option("--tables", help="comma separated subset of: " + ", ".join(MODELS))
+@with_appcontext
+def popularity_reconcile_command(batch_size, tables):
+    """Recount the favorites and comments of every item and repair the counters that drifted"""
+    names = tables.split(",") if tables else list(MODELS)
+    unknown = [name for name in names if name not in MODELS]
+    if unknown:
+        raise click.UsageError("unknown tables: %s" % ", ".join(unknown))
+    for name in names:
+        fixed, removed = reconcile(db.engine, MODELS[name], batch_size, echo=click.echo)
+        click.echo("%s: %d counters fixed, %d counters of deleted items removed" % (name, fixed, removed))
+    response_cache.invalidate(TOP_NAMESPACE)
@@ -0,0 +1,193 @@
+"""
+SQL profiler: slow-query log with EXPLAIN, N+1 detection and per-endpoint query budgets
+"""
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+
+# statements slower than this are logged with their call site and query plan (0 turns it off)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+SLOW_QUERY_EXPLAIN = _env_flag("SLOW_QUERY_EXPLAIN", True)
+# the same statement this many times in one request is reported as a possible N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 5))
+EXPLAIN_PREFIXES = {"sqlite": "EXPLAIN QUERY PLAN ", "postgresql": "EXPLAIN ", "mysql": "EXPLAIN "}
+
+THIS_FILE = os.path.abspath(__file__)
+SRC_DIR = os.path.dirname(THIS_FILE)
+_app_files = {}
+_counters = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def call_site():
+    # first frame of our own code (app.py, cache.py...) below the SQLAlchemy internals
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        own = _app_files.get(filename)
+        if own is None:
+            path = os.path.abspath(filename)
+            own = _app_files[filename] = os.path.dirname(path) == SRC_DIR and path != THIS_FILE
+        if own:
+            return "%s:%d in %s" % (os.path.basename(filename), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return "unknown"
+
+
+def explain(engine, statement, parameters):
+    prefix = EXPLAIN_PREFIXES.get(engine.dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    try:
+        # own connection: the plan is asked outside of the transaction of the request
+        with engine.connect().execution_options(profile=False) as connection:
+            rows = connection.exec_driver_sql(prefix + statement, parameters).fetchall()
+    except Exception as error:
+        return "EXPLAIN failed: %s" % error
+    return "\n".join(" | ".join(str(value) for value in row) for row in rows)
+
+
+def log_slow_query(engine, statement, parameters, elapsed, site):
+    plan = explain(engine, statement, parameters) if SLOW_QUERY_EXPLAIN else None
+    logger.warning("slow query (%.1f ms) at %s: %s%s", elapsed * 1000, site, statement,
+                   "\n" + plan if plan else "")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["profile_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("profile_start", time.perf_counter())
+    if not conn.get_execution_options().get("profile", True):
+        return
+    for counter in getattr(_counters, "active", ()):
+        counter.count += 1
+        counter.statements.append(statement)
+
+    slow = SLOW_QUERY_MS > 0 and elapsed * 1000 >= SLOW_QUERY_MS
+    in_request = has_request_context() and "sql_log" in g
+    if in_request and g.sql_log is not None:
+        g.sql_log.append((statement, elapsed, call_site()))
+    if slow:
+        site = call_site()
+        if in_request:
+            # EXPLAIN once the response is sent, not while the request holds its connection
+            g.slow_queries.append((conn.engine, statement, parameters, elapsed, site))
+        else:
+            log_slow_query(conn.engine, statement, parameters, elapsed, site)
+
+
+class QueryCounter:
+    """Count the statements executed by this thread while the block runs"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        if not hasattr(_counters, "active"):
+            _counters.active = []
+        _counters.active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _counters.active.remove(self)
+        return False
+
+
+@contextmanager
+def assert_max_queries(budget):
+    """Test helper: with assert_max_queries(2): client.get("/users/1/favorites")"""
+    with QueryCounter() as counter:
+        yield counter
+    if counter.count > budget:
+        raise QueryBudgetExceeded("%d queries, budget is %d:\n%s" % (
+            counter.count, budget, "\n".join(counter.statements)))
+
+
+def query_budget(budget):
+    """Declare how many statements a handler may run.
+
+    Going over fails the request under TESTING (or QUERY_BUDGET_STRICT=1) and is logged otherwise.
+    Statements run while a streamed body is generated are not counted.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with QueryCounter() as counter:
+                response = view(*args, **kwargs)
+            if counter.count > budget:
+                message = "%s ran %d queries, budget is %d" % (request.endpoint, counter.count, budget)
+                if _env_flag("QUERY_BUDGET_STRICT", current_app.testing):
+                    raise QueryBudgetExceeded(message + ":\n" + "\n".join(counter.statements))
+                logger.warning(message)
+            return response
+        wrapper.query_budget = budget
+        return wrapper
+    return decorator
+
+
+def report_n_plus_one(log):
+    repeated = Counter(statement for statement, elapsed, site in log)
+    for statement, count in repeated.items():
+        if count >= N_PLUS_ONE_THRESHOLD:
+            sites = Counter(site for text, elapsed, site in log if text == statement)
+            logger.warning("possible N+1 in %s %s: %d x %s (from %s)", request.method, request.path, count,
+                           statement, ", ".join("%s x%d" % item for item in sites.most_common(3)))
+
+
+def _start_request():
+    # full statement log only while profiling, the slow query log is always on
+    g.sql_log = [] if current_app.config["SQL_PROFILE"] else None
+    g.slow_queries = []
+
+
+def _add_server_timing(response):
+    if g.get("sql_log"):
+        total = sum(elapsed for statement, elapsed, site in g.sql_log)
+        response.headers.add("Server-Timing", 'db;dur=%.1f;desc="%d queries"' % (total * 1000, len(g.sql_log)))
+    return response
+
+
+def _finish_request(exc=None):
+    if "sql_log" not in g:
+        return
+    try:
+        if g.sql_log:
+            report_n_plus_one(g.sql_log)
+        for slow_query in g.slow_queries:
+            log_slow_query(*slow_query)
+    except Exception as error:
+        print(error)
+
+
+def init_profiling(app):
+    # SQL_PROFILE=1 records every statement of every request, on by default in debug mode
+    app.config.setdefault("SQL_PROFILE", _env_flag("SQL_PROFILE", app.debug))
+    app.before_request(_start_request)
+    app.after_request(_add_server_timing)
+    app.teardown_request(_finish_request)
@@ -0,0 +1,136 @@
+"""
+Read replica routing: read-only handlers use the "replica" bind, everything else the primary database
+"""
+import os
+import time
+import tempfile
+import threading
+from functools import wraps
+from flask import g, request, current_app, has_request_context
+from flask_sqlalchemy.session import Session
+
+REPLICA_BIND = "replica"
+# after a write, the same client keeps reading from the primary for this long (replica lag budget)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+LAST_WRITE_COOKIE = "db_last_write"
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+# last write of each user, for the API clients that do not keep cookies: shared by the workers of the host
+READ_YOUR_WRITES_DIR = os.getenv("READ_YOUR_WRITES_DIR", os.path.join(tempfile.gettempdir(), "starwars-api-writers"))
+# stale markers are removed once every that many writes of a worker
+PRUNE_EVERY = 1000
+
+
+class WriteMarkers:
+    """Time of the last write of each user, one empty file per user whose mtime is the write time"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, "%d" % user_id)
+
+    def touch(self, user_id):
+        path = self._path(user_id)
+        with open(path, "ab"):
+            pass
+        os.utime(path)
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def last_write(self, user_id):
+        try:
+            return os.stat(self._path(user_id)).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def prune(self):
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime >= READ_YOUR_WRITES_SECONDS:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # another worker pruned it first
+                pass
+
+
+write_markers = WriteMarkers(READ_YOUR_WRITES_DIR)
+
+
+def replica_binds(replica_url, engine_options):
+    # SQLALCHEMY_BINDS entry for DATABASE_REPLICA_URL, empty when there is no replica
+    if not replica_url:
+        return {}
+    replica_url = replica_url.replace("postgres://", "postgresql://")
+    return {REPLICA_BIND: dict(engine_options(replica_url), url=replica_url)}
+
+
+def read_only(view):
+    """Mark a handler as read only, its queries may go to the replica"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _request_user_id():
+    user_id = (request.view_args or {}).get("user_id") or request.args.get("user_id", type=int)
+    if user_id is None and request.is_json:
+        data = request.get_json(silent=True)
+        user_id = data.get("user_id") if isinstance(data, dict) else None
+    return user_id if isinstance(user_id, int) else None
+
+
+def wrote_recently():
+    now = time.time()
+    try:
+        if now - float(request.cookies.get(LAST_WRITE_COOKIE, 0)) < READ_YOUR_WRITES_SECONDS:
+            return True
+    except ValueError:
+        pass
+    user_id = _request_user_id()
+    return user_id is not None and now - write_markers.last_write(user_id) < READ_YOUR_WRITES_SECONDS
+
+
+def reads_from_replica():
+    if not has_request_context() or REPLICA_BIND not in current_app.config.get("SQLALCHEMY_BINDS", {}):
+        return False
+    return g.get("read_only", False) and not wrote_recently()
+
+
+def maybe_lagging(written_at_ns):
+    # rows read from the replica right after a write may predate it, they should not be cached
+    return reads_from_replica() and time.time_ns() - written_at_ns < READ_YOUR_WRITES_SECONDS * 1e9
+
+
+def remember_write(response):
+    # after_request hook: successful writes pin the client (cookie) and the user (marker file) to the primary
+    if request.method not in WRITE_METHODS or response.status_code >= 400:
+        return response
+    now = time.time()
+    response.set_cookie(LAST_WRITE_COOKIE, "%.3f" % now, max_age=int(READ_YOUR_WRITES_SECONDS) + 1, httponly=True)
+    user_id = _request_user_id()
+    if user_id is not None:
+        write_markers.touch(user_id)
+    return response
+
+
+class RoutingSession(Session):
+    """Session that sends the queries of read-only handlers to the replica bind, when there is one"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and reads_from_replica():
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_routing(app):
+    app.after_request(remember_write)
@@ -0,0 +1,452 @@
+"""
+Full-text search over characters, planets, starships and comments.
+
+The documents live in one search_index table created by a migration: an FTS5 table on sqlite,
+a tsvector column with a GIN index on postgres and a FULLTEXT index on mysql. Writes keep it in
+sync in the same transaction. Without the table (other backends, or a database made with
+create_all) every worker searches an in-memory index built from the source tables, and keeps it
+up to date from a log of the changed documents shared by the workers of the host.
+"""
+import os
+import re
+import math
+import bisect
+import threading
+import weakref
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Table, Column, MetaData, Integer, SmallInteger, BigInteger, Text, select, literal, \
+    text, bindparam, inspect, event, delete
+from sqlalchemy.dialects import postgresql, mysql
+from sqlalchemy.orm import Session
+from models import db, Character, Planet, Starship, Comment
+from cache import namespace_versions
+from utils import APIException
+
+SEARCH_TABLE = "search_index"
+# doc_id = entity id * 4 + kind code: one integer key per document, unique across the four tables
+KINDS = {"people": 0, "planets": 1, "starships": 2, "comments": 3}
+KIND_NAMES = {code: name for name, code in KINDS.items()}
+MODELS = {"people": Character, "planets": Planet, "starships": Starship, "comments": Comment}
+# title and body of the document of every model
+DOCUMENT_COLUMNS = {
+    Character: (Character.name, None),
+    Planet: (Planet.name, Planet.climate),
+    Starship: (Starship.name, Starship.model),
+    Comment: (None, Comment.comment_text),
+}
+MODEL_KINDS = {model: KINDS[name] for name, model in MODELS.items()}
+MAX_TERMS = 8
+# a match in the title counts this much more than one in the body
+TITLE_WEIGHT = 10.0
+# the change log is started over once it gets bigger, the in-memory indexes are then rebuilt
+CHANGE_LOG_MAX_BYTES = 1024 * 1024
+# ids of the changed documents reloaded per query
+RELOAD_BATCH_SIZE = 500
+
+metadata = MetaData()
+search_table = Table(
+    SEARCH_TABLE, metadata,
+    Column("doc_id", BigInteger, primary_key=True),
+    Column("kind", SmallInteger, nullable=False),
+    Column("entity_id", Integer, nullable=False),
+    Column("title", Text),
+    Column("body", Text),
+)
+# the FTS5 table keys its documents by rowid
+fts_table = Table(
+    SEARCH_TABLE, MetaData(),
+    Column("rowid", BigInteger, key="doc_id", primary_key=True),
+    Column("kind", SmallInteger),
+    Column("entity_id", Integer),
+    Column("title", Text),
+    Column("body", Text),
+)
+
+# engine -> True when the search_index table exists, checked again once the engine is disposed
+_native = weakref.WeakKeyDictionary()
+
+
+def _forget_engine(engine):
+    _native.pop(engine, None)
+
+
+def uses_native_index(connection):
+    engine = connection.engine
+    native = _native.get(engine)
+    if native is None:
+        native = _native[engine] = (engine.dialect.name in ("sqlite", "postgresql", "mysql")
+                                    and inspect(connection).has_table(SEARCH_TABLE))
+        # dispose() rebuilds the pool: after a migration, in a forked worker
+        if not event.contains(engine, "engine_disposed", _forget_engine):
+            event.listen(engine, "engine_disposed", _forget_engine)
+    return native
+
+
+def terms(query):
+    # words only: nothing the user types reaches the backend query syntax
+    return re.findall(r"\w+", query.lower())[:MAX_TERMS]
+
+
+########## WRITES ##########
+
+def documents(model, where=None):
+    """SELECT of the search documents of the model's rows"""
+    code = MODEL_KINDS[model]
+    title, body = DOCUMENT_COLUMNS[model]
+    statement = select(
+        (model.id * 4 + code).label("doc_id"),
+        literal(code, SmallInteger).label("kind"),
+        model.id.label("entity_id"),
+        (title if title is not None else literal(None, Text)).label("title"),
+        (body if body is not None else literal(None, Text)).label("body"),
+    )
+    return statement.where(where) if where is not None else statement
+
+
+def unindex(connection, model, where=None, ids=None):
+    """Remove the documents of the given ids, or of the rows matching where (all of the model's when both are None)
+
+    where is evaluated against the source table, so it has to run before the rows are deleted.
+    Returns the changes of the in-memory indexes, see reindex.
+    """
+    if not uses_native_index(connection):
+        return log_changed(connection, model, where, ids)
+    table = fts_table if connection.dialect.name == "sqlite" else search_table
+    code = MODEL_KINDS[model]
+    if ids is not None:
+        statement = delete(table).where(table.c.doc_id.in_([entity_id * 4 + code for entity_id in ids]))
+    elif where is not None:
+        statement = delete(table).where(table.c.doc_id.in_(select(model.id * 4 + code).where(where)))
+    else:
+        statement = delete(table).where(table.c.kind == code)
+    connection.execute(statement)
+    return []
+
+
+def reindex(connection, model, where=None):
+    """Write the documents of the rows matching where (all rows when None), set based.
+
+    Without the search_index table the changed documents go to the change log instead, they are
+    returned so that the caller can log them again once its transaction is committed.
+    """
+    if not uses_native_index(connection):
+        return log_changed(connection, model, where)
+    source = documents(model, where)
+    names = ["doc_id", "kind", "entity_id", "title", "body"]
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(search_table).from_select(names, source)
+        statement = statement.on_conflict_do_update(
+            index_elements=["doc_id"], set_={"title": statement.excluded.title, "body": statement.excluded.body})
+    elif dialect == "mysql":
+        statement = mysql.insert(search_table).from_select(names, source)
+        statement = statement.on_duplicate_key_update(title=statement.inserted.title, body=statement.inserted.body)
+    else:
+        # FTS5 has no upsert: delete the old documents, insert the new ones
+        unindex(connection, model, where)
+        statement = fts_table.insert().from_select(names, source)
+    connection.execute(statement)
+    return []
+
+
+def log_changed(connection, model, where=None, ids=None):
+    # (kind, entity id) of the documents the in-memory indexes have to reload, entity id None for all of the kind
+    code = MODEL_KINDS[model]
+    if ids is None and where is not None:
+        ids = connection.execute(select(model.id).where(where)).scalars().all()
+    changes = [(code, None)] if ids is None else [(code, entity_id) for entity_id in ids]
+    change_log.append(changes)
+    return changes
+
+
+def remember_changes(session, changes):
+    # logged again on commit: an index refreshed between the write and the commit read the old rows
+    if changes:
+        session.info.setdefault("search_changes", set()).update(changes)
+
+
+def _index_target(mapper, connection, target):
+    _remember_target(target, reindex(connection, mapper.class_, mapper.class_.id == target.id))
+
+
+def _unindex_target(mapper, connection, target):
+    _remember_target(target, unindex(connection, mapper.class_, ids=[target.id]))
+
+
+def _remember_target(target, changes):
+    session = Session.object_session(target)
+    if session is not None:
+        remember_changes(session, changes)
+
+
+def _changed_on_commit(session):
+    changes = session.info.pop("search_changes", None)
+    if changes:
+        change_log.append(changes)
+
+
+def _forget_on_rollback(session):
+    session.info.pop("search_changes", None)
+
+
+for indexed_model in DOCUMENT_COLUMNS:
+    event.listen(indexed_model, "after_insert", _index_target)
+    event.listen(indexed_model, "after_update", _index_target)
+    event.listen(indexed_model, "after_delete", _unindex_target)
+event.listen(Session, "after_commit", _changed_on_commit)
+event.listen(Session, "after_rollback", _forget_on_rollback)
+
+
+########## NATIVE SEARCH ##########
+
+def _native_statement(dialect, words, kinds, after, limit):
+    """(statement, params) of one page, best score first, doc_id breaks the ties"""
+    params = {"limit": limit + 1, "kinds": kinds}
+    if dialect == "sqlite":
+        # bm25 is lower for better matches, weights are per column: kind, entity_id, title, body
+        inner = ("SELECT rowid AS doc_id, kind, entity_id, title, body, "
+                 "-bm25(search_index, 0, 0, %s, 1.0) AS score FROM search_index "
+                 "WHERE search_index MATCH :query" % TITLE_WEIGHT)
+        params["query"] = " ".join('"%s"*' % word for word in words)
+    elif dialect == "postgresql":
+        inner = ("SELECT doc_id, kind, entity_id, title, body, ts_rank(document, query) AS score "
+                 "FROM search_index, to_tsquery('simple', :query) AS query WHERE document @@ query")
+        params["query"] = " & ".join("%s:*" % word for word in words)
+    else:
+        inner = ("SELECT doc_id, kind, entity_id, title, body, "
+                 "MATCH (title, body) AGAINST (:query IN BOOLEAN MODE) AS score FROM search_index "
+                 "WHERE MATCH (title, body) AGAINST (:query IN BOOLEAN MODE)")
+        params["query"] = " ".join("+%s*" % word for word in words)
+
+    where = ["kind IN :kinds"]
+    if after is not None:
+        where.append("(score < :after_score OR (score = :after_score AND doc_id > :after_id))")
+        params.update(after_score=after["score"], after_id=after["id"])
+    statement = text("SELECT * FROM (%s) AS matches WHERE %s ORDER BY score DESC, doc_id LIMIT :limit" % (
+        inner, " AND ".join(where)))
+    return statement.bindparams(bindparam("kinds", expanding=True)), params
+
+
+########## IN-MEMORY FALLBACK ##########
+
+class ChangeLog:
+    """Documents changed by the writes of all the workers of the host, one "<kind> <entity id>" line each
+
+    "<kind> *" stands for every document of the kind. The file is replaced by an empty one once it gets
+    big: an index that finds another file than the one it read from rebuilds from the tables.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "ab").close()
+
+    def state(self):
+        """(identity of the file, its size)"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None, 0
+        return (stat.st_dev, stat.st_ino), stat.st_size
+
+    def append(self, changes):
+        if not changes:
+            return
+        lines = "".join("%d %s\n" % (kind, "*" if entity_id is None else entity_id) for kind, entity_id in changes)
+        if self.state()[1] > CHANGE_LOG_MAX_BYTES:
+            fresh = "%s.%d" % (self.path, os.getpid())
+            open(fresh, "wb").close()
+            os.replace(fresh, self.path)
+        # one O_APPEND write per call: the lines of two workers never interleave
+        with open(self.path, "ab") as log_file:
+            log_file.write(lines.encode())
+
+    def read(self, identity, position):
+        """(identity, position after the last complete line, changes) from position on"""
+        try:
+            with open(self.path, "rb") as log_file:
+                current = (os.fstat(log_file.fileno()).st_dev, os.fstat(log_file.fileno()).st_ino)
+                if current != identity:
+                    return current, None, None
+                log_file.seek(position)
+                data = log_file.read()
+        except FileNotFoundError:
+            return None, None, None
+        data = data[:data.rfind(b"\n") + 1]
+        changes = set()
+        for line in data.decode().splitlines():
+            kind, entity_id = line.split()
+            changes.add((int(kind), None if entity_id == "*" else int(entity_id)))
+        return identity, position + len(data), changes
+
+
+class MemoryIndex:
+    """Inverted index of the documents, kept in sync with the change log"""
+
+    def __init__(self, changes):
+        self.changes = changes
+        self.lock = threading.Lock()
+        # change log file and offset the index is up to date with
+        self.identity = None
+        self.position = None
+        self.documents = {}
+        self.postings = {}
+        self.vocabulary = []
+
+    def refresh(self, session):
+        identity, size = self.changes.state()
+        with self.lock:
+            if identity == self.identity and size == self.position:
+                return
+            changes = None
+            if identity is not None and identity == self.identity:
+                identity, position, changes = self.changes.read(self.identity, self.position)
+            if changes is None:
+                # first search, or the log was started over: read everything written until now
+                identity, position = self.changes.state()
+                self.rebuild(session)
+            else:
+                self.reload(session, changes)
+            self.identity, self.position = identity, position
+
+    def rebuild(self, session):
+        self.documents, self.postings, self.vocabulary = {}, {}, []
+        for model in DOCUMENT_COLUMNS:
+            for row in session.execute(documents(model)):
+                self.add(row)
+        self.vocabulary = sorted(self.postings)
+
+    def reload(self, session, changes):
+        # only the changed documents are read again
+        for model, code in MODEL_KINDS.items():
+            ids = sorted(entity_id for kind, entity_id in changes if kind == code and entity_id is not None)
+            if (code, None) in changes:
+                for doc_id in [doc_id for doc_id, document in self.documents.items() if document[0] == code]:
+                    self.remove(doc_id)
+                rows = session.execute(documents(model))
+            else:
+                for entity_id in ids:
+                    self.remove(entity_id * 4 + code)
+                rows = (row for start in range(0, len(ids), RELOAD_BATCH_SIZE) for row in session.execute(
+                    documents(model, model.id.in_(ids[start:start + RELOAD_BATCH_SIZE]))))
+            for row in rows:
+                self.add(row, keep_sorted=True)
+
+    def add(self, row, keep_sorted=False):
+        self.documents[row.doc_id] = (row.kind, row.entity_id, row.title, row.body)
+        for position, value in enumerate((row.title, row.body)):
+            for word in terms(value or ""):
+                if word not in self.postings:
+                    self.postings[word] = {}
+                    if keep_sorted:
+                        bisect.insort(self.vocabulary, word)
+                # [matches in the title, matches in the body]
+                self.postings[word].setdefault(row.doc_id, [0, 0])[position] += 1
+
+    def remove(self, doc_id):
+        document = self.documents.pop(doc_id, None)
+        if document is None:
+            return
+        for value in document[2:]:
+            for word in terms(value or ""):
+                found = self.postings.get(word)
+                if found is None or found.pop(doc_id, None) is None or found:
+                    continue
+                del self.postings[word]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+
+    def matches(self, word):
+        # every indexed word that starts with the search term
+        start = bisect.bisect_left(self.vocabulary, word)
+        found = {}
+        for indexed in self.vocabulary[start:]:
+            if not indexed.startswith(word):
+                break
+            for doc_id, (in_title, in_body) in self.postings[indexed].items():
+                found[doc_id] = found.get(doc_id, 0.0) + TITLE_WEIGHT * in_title + in_body
+        return found
+
+    def search(self, words, kinds, after, limit):
+        with self.lock:
+            scores = None
+            for word in words:
+                found = self.matches(word)
+                scores = found if scores is None else {
+                    doc_id: score + found[doc_id] for doc_id, score in scores.items() if doc_id in found}
+            indexed = self.documents
+        results = []
+        for doc_id, score in (scores or {}).items():
+            kind, entity_id, title, body = indexed[doc_id]
+            if kind not in kinds:
+                continue
+            # longer documents rank a little lower, like bm25 does
+            score = round(score / math.log(2 + len(terms((title or "") + " " + (body or "")))), 6)
+            if after is not None and (score > after["score"] or (score == after["score"] and doc_id <= after["id"])):
+                continue
+            results.append((doc_id, kind, entity_id, title, body, score))
+        results.sort(key=lambda result: (-result[5], result[0]))
+        return results[:limit + 1]
+
+
+change_log = ChangeLog(os.path.join(namespace_versions.directory, "search.changes"))
+memory_index = MemoryIndex(change_log)
+
+
+########## API ##########
+
+def kinds_arg(value):
+    if not value:
+        return list(KINDS.values())
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in KINDS]
+    if unknown:
+        raise APIException("Unknown type %s, use %s" % (", ".join(unknown), ", ".join(KINDS)), status_code=400)
+    return [KINDS[name] for name in names]
+
+
+def search(query, kinds, after, limit):
+    """One page of matches: (list of result dicts, cursor values of the last one or None)"""
+    words = terms(query)
+    if not words:
+        raise APIException("q must contain at least one word", status_code=400)
+    if after is not None and not isinstance(after.get("score"), (int, float)):
+        raise APIException("Invalid cursor", status_code=400)
+
+    session = db.session
+    connection = session.connection()
+    if uses_native_index(connection):
+        statement, params = _native_statement(connection.dialect.name, words, kinds, after, limit)
+        rows = [tuple(row) for row in session.execute(statement, params)]
+    else:
+        memory_index.refresh(session)
+        rows = memory_index.search(words, kinds, after, limit)
+
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = {"id": rows[-1][0], "score": rows[-1][5]}
+    results = [{"type": KIND_NAMES[kind], "id": entity_id, "title": title, "text": body, "score": score}
+               for doc_id, kind, entity_id, title, body, score in rows]
+    return results, cursor
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # alembic autogenerate: the search tables are managed by their own migration, and sqlite keeps
+    # its own tables next to ours (sqlite_stat1 of ANALYZE, sqlite_sequence of AUTOINCREMENT)
+    return not (type_ == "table" and (name.startswith(SEARCH_TABLE) or name.startswith("sqlite_")))
+
+
+@click.command("search-reindex")
+@with_appcontext
+def search_reindex_command():
+    """Rebuild the search index from the source tables (after bulk loads or a restore)"""
+    with db.engine.begin() as connection:
+        if not uses_native_index(connection):
+            click.echo("no search_index table (run flask db upgrade), the API uses the in-memory index")
+            change_log.append([(code, None) for code in KINDS.values()])
+            return
+        for model in DOCUMENT_COLUMNS:
+            unindex(connection, model)
+            reindex(connection, model)
+            click.echo("%s indexed" % model.__tablename__)
@@ -0,0 +1,401 @@
+"""
+Bulk loader behind `flask seed`: users, catalog, favorites and comments from CSV/NDJSON files or
+from the synthetic dataset, at a fraction of the cost of session.add().
+
+Every backend gets its fastest path: COPY on postgres, multi-row INSERT on mysql, executemany
+with relaxed PRAGMAs on sqlite, all in one transaction. Indexes of empty tables are dropped while
+loading and built once at the end, foreign keys are checked once at the end.
+"""
+import os
+import io
+import csv
+import json
+import time
+import click
+from datetime import datetime, date
+from flask.cli import with_appcontext
+from sqlalchemy import Index, inspect, select, func
+from sqlalchemy.exc import IntegrityError
+from models import db, User, Character, Planet, Starship, Favorite, Comment
+from serializers import API_NAMES
+from synthetic import SyntheticDataset, TABLE_ORDER
+from cache import invalidate_model, response_cache
+from search import DOCUMENT_COLUMNS, reindex
+from popularity import TARGET_COLUMNS, rebuild, TOP_NAMESPACE
+
+MODELS = {"user": User, "character": Character, "planet": Planet, "starship": Starship,
+          "favorites": Favorite, "comment": Comment}
+# file names accepted for every table, besides the table name itself
+ALIASES = {"user": ["users"], "character": ["people", "characters"], "planet": ["planets"],
+           "starship": ["starships"], "favorites": ["favorite"], "comment": ["comments"]}
+FILE_FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+# rows per round trip: COPY chunk, executemany call or multi-row INSERT (mysql max_allowed_packet)
+DEFAULT_BATCH_SIZES = {"postgresql": 50000, "sqlite": 50000, "mysql": 1000}
+NULL = "\\N"
+
+
+########## SOURCES ##########
+
+def _converter(column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if python_type is bool:
+        return lambda value: value.strip().lower() in ("1", "true", "t", "yes")
+    if python_type in (int, float):
+        return python_type
+    if python_type in (datetime, date):
+        return python_type.fromisoformat
+    return None
+
+
+def _row_reader(table):
+    # column names or the api names (height for heigth), text values converted to the column type
+    names = {column.name: column.name for column in table.columns}
+    for column, api_name in API_NAMES.get(MODELS[table.name], {}).items():
+        names[api_name] = column
+    converters = {column.name: _converter(column) for column in table.columns}
+
+    def read(item):
+        row = {}
+        for key, value in item.items():
+            column = names.get(key)
+            if column is None:
+                raise click.ClickException("%s: unknown column %s" % (table.name, key))
+            if value == "" and converters[column] is not None:
+                value = None
+            elif isinstance(value, str) and converters[column] is not None:
+                value = converters[column](value)
+            row[column] = value
+        return row
+    return read
+
+
+def with_defaults(table, rows):
+    # columns with a python side default (comment.created_at) that the source leaves out or sends empty
+    defaults = {column.name: column.default for column in table.columns
+                if column.default is not None and not column.primary_key}
+    if not defaults:
+        return rows
+
+    def filled():
+        for row in rows:
+            for name, default in defaults.items():
+                if row.get(name) is None:
+                    row[name] = default.arg(None) if default.is_callable else default.arg
+            yield row
+    return filled()
+
+
+def file_rows(path, table):
+    read = _row_reader(table)
+    with open(path, newline="", encoding="utf-8") as data_file:
+        if FILE_FORMATS[os.path.splitext(path)[1]] == "csv":
+            for item in csv.DictReader(data_file):
+                yield read(item)
+        else:
+            for line in data_file:
+                if line.strip():
+                    yield read(json.loads(line))
+
+
+def directory_sources(directory):
+    """(table, rows) for every <table>.csv / .ndjson / .jsonl found in the directory, in FK order"""
+    sources = []
+    for name in TABLE_ORDER:
+        for base in [name] + ALIASES[name]:
+            paths = [os.path.join(directory, base + extension) for extension in FILE_FORMATS]
+            path = next((path for path in paths if os.path.exists(path)), None)
+            if path is not None:
+                sources.append((name, file_rows(path, MODELS[name].__table__)))
+                break
+    return sources
+
+
+########## WRITERS ##########
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def _copy_postgresql(connection, table, columns, rows, batch_size):
+    # COPY ... FROM STDIN in chunks, the chunk is built in memory as CSV text
+    cursor = connection.connection.cursor()
+    statement = "COPY %s (%s) FROM STDIN WITH (FORMAT csv, NULL '%s')" % (
+        _quote(connection, table.name), ", ".join(_quote(connection, column) for column in columns), NULL)
+    written = 0
+    while True:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        count = 0
+        for row in rows:
+            writer.writerow([NULL if row.get(column) is None else row[column] for column in columns])
+            count += 1
+            if count >= batch_size:
+                break
+        if not count:
+            break
+        buffer.seek(0)
+        if hasattr(cursor, "copy_expert"):
+            cursor.copy_expert(statement, buffer)
+        else:
+            # psycopg 3
+            with cursor.copy(statement) as copy:
+                copy.write(buffer.getvalue())
+        written += count
+        if count < batch_size:
+            break
+    return written
+
+
+def _chunks(rows, batch_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= batch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert_multirow(connection, table, columns, rows, batch_size):
+    # one INSERT ... VALUES (...), (...), ... statement per chunk
+    written = 0
+    for chunk in _chunks(rows, batch_size):
+        connection.execute(table.insert().values([{column: row.get(column) for column in columns} for row in chunk]))
+        written += len(chunk)
+    return written
+
+
+def _executemany_sqlite(connection, table, columns, rows, batch_size):
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (
+        _quote(connection, table.name), ", ".join(_quote(connection, column) for column in columns),
+        ", ".join("?" * len(columns)))
+    # the driver would write datetimes in another text format than SQLAlchemy, and sqlite compares them as text
+    processors = [table.c[column].type.dialect_impl(connection.dialect).bind_processor(connection.dialect)
+                  for column in columns]
+    written = 0
+    for chunk in _chunks(rows, batch_size):
+        connection.exec_driver_sql(statement, [
+            tuple(value if process is None or value is None else process(value)
+                  for process, value in zip(processors, (row.get(column) for column in columns)))
+            for row in chunk])
+        written += len(chunk)
+    return written
+
+
+def _executemany(connection, table, columns, rows, batch_size):
+    written = 0
+    for chunk in _chunks(rows, batch_size):
+        connection.execute(table.insert(), [{column: row.get(column) for column in columns} for row in chunk])
+        written += len(chunk)
+    return written
+
+
+WRITERS = {"postgresql": _copy_postgresql, "mysql": _insert_multirow, "sqlite": _executemany_sqlite}
+
+
+########## SESSION SETTINGS ##########
+
+def _prepare_session(connection, backend):
+    """Relax durability/checks for the load, returns what _restore_session needs"""
+    saved = {}
+    if backend == "sqlite":
+        # PRAGMA foreign_keys is ignored inside a transaction, it has to be set before the load begins
+        for pragma in ("synchronous", "foreign_keys", "cache_size", "temp_store"):
+            saved[pragma] = connection.exec_driver_sql("PRAGMA %s" % pragma).scalar()
+        connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        connection.exec_driver_sql("PRAGMA foreign_keys = OFF")
+        connection.exec_driver_sql("PRAGMA cache_size = -262144")
+        connection.exec_driver_sql("PRAGMA temp_store = MEMORY")
+    elif backend == "mysql":
+        connection.exec_driver_sql("SET SESSION foreign_key_checks = 0, unique_checks = 0")
+    return saved
+
+
+def _restore_session(connection, backend, saved):
+    if backend == "sqlite":
+        for pragma, value in saved.items():
+            connection.exec_driver_sql("PRAGMA %s = %s" % (pragma, value))
+    elif backend == "mysql":
+        connection.exec_driver_sql("SET SESSION foreign_key_checks = 1, unique_checks = 1")
+
+
+def _drop_indexes(connection, table):
+    # secondary indexes as they are in the database, rebuilt in one pass after the load
+    indexes = [index for index in inspect(connection).get_indexes(table.name)
+               if not index.get("duplicates_constraint") and all(index["column_names"])]
+    for index in indexes:
+        connection.exec_driver_sql("DROP INDEX %s" % _quote(connection, index["name"]))
+    return indexes
+
+
+def _create_indexes(connection, table, indexes):
+    for index in indexes:
+        Index(index["name"], *[table.c[name] for name in index["column_names"]],
+              unique=index["unique"], _table=table).create(connection)
+
+
+def _drop_foreign_keys(connection, table):
+    # postgres checks every row against its parents, re-adding the constraint validates them in one scan
+    foreign_keys = [key for key in inspect(connection).get_foreign_keys(table.name) if key.get("name")]
+    for key in foreign_keys:
+        connection.exec_driver_sql("ALTER TABLE %s DROP CONSTRAINT %s" % (
+            _quote(connection, table.name), _quote(connection, key["name"])))
+    return foreign_keys
+
+
+def _add_foreign_keys(connection, table, foreign_keys):
+    for key in foreign_keys:
+        ondelete = key.get("options", {}).get("ondelete")
+        connection.exec_driver_sql("ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s)%s" % (
+            _quote(connection, table.name), _quote(connection, key["name"]),
+            ", ".join(_quote(connection, column) for column in key["constrained_columns"]),
+            _quote(connection, key["referred_table"]),
+            ", ".join(_quote(connection, column) for column in key["referred_columns"]),
+            " ON DELETE %s" % ondelete if ondelete else "",
+        ))
+
+
+def _check_foreign_keys(connection, table):
+    # mysql and sqlite loaded without checks: find the orphans before committing
+    for key in table.foreign_keys:
+        parent = key.column.table
+        child_column, parent_column = table.c[key.parent.name], parent.c[key.column.name]
+        orphans = connection.execute(
+            select(func.count()).select_from(table.outerjoin(parent, parent_column == child_column))
+            .where(child_column.isnot(None), parent_column.is_(None))
+        ).scalar()
+        if orphans:
+            raise click.ClickException("%s.%s: %d rows reference a missing %s" % (
+                table.name, key.parent.name, orphans, parent.name))
+
+
+def _sync_sequence(connection, table):
+    # same statement as ingest.sync_id_sequence, on the load connection
+    connection.exec_driver_sql(
+        "SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), COALESCE((SELECT MAX(id) FROM \"%s\"), 1))"
+        % (table.name, table.name))
+
+
+########## LOADER ##########
+
+def load_tables(engine, sources, batch_size=None, defer_indexes=None, truncate=False, echo=None):
+    """Load (table name, rows) pairs, parents first, in a single transaction.
+
+    defer_indexes=None drops and rebuilds the indexes of the tables that are empty when the load starts.
+    Returns {table name: rows written}.
+    """
+    backend = engine.dialect.name
+    batch_size = batch_size or DEFAULT_BATCH_SIZES.get(backend, 1000)
+    write = WRITERS.get(backend, _executemany)
+    # mysql commits on every DDL statement and needs the FK indexes: it relies on unique_checks=0 instead
+    can_defer = backend in ("postgresql", "sqlite")
+    echo = echo or (lambda message: None)
+    written = {}
+
+    with engine.connect() as connection:
+        with connection.begin():
+            saved = _prepare_session(connection, backend)
+        try:
+            with connection.begin():
+                if backend == "postgresql":
+                    connection.exec_driver_sql("SET LOCAL synchronous_commit = off")
+                    connection.exec_driver_sql("SET LOCAL maintenance_work_mem = '512MB'")
+                tables = [MODELS[name].__table__ for name, rows in sources]
+                if truncate:
+                    for table in reversed(tables):
+                        connection.execute(table.delete())
+
+                deferred = {}
+                for table in tables:
+                    empty = connection.execute(table.select().limit(1)).first() is None
+                    defer = can_defer and (empty if defer_indexes is None else defer_indexes)
+                    if defer:
+                        deferred[table.name] = (
+                            _drop_indexes(connection, table),
+                            _drop_foreign_keys(connection, table) if backend == "postgresql" else [],
+                        )
+
+                for table, (name, rows) in zip(tables, sources):
+                    start = time.perf_counter()
+                    columns = [column.name for column in table.columns]
+                    written[name] = write(connection, table, columns, with_defaults(table, iter(rows)), batch_size)
+                    elapsed = time.perf_counter() - start
+                    echo("%s: %d rows in %.1fs (%d rows/s)" % (
+                        name, written[name], elapsed, written[name] / elapsed if elapsed else 0))
+
+                start = time.perf_counter()
+                for table in tables:
+                    if table.name in deferred:
+                        indexes, foreign_keys = deferred[table.name]
+                        _create_indexes(connection, table, indexes)
+                        _add_foreign_keys(connection, table, foreign_keys)
+                    if backend != "postgresql":
+                        _check_foreign_keys(connection, table)
+                    if backend == "postgresql":
+                        _sync_sequence(connection, table)
+                    # Core inserts skip the mapper events that keep the search index in sync
+                    if MODELS[table.name] in DOCUMENT_COLUMNS:
+                        reindex(connection, MODELS[table.name])
+                # and the ones that keep the favorite and comment counters
+                for model in TARGET_COLUMNS:
+                    rebuild(connection, model)
+                echo("indexes, foreign keys, search index and counters: %.1fs" % (time.perf_counter() - start))
+        finally:
+            with connection.begin():
+                _restore_session(connection, backend, saved)
+
+        # fresh statistics for the planner, outside of the load transaction
+        with connection.begin():
+            for name in written:
+                if backend == "postgresql":
+                    connection.exec_driver_sql("ANALYZE %s" % _quote(connection, name))
+                elif backend == "mysql":
+                    connection.exec_driver_sql("ANALYZE TABLE %s" % _quote(connection, name))
+            if backend == "sqlite":
+                connection.exec_driver_sql("ANALYZE")
+
+    # Core inserts do not fire the mapper events that keep the caches fresh
+    for name in written:
+        invalidate_model(MODELS[name])
+    response_cache.invalidate(TOP_NAMESPACE)
+    return written
+
+
+@click.command("seed")
+@click.option("--scale", default=None, help="synthetic dataset: tiny, small, medium, large or rows per catalog table")
+@click.option("--seed", "random_seed", default=42, show_default=True, help="random seed of the synthetic dataset")
+@click.option("--from", "directory", type=click.Path(exists=True, file_okay=False),
+              help="directory with <table>.csv/.ndjson files (user, people, planets, starships, favorites, comments)")
+@click.option("--tables", help="comma separated subset of: " + ", ".join(TABLE_ORDER))
+@click.option("--batch-size", type=int, help="rows per COPY chunk / executemany call / INSERT statement")
+@click.option("--truncate", is_flag=True, help="delete the rows of the loaded tables first")
+@click.option("--defer-indexes/--keep-indexes", default=None,
+              help="build the indexes after the load (default: only for tables that start empty)")
+@with_appcontext
+def seed_command(scale, random_seed, directory, tables, batch_size, truncate, defer_indexes):
+    """Bulk load the database from files or from the synthetic dataset"""
+    if (scale is None) == (directory is None):
+        raise click.UsageError("use either --scale or --from")
+    if directory is not None:
+        sources = directory_sources(directory)
+        if not sources:
+            raise click.UsageError("no <table>.csv or <table>.ndjson file in %s" % directory)
+    else:
+        sources = [(name, rows()) for name, rows in SyntheticDataset(scale, seed=random_seed).tables()]
+    if tables:
+        selected = set(tables.split(","))
+        unknown = selected - set(TABLE_ORDER)
+        if unknown:
+            raise click.UsageError("unknown tables: %s" % ", ".join(sorted(unknown)))
+        sources = [(name, rows) for name, rows in sources if name in selected]
+
+    start = time.perf_counter()
+    try:
+        written = load_tables(db.engine, sources, batch_size, defer_indexes, truncate, echo=click.echo)
+    except IntegrityError as error:
+        raise click.ClickException("nothing was loaded, the rows conflict with the database: %s" % error.orig)
+    click.echo("loaded %d rows in %.1fs" % (sum(written.values()), time.perf_counter() - start))
@@ -0,0 +1,72 @@
+"""
+Precompiled serializers that build the API dicts straight from Core rows, without ORM objects
+"""
+from functools import lru_cache
+from flask import request
+from sqlalchemy import select
+from models import User, Character, Planet, Starship, Favorite, Comment
+from utils import APIException
+
+# columns exposed by serialize() under another name
+API_NAMES = {
+    Character: {"heigth": "height"},
+}
+
+
+class RowSerializer:
+    """Selects only the columns behind serialize() (or a subset of them) and zips each row into a dict"""
+
+    def __init__(self, model, columns):
+        self.model = model
+        # api field -> column, in the same order as serialize()
+        self.columns = columns
+
+    @lru_cache(maxsize=64)
+    def compile(self, fields=None):
+        # fields is a tuple of api names, id always comes along because the cursors need it
+        names = list(self.columns) if fields is None else ["id"] + [name for name in fields if name != "id"]
+        return tuple(names), select(*[self.columns[name] for name in names])
+
+    def serialize_rows(self, keys, rows):
+        return [dict(zip(keys, row)) for row in rows]
+
+
+def serialized_fields(model):
+    # the keys of the hand written serialize(), read from a transient instance
+    return list(model().serialize().keys())
+
+
+@lru_cache(maxsize=None)
+def row_serializer(model):
+    """RowSerializer for the model, or None when serialize() has keys that are not plain columns"""
+    names = {API_NAMES.get(model, {}).get(column.key, column.key): column for column in model.__table__.columns}
+    columns = {}
+    for field in serialized_fields(model):
+        if field not in names:
+            return None
+        columns[field] = names[field]
+    return RowSerializer(model, columns)
+
+
+def fields_arg(model):
+    # ?fields=name,population -> ("name", "population"), None when the parameter is not sent
+    raw = request.args.get("fields")
+    if not raw:
+        return None
+    fields = tuple(dict.fromkeys(name.strip() for name in raw.split(",") if name.strip()))
+    unknown = [name for name in fields if name not in serialized_fields(model)]
+    if unknown:
+        raise APIException("Unknown fields: %s" % ", ".join(unknown), status_code=400)
+    return fields
+
+
+def select_fields(data, fields):
+    # sparse fieldset for the models that still go through serialize()
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key == "id" or key in fields}
+
+
+# compile the serializers of the models that the list endpoints expose
+for serialized_model in (User, Character, Planet, Starship, Favorite, Comment):
+    row_serializer(serialized_model)
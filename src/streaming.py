@@ -0,0 +1,75 @@
+"""
+Streaming responses for clients that need a whole collection in one request
+"""
+import os
+from flask import Response, request, current_app, stream_with_context
+from sqlalchemy import select
+from models import db
+from serializers import row_serializer, fields_arg, select_fields
+
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 1000))
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def wants_ndjson():
+    # only an explicit application/x-ndjson counts, */* keeps the default JSON
+    return any(mimetype == NDJSON_MIMETYPE and quality > 0 for mimetype, quality in request.accept_mimetypes)
+
+
+def wants_stream():
+    stream = request.args.get("stream", "").lower()
+    return stream in ("1", "true", "yes") or wants_ndjson()
+
+
+def stream_collection(model, filters=(), sort=None):
+    ndjson = wants_ndjson()
+    dumps = current_app.json.dumps
+    fields = fields_arg(model)
+    serializer = row_serializer(model)
+
+    def serialized_batches(result):
+        if serializer is not None:
+            for batch in result.partitions():
+                yield serializer.serialize_rows(keys, batch)
+            return
+        for batch in result.scalars().partitions():
+            yield [select_fields(item.serialize(), fields) for item in batch]
+            # drop the batch from the session so memory does not grow with the table
+            for item in batch:
+                db.session.expunge(item)
+
+    id_column = model.__table__.c.id
+    if serializer is not None:
+        keys, statement = serializer.compile(fields)
+    else:
+        statement = select(model)
+    statement = statement.where(*filters)
+    if sort is not None:
+        # same order as the sorted pages: rows without a value last
+        column = sort.column.desc() if sort.descending else sort.column.asc()
+        id_order = id_column.desc() if sort.descending else id_column.asc()
+        statement = statement.order_by(sort.column.is_(None), column, id_order)
+    else:
+        statement = statement.order_by(id_column)
+
+    def generate():
+        # yield_per turns on a server side cursor (stream_results), rows arrive in fixed size batches
+        result = db.session.execute(statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+        try:
+            if not ndjson:
+                yield "["
+            first = True
+            for batch in serialized_batches(result):
+                items = [dumps(item) for item in batch]
+                if ndjson:
+                    yield "\n".join(items) + "\n"
+                else:
+                    yield ("" if first else ",") + ",".join(items)
+                first = False
+            if not ndjson:
+                yield "]"
+        finally:
+            result.close()
+
+    mimetype = NDJSON_MIMETYPE if ndjson else "application/json"
+    return Response(stream_with_context(generate()), status=200, mimetype=mimetype)
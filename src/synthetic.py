@@ -0,0 +1,176 @@
+"""
+Reproducible synthetic Star Wars dataset, for benchmarks and for seeding big databases.
+
+The same size and seed always give the same rows. Favorites and comments follow a power law:
+a few users do most of the activity and a few planets/characters/starships get most of it.
+"""
+import math
+import random
+import bisect
+from datetime import datetime, timedelta
+from itertools import count
+
+# named sizes: characters, planets and starships each (users are a tenth of it)
+SCALES = {"tiny": 1000, "small": 10000, "medium": 100000, "large": 1000000}
+
+SYLLABLES = ["an", "ka", "lu", "ke", "sky", "wal", "ker", "le", "ia", "or", "ga", "na", "ob", "i", "wan",
+             "ben", "ja", "bba", "chew", "bac", "ca", "han", "so", "lo", "yo", "da", "pa", "dme", "mon", "ta"]
+EYE_COLORS = ["blue", "brown", "yellow", "red", "black", "green", "hazel", "orange", "gold", "white"]
+CLIMATES = ["arid", "temperate", "tropical", "frozen", "murky", "windy", "hot", "humid", "polluted", "rocky"]
+STARSHIP_CLASSES = ["Starfighter", "Light freighter", "Corvette", "Star Destroyer", "Transport",
+                    "Assault ship", "Cruiser", "Yacht", "Patrol craft", "Landing craft"]
+MAKERS = ["Incom", "Corellian", "Kuat", "Sienar", "Cygnus", "Koensayr", "Sorosuub", "Mon Calamari"]
+WORDS = ["great", "ship", "planet", "hero", "sand", "force", "dark", "side", "jedi", "rebel", "empire",
+         "droid", "fast", "old", "love", "this", "one", "never", "again", "best", "worst", "saga"]
+
+TABLE_ORDER = ["user", "character", "planet", "starship", "favorites", "comment"]
+# the comments are written one every few minutes from this date on, in id order
+COMMENTS_START = datetime(2024, 1, 1)
+
+
+def scale_size(scale):
+    if isinstance(scale, int):
+        return scale
+    if scale in SCALES:
+        return SCALES[scale]
+    return int(scale)
+
+
+class PowerLaw:
+    """Pick ids 1..n with probability proportional to 1 / rank ** alpha"""
+
+    def __init__(self, n, alpha, rng):
+        self.n = n
+        self.rng = rng
+        total = 0.0
+        self.cumulative = []
+        for rank in range(1, n + 1):
+            total += rank ** -alpha
+            self.cumulative.append(total)
+        self.total = total
+        # spread the popular ids over the table instead of packing them at the start
+        self.step = next(step for step in count(7919) if math.gcd(step, n) == 1)
+
+    def pick(self):
+        rank = bisect.bisect_left(self.cumulative, self.rng.random() * self.total)
+        return (min(rank, self.n - 1) * self.step) % self.n + 1
+
+
+class SyntheticDataset:
+    """Generators of rows (dicts keyed by column name) for every table"""
+
+    def __init__(self, size, users=None, favorites_per_user=5, comments_per_user=3, alpha=1.1, seed=42):
+        self.size = scale_size(size)
+        self.user_count = users or max(self.size // 10, 10)
+        self.favorites_per_user = favorites_per_user
+        self.comments_per_user = comments_per_user
+        self.alpha = alpha
+        self.seed = seed
+
+    def _rng(self, table):
+        # every table has its own stream, generating one table does not shift the others
+        return random.Random("%s-%s" % (self.seed, table))
+
+    def _name(self, rng, parts=2):
+        return " ".join(
+            "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3))).capitalize()
+            for _ in range(parts)
+        )
+
+    def _activity(self, rng, mean):
+        # pareto distributed amount per user, mean close to `mean`
+        return min(int(mean * 0.5 * rng.paretovariate(2.0)), 50 * mean)
+
+    def users(self):
+        for user_id in range(1, self.user_count + 1):
+            yield {"id": user_id, "email": "user%d@example.com" % user_id, "password": "synthetic", "is_active": True}
+
+    def characters(self):
+        rng = self._rng("character")
+        for character_id in range(1, self.size + 1):
+            yield {
+                "id": character_id,
+                "name": self._name(rng),
+                "age": rng.randint(8, 900),
+                "heigth": rng.randint(60, 260),
+                "eye_color": rng.choice(EYE_COLORS),
+            }
+
+    def planets(self):
+        rng = self._rng("planet")
+        for planet_id in range(1, self.size + 1):
+            yield {
+                "id": planet_id,
+                "name": self._name(rng, 1),
+                "diameter": rng.randint(1000, 200000),
+                "gravity": rng.randint(0, 5),
+                "population": int(10 ** rng.uniform(2, 9)),
+                "climate": rng.choice(CLIMATES),
+            }
+
+    def starships(self):
+        rng = self._rng("starship")
+        for starship_id in range(1, self.size + 1):
+            yield {
+                "id": starship_id,
+                "name": self._name(rng),
+                "model": "%s %s-%d" % (rng.choice(MAKERS), rng.choice("ABXYTVZ"), rng.randint(1, 99)),
+                "starship_class": rng.choice(STARSHIP_CLASSES),
+                "crew": int(10 ** rng.uniform(0, 5)),
+                "passengers": int(10 ** rng.uniform(0, 4)),
+            }
+
+    def _targets(self, rng):
+        return {
+            "planet_id": PowerLaw(self.size, self.alpha, rng),
+            "character_id": PowerLaw(self.size, self.alpha, rng),
+            "starship_id": PowerLaw(self.size, self.alpha, rng),
+        }
+
+    def favorites(self):
+        rng = self._rng("favorites")
+        targets = self._targets(rng)
+        columns = list(targets)
+        favorite_id = count(1)
+        for user_id in range(1, self.user_count + 1):
+            chosen = set()
+            for _ in range(self._activity(rng, self.favorites_per_user)):
+                column = rng.choice(columns)
+                target = (column, targets[column].pick())
+                # (user, target) is unique, popular targets are simply not picked twice
+                if target in chosen:
+                    continue
+                chosen.add(target)
+                row = {"id": next(favorite_id), "user_id": user_id,
+                       "planet_id": None, "character_id": None, "starship_id": None}
+                row[column] = target[1]
+                yield row
+
+    def comments(self):
+        rng = self._rng("comment")
+        targets = self._targets(rng)
+        columns = list(targets)
+        users = PowerLaw(self.user_count, self.alpha, rng)
+        total = self.user_count * self.comments_per_user
+        created_at = COMMENTS_START
+        for comment_id in range(1, total + 1):
+            column = rng.choice(columns)
+            # some comments share their timestamp, the feeds break those ties by id
+            created_at += timedelta(seconds=rng.choice((0, 1, 30, 300)))
+            row = {
+                "id": comment_id,
+                "comment_text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))[:250],
+                "created_at": created_at,
+                "user_id": users.pick(),
+                "planet_id": None, "character_id": None, "starship_id": None,
+            }
+            row[column] = targets[column].pick()
+            yield row
+
+    def tables(self):
+        """(table name, row generator) in foreign key order"""
+        generators = {
+            "user": self.users, "character": self.characters, "planet": self.planets,
+            "starship": self.starships, "favorites": self.favorites, "comment": self.comments,
+        }
+        return [(name, generators[name]) for name in TABLE_ORDER]
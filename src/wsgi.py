@@ -1,7 +1,10 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
-from app import app as application
+from app import create_app
+
+# the web workers do not run migrations, `flask db ...` builds its own app with Flask-Migrate
+application = create_app({"MIGRATE_ENABLED": False})
 
 if __name__ == "__main__":
     application.run()
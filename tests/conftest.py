@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+# read when the modules are imported: no rate limit, and directories of their own for the shared state
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+TEST_DIR = tempfile.mkdtemp(prefix="starwars-api-test-")
+os.environ.setdefault("CACHE_DIR", os.path.join(TEST_DIR, "cache"))
+os.environ.setdefault("READ_YOUR_WRITES_DIR", os.path.join(TEST_DIR, "writers"))
+
+from app import create_app  # noqa: E402
+from models import db  # noqa: E402
+from cache import response_cache, entity_cache  # noqa: E402
+from search import memory_index  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Build an app on a new sqlite file of tmp_path with all the tables created"""
+    def make(name="test.db", **config):
+        app = create_app(dict({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % (tmp_path / name),
+            "MIGRATE_ENABLED": False,
+            "ADMIN_ENABLED": False,
+            "TESTING": True,
+        }, **config))
+        with app.app_context():
+            # db is shared by the apps: a replica bind of an earlier test is still registered
+            db.create_all(bind_key=None)
+        # the caches live in the modules, entries of an earlier test come from another database
+        with response_cache.lock:
+            response_cache.entries.clear()
+        with entity_cache.lock:
+            entity_cache.entries.clear()
+        # and the in-memory search index was built from another database
+        memory_index.identity = None
+        return app
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,53 @@
+import pytest
+import cache
+from models import db, Planet, Starship
+
+
+@pytest.fixture
+def planets(app):
+    with app.app_context():
+        db.session.add_all([Planet(name="Dagobah"), Planet(name="Endor")])
+        db.session.commit()
+
+
+def test_unchanged_list_is_revalidated_with_304(client, planets):
+    first = client.get("/planets")
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "no-cache"
+    etag = first.headers["ETag"]
+
+    again = client.get("/planets", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+
+def test_write_changes_the_etag(client, planets):
+    etag = client.get("/planets").headers["ETag"]
+    assert client.post("/planets", json={"name": "Naboo"}).status_code == 201
+
+    response = client.get("/planets", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert "Naboo" in [planet["name"] for planet in response.get_json()]
+
+
+def test_update_reaches_the_cached_single_item(client, planets):
+    assert client.get("/planets/1").get_json()["name"] == "Dagobah"
+    assert client.put("/planets/1", json={"name": "Dagobah System"}).status_code == 200
+    assert client.get("/planets/1").get_json()["name"] == "Dagobah System"
+
+
+def test_errors_are_not_cached(app, client, monkeypatch):
+    with app.app_context():
+        db.session.add(Starship(name="Millennium Falcon"))
+        db.session.commit()
+
+    def broken(model, entity_id, loader=None):
+        raise RuntimeError("database is away")
+    monkeypatch.setattr(cache.entity_cache, "get_or_load", broken)
+    assert client.get("/starships/1").status_code == 500
+
+    monkeypatch.undo()
+    response = client.get("/starships/1")
+    assert response.status_code == 200
+    assert response.get_json()["name"] == "Millennium Falcon"
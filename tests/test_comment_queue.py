@@ -0,0 +1,95 @@
+import os
+import pytest
+from models import db, User, Planet, Comment, Popularity
+from comment_queue import CommentQueue, Journal, write_batch, replay_journals, pending_rows, _row
+
+
+@pytest.fixture
+def catalog(app):
+    """user 1 and planet 1"""
+    with app.app_context():
+        db.session.add_all([User(id=1, email="rey@example.com", password="secret", is_active=True),
+                            Planet(id=1, name="Jakku")])
+        db.session.commit()
+    return app
+
+
+def comment(text, user_id=1):
+    return _row({"user_id": user_id, "planet_id": 1, "comment_text": text})
+
+
+def stored(app):
+    with app.app_context():
+        texts = sorted(text for text, in db.session.query(Comment.comment_text))
+        counter = db.session.get(Popularity, ("planet", 1))
+        return texts, counter.comments if counter is not None else 0
+
+
+def test_batch_keeps_the_good_rows_when_one_is_refused(catalog):
+    with catalog.app_context():
+        dropped = write_batch(db.engine, [comment("first"), comment("nobody", user_id=99), comment("second")])
+    assert [row["comment_text"] for row in dropped] == ["nobody"]
+    assert stored(catalog) == (["first", "second"], 2)
+
+
+def test_queue_writes_every_comment_by_batches(catalog):
+    queue = CommentQueue(max_size=10, batch_size=3, flush_seconds=0.05)
+    queue.app = catalog
+    for number in range(7):
+        assert queue.submit(**comment("comment %d" % number))
+    queue.stop(timeout=5)
+    assert stored(catalog) == (["comment %d" % number for number in range(7)], 7)
+    assert queue.stats()["written"] == 7
+    assert queue.stats()["gauge_pending"] == 0
+
+
+def test_full_queue_refuses_the_comment(catalog, monkeypatch):
+    monkeypatch.setattr("comment_queue.COMMENTS_QUEUE_TIMEOUT", 0.01)
+    queue = CommentQueue(max_size=1, batch_size=10, flush_seconds=5)
+    queue.app = catalog
+    assert queue.submit(**comment("fits"))
+    assert not queue.submit(**comment("does not fit"))
+    assert queue.stats()["rejected"] == 1
+    queue.stop(timeout=5)
+    assert stored(catalog) == (["fits"], 1)
+
+
+def test_journal_failure_gives_the_slot_back(catalog, monkeypatch):
+    monkeypatch.setattr("comment_queue.COMMENTS_QUEUE_TIMEOUT", 0.01)
+
+    class FullDisk:
+        def append(self, row):
+            raise OSError("No space left on device")
+
+    queue = CommentQueue(max_size=1, batch_size=10, flush_seconds=5)
+    queue.app = catalog
+    queue.start()
+    queue.journal = FullDisk()
+    with pytest.raises(OSError):
+        queue.submit(**comment("lost"))
+    queue.journal = None
+    assert queue.submit(**comment("kept"))
+    queue.stop(timeout=5)
+    assert stored(catalog) == (["kept"], 1)
+
+
+def test_replay_writes_the_comments_a_dead_worker_did_not_mark(catalog, tmp_path):
+    journal = Journal(str(tmp_path))
+    for text in ("written", "pending 1", "pending 2"):
+        journal.append(comment(text))
+    journal.mark_done(1)
+    # the worker dies: the file stays, its lock goes
+    journal.file.close()
+    assert [row["comment_text"] for row in pending_rows(journal.path)] == ["pending 1", "pending 2"]
+
+    with catalog.app_context():
+        assert replay_journals(db.engine, str(tmp_path)) == 2
+    assert stored(catalog) == (["pending 1", "pending 2"], 2)
+    assert not os.path.exists(journal.path)
+
+
+def test_handler_refuses_values_the_database_would_refuse(catalog, client):
+    assert client.post("/comment/planet/1", json={"user_id": "x", "comment_text": "hi"}).status_code == 400
+    assert client.post("/comment/planet/1", json={"user_id": 1, "comment_text": "x" * 251}).status_code == 400
+    assert client.post("/comment/planet/1", json={"user_id": True, "comment_text": "hi"}).status_code == 400
+    assert client.post("/comment/planet/1", json={"user_id": "1", "comment_text": "hi"}).status_code == 201
@@ -0,0 +1,42 @@
+from models import db, User, Planet, Favorite, Popularity
+
+
+def test_favorite_of_a_missing_planet_is_404(app, client):
+    with app.app_context():
+        user = User(email="leia@example.com", password="secret", is_active=True)
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    response = client.post("/favorites/user/%d/planet/999" % user_id)
+
+    assert response.status_code == 404
+    with app.app_context():
+        assert Favorite.query.count() == 0
+        assert Popularity.query.count() == 0
+
+
+def test_favorite_of_a_missing_user_is_404(app, client):
+    with app.app_context():
+        planet = Planet(name="Tatooine")
+        db.session.add(planet)
+        db.session.commit()
+        planet_id = planet.id
+
+    assert client.post("/favorites/user/999/planet/%d" % planet_id).status_code == 404
+    with app.app_context():
+        assert Favorite.query.count() == 0
+
+
+def test_favorite_is_added_once(app, client):
+    with app.app_context():
+        user = User(email="leia@example.com", password="secret", is_active=True)
+        planet = Planet(name="Tatooine")
+        db.session.add_all([user, planet])
+        db.session.commit()
+        url = "/favorites/user/%d/planet/%d" % (user.id, planet.id)
+
+    assert client.post(url).status_code == 201
+    assert client.post(url).status_code == 400
+    with app.app_context():
+        assert Favorite.query.count() == 1
@@ -0,0 +1,58 @@
+from models import db, User, Planet, Character, Favorite
+
+
+def setup_catalog(app):
+    with app.app_context():
+        db.session.add_all([User(id=1, email="finn@example.com", password="secret", is_active=True),
+                            Planet(id=1, name="Jakku"), Planet(id=2, name="Takodana"), Character(id=1, name="Poe")])
+        db.session.add(Favorite(user_id=1, planet_id=2))
+        db.session.commit()
+
+
+def test_batch_reports_every_item_in_order(app, client):
+    setup_catalog(app)
+    response = client.post("/favorites/user/1/batch", json={
+        "remove": [{"kind": "planet", "id": 2}, {"kind": "people", "id": 1}],
+        "add": [
+            {"kind": "planet", "id": 1},
+            {"kind": "planet", "id": 1},
+            {"kind": "planet", "id": 999},
+            {"kind": "people", "id": 1},
+            {"kind": "droid", "id": 1},
+            "planet 1",
+        ],
+    })
+    assert response.status_code == 200
+    assert [(result["op"], result.get("kind"), result["status"]) for result in response.get_json()["results"]] == [
+        ("remove", "planet", "removed"),
+        ("remove", "people", "not_found"),
+        ("add", "planet", "added"),
+        ("add", "planet", "exists"),
+        ("add", "planet", "not_found"),
+        ("add", "people", "added"),
+        ("add", None, "invalid"),
+        ("add", None, "invalid"),
+    ]
+    with app.app_context():
+        assert {(favorite.planet_id, favorite.character_id) for favorite in Favorite.query} == {(1, None), (None, 1)}
+
+
+def test_batch_of_a_missing_user_is_404(app, client):
+    setup_catalog(app)
+    response = client.post("/favorites/user/2/batch", json={"add": [{"kind": "planet", "id": 1}]})
+    assert response.status_code == 404
+
+
+def test_batch_that_is_not_a_list_writes_nothing(app, client):
+    setup_catalog(app)
+    response = client.post("/favorites/user/1/batch", json={"add": [{"kind": "planet", "id": 1}], "remove": "all"})
+    assert response.status_code == 400
+    with app.app_context():
+        assert [favorite.planet_id for favorite in Favorite.query] == [2]
+
+
+def test_too_big_batch_is_413(app, client, monkeypatch):
+    setup_catalog(app)
+    monkeypatch.setattr("favorites.FAVORITES_BATCH_MAX", 2)
+    items = [{"kind": "planet", "id": 1}] * 3
+    assert client.post("/favorites/user/1/batch", json={"add": items}).status_code == 413
@@ -0,0 +1,58 @@
+from models import db, User, Character, Planet, Starship, Favorite
+import profiling
+
+
+def expanded_favorites(app, favorites_per_kind):
+    """Status, favorites and statements of /users/<id>/favorites?expand=1 for a user with N favorites of each kind"""
+    with app.app_context():
+        user = User(email="luke@example.com", password="secret", is_active=True)
+        db.session.add(user)
+        for number in range(favorites_per_kind):
+            planet = Planet(name="Planet %d" % number)
+            character = Character(name="Character %d" % number)
+            starship = Starship(name="Starship %d" % number)
+            db.session.add_all([planet, character, starship])
+            db.session.add_all([
+                Favorite(user=user, planet=planet),
+                Favorite(user=user, character=character),
+                Favorite(user=user, starship=starship),
+            ])
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    # the handler's budget: one query for the user, one for the favorites with their targets
+    with profiling.assert_max_queries(2) as counter:
+        response = client.get("/users/%d/favorites?expand=1" % user_id)
+    return response.status_code, response.get_json(), counter.count
+
+
+def test_expanded_favorites_stay_within_budget(make_app):
+    counts = {}
+    for favorites_per_kind in (1, 20):
+        status, favorites, counts[favorites_per_kind] = expanded_favorites(
+            make_app("favorites_%d.db" % favorites_per_kind), favorites_per_kind)
+        assert status == 200
+        assert len(favorites) == 3 * favorites_per_kind
+    # the targets are loaded with the favorites, not one query per favorite
+    assert counts[20] == counts[1]
+
+
+def test_expanded_favorites_include_their_targets(app):
+    status, favorites, _ = expanded_favorites(app, 2)
+    assert status == 200
+    assert sorted(favorite["planet"]["name"] for favorite in favorites if favorite.get("planet")) == [
+        "Planet 0", "Planet 1"]
+
+
+def test_plain_favorites_stay_within_budget(app):
+    with app.app_context():
+        user = User(email="han@example.com", password="secret", is_active=True)
+        db.session.add_all([user] + [Favorite(user=user, planet=Planet(name="Planet %d" % n)) for n in range(5)])
+        db.session.commit()
+        user_id = user.id
+
+    with profiling.assert_max_queries(2):
+        response = app.test_client().get("/users/%d/favorites" % user_id)
+    assert response.status_code == 200
+    assert len(response.get_json()) == 5
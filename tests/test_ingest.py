@@ -0,0 +1,61 @@
+import json
+from models import db, Planet
+
+
+def names(app):
+    with app.app_context():
+        return [planet.name for planet in Planet.query.order_by(Planet.id)]
+
+
+def test_bulk_create_is_201_when_everything_is_written(app, client):
+    response = client.post("/planets?batch_size=2", json=[{"name": "Hoth"}, {"name": "Endor"}, {"name": "Yavin"}])
+    assert response.status_code == 201
+    report = response.get_json()
+    assert (report["received"], report["written"], report["failed"], report["batches"]) == (3, 3, 0, 2)
+    assert names(app) == ["Hoth", "Endor", "Yavin"]
+
+
+def test_bulk_create_reports_bad_items_and_failed_batches_with_207(app, client):
+    with app.app_context():
+        db.session.add(Planet(id=5, name="Scarif"))
+        db.session.commit()
+    items = [
+        {"name": "Hoth"},
+        {"name": "Endor", "diameter": "big"},
+        {"name": "Yavin"},
+        # batch 2 fails on the primary key, the batches around it are still written
+        {"id": 5, "name": "Duplicate"},
+        {"name": "Lost with the duplicate"},
+        {"name": "Jedha"},
+    ]
+    response = client.post("/planets?batch_size=2", json=items)
+    assert response.status_code == 207
+    report = response.get_json()
+    assert (report["received"], report["written"], report["failed"], report["batches"]) == (6, 3, 3, 3)
+    item_error, batch_error = report["errors"]
+    assert item_error["item"] == 1
+    assert (batch_error["batch"], batch_error["first_item"], batch_error["rows"]) == (2, 3, 2)
+    assert names(app) == ["Scarif", "Hoth", "Yavin", "Jedha"]
+
+
+def test_ndjson_lines_that_are_not_json_are_reported(app, client):
+    body = "\n".join([json.dumps({"name": "Hoth"}), "{not json", json.dumps({"name": "Endor"})])
+    response = client.post("/planets", data=body, content_type="application/x-ndjson")
+    assert response.status_code == 207
+    report = response.get_json()
+    assert (report["written"], report["failed"]) == (2, 1)
+    # NDJSON items are reported by line number
+    assert report["errors"][0]["item"] == 2
+    assert names(app) == ["Hoth", "Endor"]
+
+
+def test_upsert_needs_an_id_and_replaces_the_row(app, client):
+    with app.app_context():
+        db.session.add(Planet(id=1, name="Tatooine", climate="arid"))
+        db.session.commit()
+    response = client.put("/planets", json=[{"id": 1, "name": "Tatooine"}, {"name": "No id"}, {"id": 2, "name": "Naboo"}])
+    assert response.status_code == 207
+    assert response.get_json()["failed"] == 1
+    with app.app_context():
+        assert [(planet.id, planet.name, planet.climate) for planet in Planet.query.order_by(Planet.id)] == [
+            (1, "Tatooine", None), (2, "Naboo", None)]
@@ -0,0 +1,67 @@
+import pytest
+from models import db, Character
+
+
+@pytest.fixture
+def people(app):
+    # repeated and missing ages: the sorted walks have ties and rows without a value
+    ages = [30, None, 19, 30, 45, None, 19, 30, 62, 8, 30]
+    with app.app_context():
+        db.session.add_all([Character(name="Person %02d" % number, age=age) for number, age in enumerate(ages)])
+        db.session.commit()
+        return [character.id for character in Character.query.order_by(Character.id)]
+
+
+def walk(client, url):
+    """ids of every page, following the Link header"""
+    ids, pages = [], 0
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        ids += [item["id"] for item in response.get_json()]
+        pages += 1
+        link = response.headers.get("Link")
+        url = link[link.index("<") + 1:link.index(">")] if link else None
+    return ids, pages
+
+
+def test_cursor_walks_every_row_once(client, people):
+    ids, pages = walk(client, "/people?limit=3")
+    assert ids == people
+    assert pages == 4
+
+
+@pytest.mark.parametrize("sort", ["age", "-age", "name", "-name"])
+def test_sorted_cursor_walks_every_row_once(client, people, sort):
+    everything, _ = walk(client, "/people?limit=100&sort=%s" % sort)
+    assert sorted(everything) == people
+    for limit in (1, 2, 4):
+        assert walk(client, "/people?limit=%d&sort=%s" % (limit, sort))[0] == everything
+
+
+def test_filtered_walk_keeps_the_filter(client, people):
+    everything, _ = walk(client, "/people?limit=100&age=30")
+    assert len(everything) == 4
+    assert walk(client, "/people?limit=1&age=30") == (everything, 4)
+
+
+def test_rows_written_behind_the_cursor_are_not_repeated(app, client, people):
+    first = client.get("/people?limit=5")
+    link = first.headers["Link"]
+    with app.app_context():
+        db.session.add(Character(name="Late arrival"))
+        db.session.commit()
+    rest, _ = walk(client, link[link.index("<") + 1:link.index(">")])
+    assert [item["id"] for item in first.get_json()] + rest[:-1] == people
+    assert rest[-1] > people[-1]
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "eyJ4IjoxfQ"])
+def test_bad_cursor_is_400(client, people, cursor):
+    assert client.get("/people?after=%s" % cursor).status_code == 400
+
+
+def test_cursor_of_another_sort_is_400(client, people):
+    link = client.get("/people?limit=2&sort=age").headers["Link"]
+    cursor = link.split("after=")[1].split("&")[0].rstrip(">")
+    assert client.get("/people?limit=2&sort=name&after=%s" % cursor).status_code == 400
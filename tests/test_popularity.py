@@ -0,0 +1,61 @@
+import pytest
+from models import db, User, Planet
+
+
+@pytest.fixture
+def voters(app):
+    """users 1-3 and planets 1-3"""
+    with app.app_context():
+        db.session.add_all([User(id=number, email="user%d@example.com" % number, password="secret", is_active=True)
+                            for number in (1, 2, 3)])
+        db.session.add_all([Planet(id=number, name=name) for number, name in ((1, "Hoth"), (2, "Kashyyyk"), (3, "Mustafar"))])
+        db.session.commit()
+
+
+def top(client, by="favorites"):
+    response = client.get("/top/planets?by=%s" % by)
+    assert response.status_code == 200
+    return [(item["name"], item[by]) for item in response.get_json()]
+
+
+def favorite(client, user_id, planet_id):
+    assert client.post("/favorites/user/%d/planet/%d" % (user_id, planet_id)).status_code == 201
+
+
+def test_top_follows_the_favorites(client, voters):
+    for user_id, planet_id in ((1, 2), (2, 2), (3, 2), (1, 3), (2, 3), (1, 1)):
+        favorite(client, user_id, planet_id)
+    assert top(client) == [("Kashyyyk", 3), ("Mustafar", 2), ("Hoth", 1)]
+
+    assert client.delete("/favorite/planet/2?user_id=1").status_code == 200
+    assert client.delete("/favorite/planet/2?user_id=2").status_code == 200
+    assert top(client) == [("Mustafar", 2), ("Kashyyyk", 1), ("Hoth", 1)]
+
+
+def test_batch_moves_the_counters(client, voters):
+    response = client.post("/favorites/user/1/batch", json={"add": [{"kind": "planet", "id": 1}, {"kind": "planet", "id": 3}]})
+    assert response.status_code == 200
+    favorite(client, 2, 3)
+    assert top(client) == [("Mustafar", 2), ("Hoth", 1)]
+
+
+def test_top_follows_the_comments(client, voters):
+    for text in ("cold", "very cold"):
+        assert client.post("/comment/planet/1", json={"user_id": 1, "comment_text": text}).status_code == 201
+    assert top(client, by="comments") == [("Hoth", 2)]
+
+
+def test_renamed_and_deleted_items_leave_the_cached_top(client, voters):
+    favorite(client, 1, 2)
+    favorite(client, 1, 3)
+    favorite(client, 2, 3)
+    assert top(client) == [("Mustafar", 2), ("Kashyyyk", 1)]
+
+    assert client.put("/planets/3", json={"name": "Mustafar System"}).status_code == 200
+    assert top(client) == [("Mustafar System", 2), ("Kashyyyk", 1)]
+
+    assert client.put("/planets", json=[{"id": 2, "name": "Wookiee Planet"}]).status_code == 200
+    assert top(client) == [("Mustafar System", 2), ("Wookiee Planet", 1)]
+
+    assert client.delete("/planets/3").status_code == 200
+    assert top(client) == [("Wookiee Planet", 1)]
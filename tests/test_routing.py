@@ -0,0 +1,54 @@
+import pytest
+import routing
+from models import db, User, Planet, Favorite
+from routing import WriteMarkers, REPLICA_BIND
+
+
+@pytest.fixture
+def replicated(make_app, tmp_path, monkeypatch):
+    """App with a primary and a replica sqlite file: user 1 has a favorite planet on the primary only"""
+    # the writes of the other tests must not pin user 1 to the primary
+    monkeypatch.setattr(routing, "write_markers", WriteMarkers(str(tmp_path / "writers")))
+    app = make_app("primary.db", SQLALCHEMY_BINDS={REPLICA_BIND: "sqlite:///%s" % (tmp_path / "replica.db")})
+    with app.app_context():
+        db.metadata.create_all(db.engines[REPLICA_BIND])
+        for engine in (db.engine, db.engines[REPLICA_BIND]):
+            with engine.begin() as connection:
+                connection.execute(User.__table__.insert().values(
+                    id=1, email="leia@example.com", password="secret", is_active=True))
+                connection.execute(Planet.__table__.insert().values(id=1, name="Alderaan"))
+                connection.execute(Planet.__table__.insert().values(id=2, name="Hoth"))
+        db.session.add(Favorite(user_id=1, planet_id=1))
+        db.session.commit()
+    return app
+
+
+def favorite_planets(client):
+    response = client.get("/users/1/favorites")
+    return [favorite["planet_id"] for favorite in response.get_json()] if response.status_code == 200 else []
+
+
+def test_read_only_handlers_read_the_replica(replicated):
+    # the replica has not caught up with the favorite yet
+    assert favorite_planets(replicated.test_client()) == []
+
+
+def test_writer_reads_its_writes_from_the_primary(replicated):
+    client = replicated.test_client()
+    assert client.post("/favorites/user/1/planet/2").status_code == 201
+    assert favorite_planets(client) == [1, 2]
+
+
+def test_user_reads_its_writes_without_the_cookie(replicated):
+    assert replicated.test_client().post("/favorites/user/1/planet/2").status_code == 201
+    # another client (no cookie, maybe another worker) reading the same user
+    assert favorite_planets(replicated.test_client()) == [1, 2]
+
+
+def test_write_markers_are_shared_through_the_directory(tmp_path):
+    # each gunicorn worker has its own WriteMarkers on the same directory
+    writer, reader = WriteMarkers(str(tmp_path)), WriteMarkers(str(tmp_path))
+    assert reader.last_write(7) == 0
+    writer.touch(7)
+    assert reader.last_write(7) > 0
+    assert reader.last_write(8) == 0
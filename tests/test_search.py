@@ -0,0 +1,98 @@
+import pytest
+import search
+from models import db, Character, Planet
+from search import ChangeLog, MemoryIndex, memory_index, uses_native_index
+
+
+def titles(client, query):
+    response = client.get("/search", query_string={"q": query})
+    assert response.status_code == 200
+    return sorted(result["title"] for result in response.get_json())
+
+
+@pytest.fixture
+def rebuilds(monkeypatch):
+    # full rebuilds of the app's in-memory index
+    calls = []
+    rebuild = MemoryIndex.rebuild
+
+    def counted(self, session):
+        if self is memory_index:
+            calls.append(1)
+        return rebuild(self, session)
+    monkeypatch.setattr(MemoryIndex, "rebuild", counted)
+    return calls
+
+
+def test_writes_reach_the_in_memory_index_without_a_rebuild(app, client, rebuilds):
+    with app.app_context():
+        db.session.add_all([Character(name="Luke Skywalker"), Planet(name="Tatooine", climate="arid desert")])
+        db.session.commit()
+    assert titles(client, "sky") == ["Luke Skywalker"]
+    assert titles(client, "desert") == ["Tatooine"]
+    assert len(rebuilds) == 1
+
+    luke_id = client.get("/search", query_string={"q": "luke"}).get_json()[0]["id"]
+    assert client.put("/people/%d" % luke_id, json={"name": "Anakin Skywalker"}).status_code == 200
+    assert titles(client, "luke") == []
+    assert titles(client, "skywalker") == ["Anakin Skywalker"]
+
+    assert client.delete("/people/%d" % luke_id).status_code == 200
+    assert titles(client, "skywalker") == []
+    # only the changed documents were read again
+    assert len(rebuilds) == 1
+
+
+def test_bulk_writes_reach_the_in_memory_index(app, client, rebuilds):
+    assert titles(client, "hoth") == []
+    response = client.post("/planets", json=[{"name": "Hoth", "climate": "frozen"}, {"name": "Bespin"}])
+    assert response.status_code in (200, 201, 207)
+    assert titles(client, "hoth") == ["Hoth"]
+    assert titles(client, "frozen") == ["Hoth"]
+    assert len(rebuilds) == 1
+
+
+def test_every_worker_sees_the_changes_of_the_others(app, client):
+    other_worker = MemoryIndex(search.change_log)
+    with app.app_context():
+        other_worker.refresh(db.session)
+        db.session.add(Character(name="Obi-Wan Kenobi"))
+        db.session.commit()
+        other_worker.refresh(db.session)
+        assert [document[2] for document in other_worker.documents.values()] == ["Obi-Wan Kenobi"]
+
+
+def test_a_started_over_log_rebuilds_the_index(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(search, "CHANGE_LOG_MAX_BYTES", 0)
+    changes = ChangeLog(str(tmp_path / "search.changes"))
+    index = MemoryIndex(changes)
+    with app.app_context():
+        index.refresh(db.session)
+        changes.append([(0, 1)])
+        first = changes.state()[0]
+        # bigger than the limit: the next append starts a new file
+        changes.append([(0, 2)])
+        assert changes.state()[0] != first
+        db.session.add(Character(name="Yoda"))
+        db.session.commit()
+        index.refresh(db.session)
+    assert [document[2] for document in index.documents.values()] == ["Yoda"]
+
+
+def test_native_index_check_is_done_again_after_dispose(app):
+    with app.app_context():
+        engine = db.engine
+        with engine.connect() as connection:
+            assert uses_native_index(connection) is False
+        assert engine in search._native
+        engine.dispose()
+        assert engine not in search._native
+
+
+@pytest.mark.parametrize("name", ["search_index", "search_index_data", "sqlite_stat1", "sqlite_stat4", "sqlite_sequence"])
+def test_autogenerate_leaves_the_managed_tables_alone(name):
+    assert search.include_object(None, name, "table", True, None) is False
+
+
+def test_autogenerate_compares_the_model_tables():
+    assert search.include_object(None, "favorites", "table", True, None) is True
@@ -0,0 +1,28 @@
+import json
+import pytest
+from models import db, Planet
+
+
+@pytest.fixture
+def planets(app, monkeypatch):
+    # several batches per stream
+    monkeypatch.setattr("streaming.STREAM_BATCH_SIZE", 3)
+    with app.app_context():
+        db.session.add_all([Planet(name="Planet %02d" % number) for number in range(10)])
+        db.session.commit()
+        return [planet.id for planet in Planet.query.order_by(Planet.id)]
+
+
+def test_stream_is_one_json_array_of_every_row(client, planets):
+    response = client.get("/planets?stream=1")
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert [item["id"] for item in json.loads(response.get_data())] == planets
+
+
+def test_ndjson_stream_has_one_row_per_line(client, planets):
+    response = client.get("/planets", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)["id"] for line in lines] == planets